@@ -27,7 +27,7 @@ class Post(Base):
         orm.DateTime('time_created', default=datetime.datetime.now)
         ]
 
-    _indexes = [['time_created']]
+    _indexes = [['time_created'], orm.TextIndex('text_post', ['title', 'content'])]
 
     @classmethod
     def new_post(cls, title, content):
@@ -37,35 +37,50 @@ class Post(Base):
     def comments(self):
         """Get all the comments for this post, ordered by time created."""
         if not hasattr(self, '_comments'):
-            comments = Comment.query(c.post_id == self.id)
+            comments = self.prefetched(Comment, 'post_id')
+            if comments is None:
+                comments = Comment.query(c.post_id == self.id)
             self._comments = sorted(comments, key=lambda c: c.time_created)
         return self._comments
 
 class Comment(Base):
     _columns = [
-        orm.Guid('post_id', 32, required=True),
+        orm.Guid('post_id', required=True),
         orm.String('author', 255),
         orm.Text('content', required=True),
         orm.DateTime('time_created', default=datetime.datetime.now)
         ]
 
-    _indexes = [['comment_id']]
+    _indexes = [['post_id']]
 
     @classmethod
     def reply(cls, post_id, author, content):
-        return cls(comment_id=schemaless.guid(), post_id=post_id, author=author, content=content).save()
+        return cls(post_id=post_id, author=author, content=content).save()
 
 ##############
 # Tornado Things
 ##############
 
-class MainHandler(tornado.web.RequestHandler):
+class BaseHandler(tornado.web.RequestHandler):
+
+    def on_finish(self):
+        # the session caches the documents it loads; start each request
+        # with an empty one so that it doesn't serve stale documents
+        session.clear()
+
+class MainHandler(BaseHandler):
 
     def get(self):
-        posts = sorted(Post.all(), key=lambda x: x.time_created, reverse=True)
+        posts = sorted(Post.all().prefetch(Comment, 'post_id'), key=lambda x: x.time_created, reverse=True)
         self.render('main.html', title='Blog', posts=posts)
 
-class PostHandler(tornado.web.RequestHandler):
+class SearchHandler(BaseHandler):
+
+    def get(self):
+        posts = Post.search(self.get_argument('q'), prefix=True).prefetch(Comment, 'post_id')
+        self.render('main.html', title='Search', posts=posts)
+
+class PostHandler(BaseHandler):
 
     def get(self):
         self.render('post.html', title='New Post')
@@ -76,7 +91,7 @@ class PostHandler(tornado.web.RequestHandler):
         Post.new_post(title, content)
         self.redirect('/')
 
-class CommentHandler(tornado.web.RequestHandler):
+class CommentHandler(BaseHandler):
 
     def post(self):
         post_id = self.get_argument('post_id')
@@ -94,6 +109,7 @@ settings = {
 
 application = tornado.web.Application([
         ('/', MainHandler),
+        ('/search', SearchHandler),
         ('/post', PostHandler),
         ('/comment', CommentHandler)], **settings)
 
@@ -16,6 +16,14 @@ Some notes:
  * if you're on a machine without dedicated hardware (e.g. a VPS), you'll
    probably see interesting things with transaction times fluctuating wildly as
    your instance gets access to hardware
+ * to get closer to what the schemaless write path really does, use
+   --threads to insert from several connections at once, --index-tables to
+   also write a row into some index_* style tables for every entity, --ids=time
+   to use time-ordered ids instead of random ones, and --json to use
+   compressible JSON bodies (compressed like DataStore does) instead of random
+   bytes
+ * with --latency-csv, a histogram of the latency of every single entity write
+   (entity row plus its index rows) is stored for each schema
 
 An example yaml config file (ignore the lines starting with ---):
 
@@ -32,16 +40,30 @@ import csv
 import math
 import time
 import yaml
+import zlib
+import random
+import struct
+import Queue
 import optparse
+import threading
+import simplejson
 import MySQLdb
 
 OVERALL_TIMES = []
+OVERALL_LATENCIES = []
 
-def drop_test_entities(conn):
+# upper bounds (in seconds) of the latency histogram buckets; the last bucket
+# catches everything slower than the last bound
+LATENCY_BUCKETS = [0.0001 * 2**x for x in xrange(16)]
+
+WORDS = ('the quick brown fox jumps over lazy dog schemaless mysql entity '
+         'index body friendfeed user post comment title content tag').split()
+
+def drop_test_tables(conn):
     c = conn.cursor()
-    c.execute('SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s', 'test_entities')
-    if c.fetchone():
-        c.execute('DROP TABLE test_entities')
+    c.execute('SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() AND (table_name = %s OR table_name LIKE %s)', ('test_entities', 'test\\_index\\_%'))
+    for row in c.fetchall():
+        c.execute('DROP TABLE %s' % (row[0],))
 
 def create_table(conn, lines, data):
     q = []
@@ -57,56 +79,177 @@ def create_table(conn, lines, data):
         c.execute('ALTER TABLE test_entities ADD COLUMN payload MEDIUMBLOB')
         print('ALTER TABLE test_entities ADD COLUMN payload MEDIUMBLOB')
 
-def increment_worker(c, data):
-    os.urandom(16) # ensure that this has the same overhead as uuid_worker;
-                   # comment out if you don't like this fairness
+def create_index_tables(conn, num_tables):
+    c = conn.cursor()
+    for x in xrange(num_tables):
+        c.execute("""
+            CREATE TABLE test_index_%d (
+                entity_id BINARY(16) NOT NULL,
+                value CHAR(32) NOT NULL,
+                PRIMARY KEY (value, entity_id),
+                UNIQUE KEY (entity_id)
+            ) ENGINE=InnoDB""" % (x,))
+    if num_tables:
+        print 'created %d index tables' % (num_tables,)
+
+def random_id():
+    return os.urandom(16)
+
+def time_ordered_id():
+    # microseconds since the epoch followed by random bytes, so that ids
+    # generated close together in time are close together in the index
+    return struct.pack('>Q', int(time.time() * 1000000)) + os.urandom(8)
+
+ID_STRATEGIES = {'random': random_id, 'time': time_ordered_id}
+
+def make_json_payload(size):
+    """Make a compressible JSON body of (roughly) the given size, compressed
+    the same way that DataStore.put compresses bodies.
+    """
+    d = {'user_id': os.urandom(16).encode('hex'), 'title': ' '.join(random.choice(WORDS) for x in xrange(8))}
+    content = []
+    length = 0
+    while length < size:
+        word = random.choice(WORDS)
+        content.append(word)
+        length += len(word) + 1
+    d['content'] = ' '.join(content)
+    return zlib.compress(simplejson.dumps(d), 1)
+
+def increment_worker(c, entity_id, data):
     if data:
         c.execute('INSERT INTO test_entities (added_id, payload) VALUES (NULL, %s)', data)
     else:
         c.execute('INSERT INTO test_entities (added_id) VALUES (NULL)')
 
-def uuid_worker(c, data):
+def uuid_worker(c, entity_id, data):
     if data:
-        c.execute('INSERT INTO test_entities (id, payload) VALUES (%s, %s)', (os.urandom(16), data))
+        c.execute('INSERT INTO test_entities (id, payload) VALUES (%s, %s)', (entity_id, data))
     else:
-        c.execute('INSERT INTO test_entities (id) VALUES (%s)', os.urandom(16))
+        c.execute('INSERT INTO test_entities (id) VALUES (%s)', entity_id)
+
+class InsertThread(threading.Thread):
+    """A thread with its own connection and task queue, which runs one
+    transaction of batch_size entity writes for every task put on its queue.
+    """
+
+    def __init__(self, cfg, opts, results):
+        super(InsertThread, self).__init__()
+        self.daemon = True
+        self.opts = opts
+        self.tasks = Queue.Queue()
+        self.results = results
+        self.conn = MySQLdb.connect(**cfg)
+        self.conn.cursor().execute('SET autocommit = %d' % (int(opts.autocommit),))
+        self.make_id = ID_STRATEGIES[opts.ids]
+
+    def run(self):
+        c = self.conn.cursor()
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            worker, data = task
+            latencies = []
+            try:
+                if not self.opts.autocommit:
+                    c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                for y in xrange(self.opts.batch_size):
+                    ts = time.time()
+                    entity_id = self.make_id()
+                    worker(c, entity_id, data)
+                    for x in xrange(self.opts.index_tables):
+                        c.execute('INSERT INTO test_index_%d (entity_id, value) VALUES (%%s, %%s)' % (x,), (entity_id, os.urandom(16).encode('hex')))
+                    latencies.append(time.time() - ts)
+                self.conn.commit()
+            except Exception, e:
+                self.results.put(e)
+            else:
+                self.results.put(latencies)
 
-def bench(name, opts, conn, data, schema, worker=uuid_worker):
-    drop_test_entities(conn)
+    def stop(self):
+        self.tasks.put(None)
+        self.join()
+        self.conn.close()
+
+def make_histogram(latencies):
+    counts = [0 for x in xrange(len(LATENCY_BUCKETS) + 1)]
+    for latency in latencies:
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(round(pct / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[idx]
+
+def bench(name, opts, cfg, conn, data, schema, worker=uuid_worker):
+    drop_test_tables(conn)
     print name
     print '=' * len(name)
     create_table(conn, schema, data=data)
+    create_index_tables(conn, opts.index_tables)
     if opts.sleep:
         time.sleep(opts.sleep)
+
+    results = Queue.Queue()
+    threads = [InsertThread(cfg, opts, results) for x in xrange(opts.threads)]
+    for t in threads:
+        t.start()
+
     times = []
-    c = conn.cursor()
-    for x in xrange(opts.num_iterations):
-        if not opts.autocommit:
-            c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
-        ts = time.time()
-        for y in xrange(opts.batch_size):
-            worker(c, data)
-        conn.commit()
-        elapsed = time.time() - ts
-        times.append(elapsed)
-        print '% 4d    %f' % (x + 1, elapsed)
+    latencies = []
+    try:
+        for x in xrange(opts.num_iterations):
+            ts = time.time()
+            for t in threads:
+                t.tasks.put((worker, data))
+            for t in threads:
+                result = results.get()
+                if isinstance(result, Exception):
+                    raise result
+                latencies.extend(result)
+            elapsed = time.time() - ts
+            times.append(elapsed)
+            print '% 4d    %f' % (x + 1, elapsed)
+    finally:
+        for t in threads:
+            t.stop()
+
     OVERALL_TIMES.append((name, times))
+    OVERALL_LATENCIES.append((name, make_histogram(latencies)))
     sorted_times = sorted(times)
     total = sum(times)
     avg = total / len(times)
     if len(times) % 2 == 0:
         idx = len(times) / 2
-        med = (sorted_times[idx] + sorted_times[idx + 1]) / 2
+        med = (sorted_times[idx - 1] + sorted_times[idx]) / 2
     else:
-        med = times[len(sorted_times) / 2]
+        med = sorted_times[len(sorted_times) / 2]
     dev = math.sqrt(sum((x - avg)**2 for x in times) / len(times))
+    latencies.sort()
     print
     print 'average = %1.3f' % (avg,)
     print 'median  = %1.3f' % (med,)
     print 'std dev = %1.3f' % (dev,)
+    print 'per-entity write latency: p50 = %1.2f ms, p99 = %1.2f ms, max = %1.2f ms' % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, latencies[-1] * 1000)
     print
     return times
 
+def write_latency_csv(path):
+    writer = csv.writer(open(path, 'w'))
+    writer.writerow(['latency_ms'] + [name for name, _ in OVERALL_LATENCIES])
+    bounds = ['%1.1f' % (b * 1000,) for b in LATENCY_BUCKETS] + ['inf']
+    for i, bound in enumerate(bounds):
+        writer.writerow([bound] + [counts[i] for _, counts in OVERALL_LATENCIES])
+
 def main(opts, args):
     start = time.time()
     cfg = yaml.load(open(args[0]).read())
@@ -116,7 +259,9 @@ def main(opts, args):
     print '%s %s' % (opsys, kernel)
     print 'MySQL ' + conn.get_server_info()
     print
-    print 'running %d iterations of %d inserts per txn (%d rows total)' % (opts.num_iterations, opts.batch_size, opts.num_iterations * opts.batch_size)
+    rows_per_iteration = opts.batch_size * opts.threads
+    print 'running %d iterations of %d inserts per txn on %d connection(s) (%d rows total)' % (opts.num_iterations, opts.batch_size, opts.threads, opts.num_iterations * rows_per_iteration)
+    print 'using %s ids, %d index table(s) per entity' % (opts.ids, opts.index_tables)
     if opts.autocommit:
         conn.cursor().execute('SET autocommit = 1')
         print 'autocommit is ON'
@@ -125,45 +270,54 @@ def main(opts, args):
         print 'autocommit is OFF'
     print
 
-    data = os.urandom(opts.data) if opts.data else None
-    bench('just auto_increment', opts, conn, data,
+    if not opts.data:
+        data = None
+    elif opts.json:
+        data = make_json_payload(opts.data)
+        print 'json payload is %d bytes compressed' % (len(data),)
+    else:
+        data = os.urandom(opts.data)
+    bench('just auto_increment', opts, cfg, conn, data,
           ['added_id INTEGER NOT NULL AUTO_INCREMENT,',
            'PRIMARY KEY (added_id)'], increment_worker)
 
-    bench('auto_increment, key', opts, conn, data,
+    bench('auto_increment, key', opts, cfg, conn, data,
           ['added_id INTEGER NOT NULL AUTO_INCREMENT,',
            'id BINARY(16) NOT NULL,',
            'PRIMARY KEY (added_id),',
            'KEY (id)'])
 
-    bench('auto_increment, unique key', opts, conn, data,
+    bench('auto_increment, unique key', opts, cfg, conn, data,
           ['added_id INTEGER NOT NULL AUTO_INCREMENT,',
            'id BINARY(16) NOT NULL,',
            'PRIMARY KEY (added_id),',
            'UNIQUE KEY (id)'])
 
-    bench('w/o auto-increment, key', opts, conn, data,
-          ['id BINARY(16) NOT NULL,'
+    bench('w/o auto-increment, key', opts, cfg, conn, data,
+          ['id BINARY(16) NOT NULL,',
            'KEY (id)'])
 
-    bench('w/o auto-increment, unique key', opts, conn, data,
+    bench('w/o auto-increment, unique key', opts, cfg, conn, data,
           ['id BINARY(16) NOT NULL,',
            'UNIQUE KEY (id)'])
 
-    bench('w/o auto-increment, primary key', opts, conn, data,
+    bench('w/o auto-increment, primary key', opts, cfg, conn, data,
           ['id BINARY(16) NOT NULL,',
            'PRIMARY KEY (id)'])
 
-    drop_test_entities(conn)
+    drop_test_tables(conn)
     if opts.csv:
         writer = csv.writer(open(opts.csv, 'w'))
         names = ['cumulative'] + [name for name, _ in OVERALL_TIMES]
         writer.writerow(names)
         writer.writerow([0 for x in xrange(len(OVERALL_TIMES) + 1)])
         for x in xrange(opts.num_iterations):
-            tot = (x + 1) * opts.batch_size
+            tot = (x + 1) * rows_per_iteration
             writer.writerow([tot] + [t[x] for _, t in OVERALL_TIMES])
         print 'csv output is in %r' % (opts.csv,)
+    if opts.latency_csv:
+        write_latency_csv(opts.latency_csv)
+        print 'latency histograms are in %r' % (opts.latency_csv,)
     print 'total time was %1.3f seconds' % (time.time() - start)
 
 if __name__ == '__main__':
@@ -172,9 +326,16 @@ if __name__ == '__main__':
     parser.add_option('-b', '--batch-size', type='int', default=10000, help='How many rows to insert per txn')
     parser.add_option('-c', '--csv', default=None, help='Store benchmark output in the specified CSV file')
     parser.add_option('-d', '--data', type='int', default=0, help='Add a data column, with this size')
+    parser.add_option('-i', '--index-tables', type='int', default=0, help='How many secondary index tables to write per entity')
+    parser.add_option('-j', '--json', action='store_true', default=False, help='Use a compressed JSON body for the data column instead of random bytes')
+    parser.add_option('-l', '--latency-csv', default=None, help='Store per-entity write latency histograms in the specified CSV file')
     parser.add_option('-n', '--num-iterations', type='int', default=100, help='How many iterations to run')
     parser.add_option('-s', '--sleep', type='int', default=10, help='How long to sleep between tests')
+    parser.add_option('-t', '--threads', type='int', default=1, help='How many concurrent connections to insert from')
+    parser.add_option('--ids', type='choice', choices=sorted(ID_STRATEGIES.keys()), default='random', help='How to generate ids: random or time (time-ordered)')
     opts, args = parser.parse_args()
     if len(args) != 1:
         parser.error('must pass exactly one argument, the path to the mysql config file')
+    if opts.threads < 1:
+        parser.error('--threads must be at least 1')
     main(opts, args)
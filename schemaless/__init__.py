@@ -1,5 +1,11 @@
 from schemaless.guid import *
 from schemaless.column import Entity, c
 from schemaless.index import Index
-from schemaless.datastore import DataStore
-from schemaless.batch import IndexUpdater, main
+from schemaless.text import TextIndex
+from schemaless.deadline import Deadline, DeadlineExceeded, deadline_scope
+from schemaless.singleflight import SingleFlight
+from schemaless.datastore import DataStore, ConflictError, CHANGE_INSERT, CHANGE_UPDATE, CHANGE_DELETE
+from schemaless.changefeed import ChangeFeed, Change
+from schemaless.view import View
+from schemaless.counter import Counter
+from schemaless.batch import IndexUpdater, ExpiryPurger, TombstonePurger, main
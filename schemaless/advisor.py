@@ -0,0 +1,254 @@
+"""Index advice from recorded queries.
+
+A QueryRecorder keeps a summary of every query shape (the columns and
+operators in the WHERE clause, the ordering and whether there's a limit)
+run through Index._do_query and Document._query: how often it ran, how long
+it took, and how many rows were fetched from MySQL versus returned after the
+expressions that no index covered were checked in Python.
+
+    recorder = datastore.enable_recorder()
+    ...
+    recorder.save('/tmp/queries.json')
+
+Advisor runs EXPLAIN on the busiest shapes and recommends indexes for the
+ones that post-filter or scan, ranked by how many rows they'd save:
+
+    python -m schemaless.advisor --host localhost:3306 --database test /tmp/queries.json
+"""
+import sys
+import threading
+import optparse
+import simplejson
+
+import tornado.database
+
+from schemaless.column import ColumnExpression
+from schemaless.log import ClassLogger
+
+_op_names = {
+    ColumnExpression.OP_LT: '<',
+    ColumnExpression.OP_LE: '<=',
+    ColumnExpression.OP_EQ: '=',
+    ColumnExpression.OP_NE: '!=',
+    ColumnExpression.OP_GT: '>',
+    ColumnExpression.OP_GE: '>=',
+    ColumnExpression.OP_IN: 'IN'}
+
+# plans that read the whole table (or the whole of an index)
+_scan_types = frozenset(['ALL', 'index'])
+
+def _columns(exprs):
+    return sorted(set((e.name, _op_names[e.op]) for e in exprs))
+
+def _encode_param(val):
+    if isinstance(val, str):
+        try:
+            val.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'hex': val.encode('hex')}
+    return val
+
+def _decode_param(val):
+    if isinstance(val, dict):
+        return val['hex'].decode('hex')
+    return val
+
+def suggest_fields(columns, order_by=None):
+    """The fields for an index that serves a query shape: the equality
+    columns, then one range column, then the ordering column, which is the
+    order MySQL can use them in.
+    """
+    fields = []
+    for name, op in columns:
+        if op in ('=', 'IN') and name not in fields:
+            fields.append(name)
+    for name, op in columns:
+        if name not in fields:
+            fields.append(name)
+            break
+    if order_by and order_by[0] not in fields:
+        fields.append(order_by[0])
+    return fields
+
+class QueryRecorder(object):
+    """Summarizes query shapes, see the module docstring. At most max_shapes
+    distinct shapes are kept; queries with new shapes after that are only
+    counted in self.dropped.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, max_shapes=1000):
+        self.max_shapes = max_shapes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
+            self.dropped = 0
+
+    def record(self, source, name, index, exprs, residual, order_by, limit, fetched, returned, elapsed, sql, params):
+        """Record one query.
+
+        source -- 'index' for Index._do_query, 'document' for Document._query
+        name -- the index table, or the document class name
+        index -- the index table the query was run against
+        exprs -- all of the expressions in the query
+        residual -- the expressions that were checked in Python
+        order_by, limit -- as passed to the query
+        fetched, returned -- rows read from MySQL, and rows returned
+        elapsed -- wall clock time, in seconds
+        sql, params -- the index query that was run, with its parameters
+        """
+        order = (order_by.name, order_by.order) if order_by else None
+        key = (source, name, index, tuple(e.shape[:2] for e in exprs), tuple(e.shape[:2] for e in residual), order, bool(limit))
+        with self.lock:
+            shape = self.shapes.get(key)
+            if shape is None:
+                if len(self.shapes) >= self.max_shapes:
+                    self.dropped += 1
+                    return
+                shape = self.shapes[key] = {
+                    'source': source,
+                    'name': name,
+                    'index': index,
+                    'columns': _columns(exprs),
+                    'residual': _columns(residual),
+                    'order_by': order,
+                    'limit': bool(limit),
+                    'count': 0,
+                    'fetched': 0,
+                    'returned': 0,
+                    'total_time': 0.0}
+            shape['count'] += 1
+            shape['fetched'] += fetched
+            shape['returned'] += returned
+            shape['total_time'] += elapsed
+            # the most recent parameters, for EXPLAIN
+            shape['sql'] = sql
+            shape['params'] = list(params)
+
+    def snapshot(self):
+        """Return the recorded shapes, busiest (by rows fetched) first."""
+        with self.lock:
+            shapes = [dict(s, params=list(s['params'])) for s in self.shapes.itervalues()]
+        shapes.sort(key=lambda s: (s['fetched'], s['count']), reverse=True)
+        return shapes
+
+    def save(self, path):
+        shapes = self.snapshot()
+        for s in shapes:
+            s['params'] = [_encode_param(p) for p in s['params']]
+        with open(path, 'w') as f:
+            simplejson.dump(shapes, f)
+
+    @classmethod
+    def load_shapes(cls, path):
+        """Read the shapes written by save()."""
+        with open(path) as f:
+            shapes = simplejson.load(f)
+        for s in shapes:
+            s['params'] = [_decode_param(p) for p in s['params']]
+            if s['order_by']:
+                s['order_by'] = tuple(s['order_by'])
+        return shapes
+
+class Advisor(object):
+    """Turns recorded shapes into index recommendations, using EXPLAIN on
+    connection (a tornado.database.Connection, or a DataStore's connection)
+    to estimate how many rows the current plans read.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def explain(self, sql, params):
+        try:
+            rows = self.connection.query('EXPLAIN ' + sql, *params)
+        except Exception:
+            self.log.exception('failed to explain %s' % (sql,))
+            return None
+        return rows
+
+    def advise(self, shape):
+        """Return a recommendation for one shape, or None if its index
+        already serves it.
+        """
+        count = shape['count']
+        plan = self.explain(shape['sql'], shape['params'])
+        examined = float(shape['fetched']) / count
+        scan = False
+        if plan:
+            examined = max(examined, max(int(r.get('rows') or 0) for r in plan))
+            scan = any(r.get('type') in _scan_types or r.get('key') is None for r in plan)
+        if not (shape['residual'] or scan):
+            return None
+        saved = int((examined - float(shape['returned']) / count) * count)
+        if saved <= 0:
+            return None
+
+        fields = suggest_fields(shape['columns'], shape['order_by'])
+        if shape['source'] == 'document':
+            definition = '%s._indexes: %r' % (shape['name'], fields)
+        else:
+            definition = 'define_index(%r, %r)' % ('index_' + '_'.join(fields), fields)
+        return {
+            'name': shape['name'],
+            'source': shape['source'],
+            'index': shape['index'],
+            'fields': fields,
+            'definition': definition,
+            'saved': saved,
+            'count': count,
+            'fetched': shape['fetched'],
+            'returned': shape['returned'],
+            'scan': scan,
+            'plan': plan}
+
+    def report(self, shapes, top=20):
+        """Advise on the top shapes (as returned by QueryRecorder.snapshot)
+        and return the recommendations, most rows saved first. Shapes that
+        lead to the same index are merged.
+        """
+        advice = {}
+        for shape in shapes[:top]:
+            rec = self.advise(shape)
+            if rec is None:
+                continue
+            key = (rec['name'], tuple(rec['fields']))
+            if key in advice:
+                advice[key]['saved'] += rec['saved']
+                advice[key]['count'] += rec['count']
+            else:
+                advice[key] = rec
+        return sorted(advice.itervalues(), key=lambda r: r['saved'], reverse=True)
+
+def format_report(recommendations):
+    if not recommendations:
+        return 'No recommendations.'
+    lines = []
+    for rec in recommendations:
+        lines.append('%s (%s queries, ~%d rows saved)' % (rec['definition'], rec['count'], rec['saved']))
+        lines.append('    currently uses %s, fetched %d rows and returned %d%s' % (rec['index'], rec['fetched'], rec['returned'], ', scanning' if rec['scan'] else ''))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] recorded.json')
+    parser.add_option('--host', default='localhost:3306', help='MySQL host to run EXPLAIN on')
+    parser.add_option('--user', default=None)
+    parser.add_option('--password', default=None)
+    parser.add_option('--database', default=None)
+    parser.add_option('--top', type='int', default=20, help='How many of the busiest query shapes to look at')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected the file written by QueryRecorder.save')
+
+    connection = tornado.database.Connection(host=opts.host, user=opts.user, password=opts.password, database=opts.database)
+    advisor = Advisor(connection)
+    print format_report(advisor.report(QueryRecorder.load_shapes(args[0]), top=opts.top))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -37,10 +37,21 @@ class IndexUpdater(object):
     which requires iterating over a database table.
 
     At the very minimum you must implement your own process_row method.
+
+    Subclasses that don't need the whole row can set select_columns (which
+    must include added_id), and ones that don't look at the entity can set
+    decode_entities to False, in which case process_row gets None for it.
+    If raise_errors is set an exception ends the run and is raised from it,
+    instead of just being logged. Rows are read on self.connection if it's
+    set, and on the datastore's connection otherwise.
     """
 
     log = ClassLogger()
     use_zlib = True
+    select_columns = '*'
+    decode_entities = True
+    raise_errors = False
+    connection = None
 
     def __init__(self):
         self.parser = optparse.OptionParser()
@@ -62,11 +73,11 @@ class IndexUpdater(object):
         self.run()
 
     def row_iterator(self):
-        conn = self.datastore.connection
+        conn = self.connection if self.connection is not None else self.datastore.connection
         conn.execute('SET AUTOCOMMIT=1')
         next_row = self.opts.start_added_id
         while True:
-            rows = conn.query('SELECT * FROM entities WHERE added_id >= %s ORDER BY added_id ASC LIMIT %s', next_row, self.opts.batch_size)
+            rows = conn.query('SELECT %s FROM entities WHERE added_id >= %%s ORDER BY added_id ASC LIMIT %%s' % (self.select_columns,), next_row, self.opts.batch_size)
             if rows:
                 for row in rows:
                     yield row
@@ -86,16 +97,139 @@ class IndexUpdater(object):
         self.log.info('starting run loop')
         try:
             for row in self.row_iterator():
-                entity = Entity.from_row(row, use_zlib=self.use_zlib)
+                entity = Entity.from_row(row, use_zlib=self.use_zlib) if self.decode_entities else None
                 self.process_row(row, entity)
                 self.rows_processed += 1
                 self.last_id_processed = row['added_id']
         except:
             self.log.exception('exception during run loop!')
+            if self.raise_errors:
+                raise
         finally:
             elapsed_time = time.time() - self.start_run
             self.log.info('finished run loop, elapsed time = %1.2f seconds, processed %d rows, last added_id was %d' % (elapsed_time, self.rows_processed, self.last_id_processed))
 
+class Purger(object):
+    """Base class for the batches that delete rows in the background. Between
+    batches the purger sleeps for pause seconds, and if max_replica_lag is
+    set it also waits until no replica is more than that many seconds
+    behind, so that purging doesn't cause replication lag.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, datastore, batch_size=500, pause=0.1, max_replica_lag=None, lag_check_interval=1.0):
+        self.datastore = datastore
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_replica_lag = max_replica_lag
+        self.lag_check_interval = lag_check_interval
+        self.purged = 0
+
+    def throttle(self):
+        if self.pause:
+            time.sleep(self.pause)
+        if self.max_replica_lag is None:
+            return
+        while True:
+            lag = self.datastore.router.replica_lag()
+            if lag is None or lag <= self.max_replica_lag:
+                break
+            self.log.info('replicas are %s seconds behind, waiting' % (lag,))
+            time.sleep(self.lag_check_interval)
+
+class ExpiryPurger(Purger):
+    """Deletes expired entities (see the ttl argument of DataStore.put), and
+    their index rows, in batches of batch_size. The entity_expiry table is
+    walked in primary key order, and each batch is deleted in its own
+    transaction.
+
+        purger = schemaless.ExpiryPurger(datastore, max_replica_lag=5)
+        purger.run()
+    """
+
+    def __init__(self, datastore, **kwargs):
+        if datastore.expiry_index is None:
+            raise ValueError('The datastore was not created with expiry=True')
+        super(ExpiryPurger, self).__init__(datastore, **kwargs)
+        self.position = None
+
+    def purge_batch(self, now):
+        """Delete the next batch of entities that expired before now. Returns
+        the number of entity_expiry rows looked at.
+        """
+        conn = self.datastore.connection
+        if self.position is None:
+            rows = conn.query('SELECT expires_at, entity_id FROM entity_expiry WHERE expires_at <= %s ORDER BY expires_at, entity_id LIMIT %s', now, self.batch_size)
+        else:
+            expires_at, entity_id = self.position
+            rows = conn.query('SELECT expires_at, entity_id FROM entity_expiry WHERE expires_at <= %s AND (expires_at > %s OR (expires_at = %s AND entity_id > %s)) ORDER BY expires_at, entity_id LIMIT %s', now, expires_at, expires_at, entity_id, self.batch_size)
+        if rows:
+            self.purged += self.datastore.delete_expired([row['entity_id'] for row in rows], now)
+            self.position = (rows[-1]['expires_at'], rows[-1]['entity_id'])
+        return len(rows)
+
+    def run(self, max_batches=None):
+        """Purge everything that has expired as of now (or at most
+        max_batches batches of it). Returns the number of entities deleted.
+        """
+        start = now = time.time()
+        self.position = None
+        purged = self.purged
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batches += 1
+            if self.purge_batch(now) < self.batch_size:
+                break
+            self.throttle()
+        self.log.info('purged %d expired entities in %d batches, elapsed time = %1.2f seconds' % (self.purged - purged, batches, time.time() - start))
+        return self.purged - purged
+
+class TombstonePurger(Purger):
+    """Deletes the index rows (and chunks) left behind by
+    DataStore.delete_many(..., tombstone=True), batch_size of them at a time,
+    each batch in its own transaction.
+    """
+
+    def __init__(self, datastore, batch_size=5000, **kwargs):
+        super(TombstonePurger, self).__init__(datastore, batch_size=batch_size, **kwargs)
+
+    def purge_batch(self):
+        """Delete the next batch of tombstoned rows. Returns the number of
+        tombstones processed.
+        """
+        conn = self.datastore.connection
+        rows = conn.query('SELECT index_table, entity_id FROM tombstones ORDER BY index_table, entity_id LIMIT %s', self.batch_size)
+        if not rows:
+            return 0
+        tables = {}
+        for row in rows:
+            tables.setdefault(row['index_table'], []).append(row['entity_id'])
+        with self.datastore.transaction():
+            for table, entity_ids in sorted(tables.iteritems()):
+                in_clause = ', '.join('%s' for x in entity_ids)
+                conn.execute('DELETE FROM %s WHERE entity_id IN (%s)' % (table, in_clause), *entity_ids)
+                conn.execute('DELETE FROM tombstones WHERE index_table = %%s AND entity_id IN (%s)' % (in_clause,), table, *entity_ids)
+        self.purged += len(rows)
+        return len(rows)
+
+    def run(self, max_batches=None):
+        """Purge all of the tombstones (or at most max_batches batches of
+        them). Returns the number of tombstones processed.
+        """
+        if not self.datastore.check_table_exists('tombstones'):
+            return 0
+        start = time.time()
+        purged = self.purged
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batches += 1
+            if self.purge_batch() < self.batch_size:
+                break
+            self.throttle()
+        self.log.info('purged %d tombstones in %d batches, elapsed time = %1.2f seconds' % (self.purged - purged, batches, time.time() - start))
+        return self.purged - purged
+
 def main(batch_cls):
     batch_instance = batch_cls()
     batch_instance.start()
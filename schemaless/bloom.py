@@ -0,0 +1,310 @@
+"""A Bloom filter over entity ids, so that by_id can answer for ids that
+don't exist without asking MySQL.
+
+    ds = schemaless.DataStore(...)
+    ds.enable_id_filter('/var/tmp/entity_ids.bloom')
+
+The first time, the filter is built by streaming the ids in the entities
+table (with BloomBuilder) and saved, along with the highest added_id it
+covers; after that it's loaded from the file and brought up to date with
+just the rows added since. New entities written through the datastore are
+added as they're written, and the ones written by other processes are
+picked up by a background thread that refreshes the filter every
+refresh_interval seconds, on a connection of its own.
+
+A lookup never refreshes the filter or queries MySQL itself. An id that
+isn't in the filter is answered as missing as long as the last refresh is
+at most max_staleness seconds old, so, like a read from a lagging replica,
+an entity another process wrote within that window may not be found yet.
+If refreshes fall further behind than that (or within use_primary()),
+lookups of ids that aren't in the filter go to MySQL.
+
+added_id is assigned when a row is inserted, but rows become visible when
+they commit, which can be out of order. So a refresh remembers the added_ids
+it skipped over (the gaps), and looks for them again on the following
+refreshes. Gaps are forgotten once the row after them is gap_timeout
+seconds old (by the server's clock), since by then they're deleted or
+rolled back rows; an insert whose transaction stays open for longer than
+that isn't picked up until the filter is rebuilt.
+
+Deleted ids stay in the filter (which only costs a query when they're
+looked up); rebuilding it clears them out.
+"""
+import os
+import time
+import threading
+import math
+import bisect
+import struct
+import hashlib
+import optparse
+
+from schemaless.batch import IndexUpdater
+from schemaless.log import ClassLogger
+
+class BloomFilter(object):
+    """A Bloom filter for strings, sized for capacity items with the given
+    false positive rate. The bit positions are derived from the md5 of the
+    key (double hashing with its two halves).
+    """
+
+    # magic, version, num_bits, num_hashes, count, added_id
+    header = struct.Struct('<4sBQBQq')
+    magic = 'SBLM'
+    version = 1
+
+    def __init__(self, capacity, error_rate=0.01, num_bits=None, num_hashes=None):
+        if num_bits is None:
+            capacity = max(capacity, 1)
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+            num_hashes = max(int(round(float(num_bits) / capacity * math.log(2))), 1)
+        self.capacity = capacity
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+        self.count = 0
+
+    def __str__(self):
+        return '%s(num_bits=%d, num_hashes=%d, count=%d)' % (self.__class__.__name__, self.num_bits, self.num_hashes, self.count)
+    __repr__ = __str__
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        m = self.num_bits
+        return [(h1 + i * h2) % m for i in xrange(self.num_hashes)]
+
+    def add(self, key):
+        """Add a key. count is only incremented for keys that weren't
+        already (apparently) in the filter, so adding a key twice is
+        harmless.
+        """
+        bits = self.bits
+        new = False
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def save(self, path, added_id=0):
+        """Write the filter to path (atomically, through a temporary file),
+        with the added_id it's up to date as of.
+        """
+        tmp_path = '%s.tmp.%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, self.num_bits, self.num_hashes, self.count, added_id))
+            f.write(self.bits)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a filter written by save(). Returns (filter, added_id)."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, num_bits, num_hashes, count, added_id = cls.header.unpack_from(data)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError('%s is not a bloom filter file' % (path,))
+        bloom = cls(0, num_bits=num_bits, num_hashes=num_hashes)
+        bits = data[cls.header.size:]
+        if len(bits) != len(bloom.bits):
+            raise ValueError('%s is truncated' % (path,))
+        bloom.bits = bytearray(bits)
+        bloom.count = count
+        return bloom, added_id
+
+class BloomBuilder(IndexUpdater):
+    """Adds the ids of the entities rows from start_added_id on to a
+    BloomFilter. Only the id columns are read, and bodies aren't decoded.
+    The added_ids that were skipped over are collected in self.gaps, as
+    (first, last, updated) triples where updated is the UNIX_TIMESTAMP of
+    the row after the gap.
+    """
+
+    select_columns = 'added_id, id, UNIX_TIMESTAMP(updated) AS updated'
+    decode_entities = False
+    raise_errors = True
+
+    def __init__(self, datastore, bloom, start_added_id=0, batch_size=5000, connection=None, lock=None):
+        super(BloomBuilder, self).__init__()
+        self.datastore = datastore
+        self.bloom = bloom
+        self.connection = connection
+        self.lock = lock
+        self.opts = optparse.Values({'start_added_id': start_added_id, 'batch_size': batch_size})
+
+    def configure_logging(self):
+        pass
+
+    def initialize(self):
+        super(BloomBuilder, self).initialize()
+        self.gaps = []
+        # auto increment columns start at 1
+        self.next_added_id = max(self.opts.start_added_id, 1)
+
+    def process_row(self, row, entity):
+        if self.lock is None:
+            self.bloom.add(row['id'])
+        else:
+            with self.lock:
+                self.bloom.add(row['id'])
+        added_id = row['added_id']
+        if added_id > self.next_added_id:
+            self.gaps.append((self.next_added_id, added_id - 1, row['updated']))
+        self.next_added_id = added_id + 1
+
+    def build(self):
+        """Add the rows, and return the last added_id processed, or None if
+        there were none.
+        """
+        self.initialize()
+        self.run()
+        return self.last_id_processed if self.rows_processed else None
+
+class IdFilter(object):
+    """The Bloom filter of entity ids used by DataStore.by_id; see the
+    module docstring. connection is the one refreshes run on, which mustn't
+    be used by other threads (it defaults to the datastore's, for a filter
+    that's only refreshed by calling refresh()). A refresh_interval of None
+    doesn't start the background thread.
+    """
+
+    log = ClassLogger()
+
+    # how many gaps are looked for with one query
+    gap_batch_size = 100
+
+    def __init__(self, datastore, path=None, capacity=None, error_rate=0.01, refresh_interval=1.0, gap_timeout=300, max_staleness=5.0, connection=None):
+        self.datastore = datastore
+        self.connection = connection if connection is not None else datastore.connection
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.gap_timeout = gap_timeout
+        self.max_staleness = max_staleness
+        self.gaps = []
+        self.refreshed_at = 0
+        # bits are set with a read-modify-write, so adds from the refresh
+        # thread and the writers mustn't interleave
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.bloom = None
+        if path is not None and os.path.exists(path):
+            try:
+                self.bloom, self.added_id = BloomFilter.load(path)
+            except (IOError, ValueError, struct.error):
+                self.log.exception('not using the saved filter in %s' % (path,))
+        if self.bloom is None:
+            if capacity is None:
+                row = self.connection.get('SELECT MAX(added_id) AS added_id FROM entities')
+                capacity = max(2 * int(row['added_id'] or 0), 1000000)
+            self.bloom = BloomFilter(capacity, error_rate)
+            self.added_id = 0
+        self.refresh()
+        if path is not None:
+            self.save()
+        if refresh_interval is not None:
+            self.thread = threading.Thread(target=self._refresh_loop, name='IdFilter refresh')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __str__(self):
+        return '%s(bloom=%s, added_id=%d, gaps=%d)' % (self.__class__.__name__, self.bloom, self.added_id, len(self.gaps))
+    __repr__ = __str__
+
+    def _refresh_loop(self):
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                # lookups go to MySQL once the filter is max_staleness old
+                self.log.exception('refreshing the id filter failed')
+
+    def stop(self):
+        """Stop the background refreshes."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def refresh(self):
+        """Add the entities added since the filter was last brought up to
+        date, by this or any other process, and the ones that have since
+        committed in the gaps it skipped over.
+        """
+        start = time.time()
+        count = self.bloom.count
+        cutoff = self.connection.get('SELECT UNIX_TIMESTAMP() AS now')['now'] - self.gap_timeout
+        self.gaps = [g for g in self.gaps if g[2] >= cutoff]
+        if self.gaps:
+            self._fill_gaps()
+        builder = BloomBuilder(self.datastore, self.bloom, self.added_id + 1, connection=self.connection, lock=self.lock)
+        last_id = builder.build()
+        if last_id is not None:
+            self.added_id = last_id
+        self.gaps.extend(g for g in builder.gaps if g[2] >= cutoff)
+        # the rows that had committed when the refresh started are in
+        self.refreshed_at = start
+        if self.bloom.count != count:
+            self.log.debug('added %d ids in %1.3f seconds' % (self.bloom.count - count, time.time() - start))
+        if self.bloom.capacity and self.bloom.count > self.bloom.capacity:
+            self.log.warning('%d ids in a filter sized for %d, it should be rebuilt' % (self.bloom.count, self.bloom.capacity))
+
+    def _fill_gaps(self):
+        """Add the rows that have appeared in the gaps, and shrink the gaps
+        to the added_ids that are still missing.
+        """
+        found = []
+        for i in xrange(0, len(self.gaps), self.gap_batch_size):
+            batch = self.gaps[i:i + self.gap_batch_size]
+            q = 'SELECT added_id, id FROM entities WHERE ' + ' OR '.join('added_id BETWEEN %s AND %s' for g in batch)
+            vals = []
+            for first, last, updated in batch:
+                vals.extend([first, last])
+            for row in self.connection.query(q, *vals):
+                self.add(row['id'])
+                found.append(row['added_id'])
+        if not found:
+            return
+        found.sort()
+        gaps = []
+        for first, last, updated in self.gaps:
+            i = bisect.bisect_left(found, first)
+            while i < len(found) and found[i] <= last:
+                if found[i] > first:
+                    gaps.append((first, found[i] - 1, updated))
+                first = found[i] + 1
+                i += 1
+            if first <= last:
+                gaps.append((first, last, updated))
+        self.gaps = gaps
+
+    def save(self):
+        # a loaded filter looks for the rows in the gaps again, by starting
+        # from before the first of them
+        gaps = self.gaps
+        added_id = min(g[0] for g in gaps) - 1 if gaps else self.added_id
+        with self.lock:
+            self.bloom.save(self.path, added_id)
+
+    def add(self, entity_id):
+        with self.lock:
+            self.bloom.add(entity_id)
+
+    def might_exist(self, entity_id):
+        """False if there's no entity with this (raw) id, as of at most
+        max_staleness seconds ago. This never queries MySQL.
+        """
+        if entity_id in self.bloom:
+            return True
+        if self.datastore.router.state.primary_only:
+            return True
+        return time.time() - self.refreshed_at > self.max_staleness
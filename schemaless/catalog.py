@@ -0,0 +1,152 @@
+import os
+import zlib
+import tempfile
+import simplejson
+
+from schemaless.log import ClassLogger
+
+class SchemaCatalog(object):
+    """Cache of the tables (and their columns) in the database.
+
+    All of the table metadata is loaded with a single information_schema
+    query, the first time a table is looked up that the catalog doesn't know
+    about. After that, a table the catalog doesn't know about is looked up
+    on its own, since another process may have created it. Tables that
+    schemaless creates are added to the catalog directly.
+
+    If cache_file is given, the catalog is persisted there along with a
+    fingerprint of its contents, and loaded back on startup. The first lookup
+    then compares the fingerprint with one computed by the server (from
+    information_schema, in one query), and only loads the metadata again if
+    they differ, e.g. after an ALTER TABLE. Tables are assumed to never be
+    dropped or altered while the process runs; if that happens, call
+    invalidate().
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, connection, database=None, cache_file=None):
+        self.connection = connection
+        self.database = database
+        self.cache_file = cache_file
+        self.tables = {}
+        self.fingerprint = None
+        self.loaded = False
+        # the tables read from cache_file, until they've been checked
+        self.cached = None
+        if cache_file:
+            self._read_cache()
+
+    # the number of columns, and the sum and the xor of the CRC32s of
+    # "table.column.position" for each of them; unlike a GROUP_CONCAT, this
+    # isn't cut off at group_concat_max_len, and doesn't depend on the order
+    # MySQL collates the names in
+    fingerprint_sql = ("SELECT COUNT(*) AS num_columns, SUM(CRC32(CONCAT_WS('.', table_name, column_name, ordinal_position))) AS crc_sum, "
+                       "BIT_XOR(CRC32(CONCAT_WS('.', table_name, column_name, ordinal_position))) AS crc_xor "
+                       "FROM information_schema.columns WHERE table_schema = DATABASE()")
+
+    @staticmethod
+    def compute_fingerprint(tables):
+        """The fingerprint of some table metadata, the same as fingerprint_sql
+        computes for the database.
+        """
+        num_columns = crc_sum = crc_xor = 0
+        for name, columns in tables.iteritems():
+            for i, column in enumerate(columns):
+                crc = zlib.crc32('%s.%s.%d' % (name, column, i + 1)) & 0xffffffff
+                num_columns += 1
+                crc_sum += crc
+                crc_xor ^= crc
+        return '%d:%d:%d' % (num_columns, crc_sum, crc_xor)
+
+    def server_fingerprint(self):
+        """The fingerprint of the tables in the database, from the server."""
+        row = self.connection.get(self.fingerprint_sql)
+        return '%d:%d:%d' % (row['num_columns'], int(row['crc_sum'] or 0), int(row['crc_xor'] or 0))
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cache = simplejson.load(f)
+        except (IOError, ValueError):
+            return
+        tables = dict((str(k), [str(c) for c in v]) for k, v in cache.get('tables', {}).iteritems())
+        if cache.get('database') != self.database or cache.get('fingerprint') != self.compute_fingerprint(tables):
+            self.log.warning('ignoring stale or corrupt schema cache %s' % (self.cache_file,))
+            return
+        self.cached = tables
+
+    def _write_cache(self):
+        if not self.cache_file:
+            return
+        cache = {'database': self.database, 'fingerprint': self.fingerprint, 'tables': self.tables}
+        dirname = os.path.dirname(os.path.abspath(self.cache_file))
+        try:
+            fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.schemaless-catalog')
+            with os.fdopen(fd, 'w') as f:
+                simplejson.dump(cache, f)
+            os.rename(tmp_name, self.cache_file)
+        except (IOError, OSError):
+            self.log.exception('failed to write schema cache %s' % (self.cache_file,))
+
+    def load(self):
+        """Load the metadata for every table in the database, with one
+        query, or check the cached metadata against the server's fingerprint
+        (also with one query) and use it if it's up to date.
+        """
+        cached, self.cached = self.cached, None
+        if cached is not None:
+            fingerprint = self.compute_fingerprint(cached)
+            if self.server_fingerprint() == fingerprint:
+                self.tables = cached
+                self.fingerprint = fingerprint
+                self.loaded = True
+                return
+            self.log.info('the schema has changed since %s was written' % (self.cache_file,))
+        tables = {}
+        rows = self.connection.query('SELECT table_name AS table_name, column_name AS column_name FROM information_schema.columns WHERE table_schema = DATABASE() ORDER BY table_name, ordinal_position')
+        for row in rows:
+            tables.setdefault(row['table_name'], []).append(row['column_name'])
+        self.tables = tables
+        self.fingerprint = self.compute_fingerprint(tables)
+        self.loaded = True
+        self._write_cache()
+
+    def invalidate(self):
+        self.tables = {}
+        self.fingerprint = None
+        self.loaded = False
+        self.cached = None
+
+    def _load_table(self, table_name):
+        rows = self.connection.query('SELECT column_name AS column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s ORDER BY ordinal_position', table_name)
+        if rows:
+            self.add_table(table_name, [row['column_name'] for row in rows])
+
+    def has_table(self, table_name):
+        if table_name in self.tables:
+            return True
+        if self.loaded:
+            self._load_table(table_name)
+        else:
+            self.load()
+        return table_name in self.tables
+
+    def columns(self, table_name):
+        """Return the column names of a table, or None if there's no such
+        table.
+        """
+        if self.has_table(table_name):
+            return self.tables[table_name]
+        return None
+
+    def has_column(self, table_name, column_name):
+        return column_name in (self.columns(table_name) or ())
+
+    def add_table(self, table_name, columns):
+        """Record a table that was just created."""
+        self.tables[table_name] = list(columns)
+        self.fingerprint = self.compute_fingerprint(self.tables)
+        if self.loaded:
+            # otherwise the catalog isn't complete yet
+            self._write_cache()
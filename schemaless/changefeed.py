@@ -0,0 +1,128 @@
+"""Consume the changes made to entities, in order, from a checkpoint.
+
+When a DataStore is created with changelog=True, put, put_many and delete
+record every insert, update and delete in the changelog table, in the same
+transaction as the write itself. A ChangeFeed reads that table in batches,
+starting after the last change that its consumer committed:
+
+    feed = schemaless.ChangeFeed(datastore, 'search-indexer')
+    for change in feed.stream():
+        if change.op == schemaless.CHANGE_DELETE:
+            search.remove(change.entity_id)
+        else:
+            search.add(change.entity)
+
+Delivery is at-least-once: the offset of a batch is committed once the
+consumer asks for the change after it, so a consumer that crashes part way
+through a batch sees that batch again when it restarts.
+"""
+import time
+
+from schemaless.column import Entity
+from schemaless.datastore import CHANGE_INSERT, CHANGE_UPDATE, CHANGE_DELETE
+from schemaless.index import entities_in_sql
+from schemaless.log import ClassLogger
+
+class Change(object):
+    """A single change.
+
+    change_id -- the position of the change in the changelog
+    op -- one of CHANGE_INSERT, CHANGE_UPDATE or CHANGE_DELETE
+    entity_id -- the (hex) id of the entity
+    tag -- the tag of the entity, if known
+    entity -- the current contents of the entity, or None if it has been
+              deleted since (or the feed doesn't fetch entities)
+    """
+
+    __slots__ = ['change_id', 'op', 'entity_id', 'tag', 'entity']
+
+    def __init__(self, change_id, op, entity_id, tag, entity=None):
+        self.change_id = change_id
+        self.op = op
+        self.entity_id = entity_id
+        self.tag = tag
+        self.entity = entity
+
+    def __str__(self):
+        return '%s(change_id=%d, op=%d, entity_id=%s, tag=%r)' % (self.__class__.__name__, self.change_id, self.op, self.entity_id, self.tag)
+    __repr__ = __str__
+
+class ChangeFeed(object):
+    """Reads the changelog for one consumer.
+
+    Changelog ids are assigned when a write starts, so a transaction that
+    commits late can leave a hole that fills in afterwards. poll() stops at
+    such a gap until it's gap_timeout seconds old; after that the missing
+    change is assumed to be from a transaction that rolled back.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, datastore, consumer, batch_size=500, gap_timeout=10, fetch_entities=True):
+        if not datastore.changelog:
+            raise ValueError('The datastore was not created with changelog=True')
+        self.datastore = datastore
+        self.connection = datastore.connection
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.fetch_entities = fetch_entities
+        self.position = None
+
+    def committed_position(self):
+        """The change_id of the last change committed by this consumer."""
+        row = self.connection.get('SELECT change_id FROM changelog_offsets WHERE consumer = %s', self.consumer)
+        return row['change_id'] if row else 0
+
+    def commit(self, change_id=None):
+        """Durably record that the consumer has processed everything up to
+        change_id (by default, everything returned by poll so far).
+        """
+        if change_id is None:
+            change_id = self.position
+        if change_id is None:
+            return
+        self.connection.execute('INSERT INTO changelog_offsets (consumer, change_id) VALUES (%s, %s) ON DUPLICATE KEY UPDATE change_id = VALUES(change_id)', self.consumer, change_id)
+
+    def poll(self):
+        """Return the next batch of changes (possibly empty)."""
+        if self.position is None:
+            self.position = self.committed_position()
+        rows = self.connection.query('SELECT change_id, entity_id, tag, op, UNIX_TIMESTAMP() - UNIX_TIMESTAMP(created) AS age FROM changelog WHERE change_id > %s ORDER BY change_id LIMIT %s', self.position, self.batch_size)
+
+        expected = self.position + 1
+        changes = []
+        for row in rows:
+            if row['change_id'] != expected and row['age'] < self.gap_timeout:
+                self.log.debug('waiting for changes %d to %d to commit' % (expected, row['change_id'] - 1))
+                break
+            changes.append(Change(row['change_id'], row['op'], row['entity_id'].encode('hex'), row['tag']))
+            expected = row['change_id'] + 1
+
+        if changes and self.fetch_entities:
+            ids = list(set(ch.entity_id.decode('hex') for ch in changes if ch.op != CHANGE_DELETE))
+            if ids:
+                entities = {}
+                for row in self.connection.query(entities_in_sql(len(ids)), *ids):
+                    entity = Entity.from_row(row, use_zlib=self.datastore.use_zlib, chunks=self.datastore.chunks)
+                    entities[entity.id] = entity
+                for ch in changes:
+                    if ch.op != CHANGE_DELETE:
+                        ch.entity = entities.get(ch.entity_id)
+        if changes:
+            self.position = changes[-1].change_id
+        return changes
+
+    def stream(self, poll_interval=1.0, commit=True):
+        """Yield changes forever, waiting poll_interval seconds whenever
+        there's nothing new. If commit is true, each batch is committed once
+        the consumer moves on to the change after it.
+        """
+        while True:
+            changes = self.poll()
+            for change in changes:
+                yield change
+            if changes and commit:
+                self.commit()
+            if len(changes) < self.batch_size:
+                time.sleep(poll_interval)
@@ -0,0 +1,234 @@
+"""Out of line storage for the large fields of big entities.
+
+When a DataStore is created with chunk_threshold set, an entity whose JSON
+body is bigger than that has its largest fields moved to the entity_chunks
+table, split into chunk_size pieces, until the rest of the body fits. The
+entities row keeps a stub body, with a _chunked property naming the fields
+that were moved out (and whether each is 'text' or 'json').
+
+Entities read back are ChunkedEntity instances, which load the chunked
+fields (with one query) the first time one of them is accessed, so queries
+that only look at the small fields never read the chunks. stream_field
+reads a single field a chunk at a time.
+
+The fields that indexes and views read are never moved out of line, so
+that writing back an entity whose chunks weren't loaded keeps its index
+rows and view contributions (functions passed as extract or where aren't
+looked into, and shouldn't read fields that are big enough to be chunked).
+"""
+import codecs
+import zlib
+import simplejson
+
+from schemaless.column import Entity
+from schemaless.log import ClassLogger
+
+class ChunkedEntity(Entity):
+    """An entity whose big fields are loaded on first access."""
+
+    @property
+    def chunked_fields(self):
+        """The names of the fields that haven't been loaded yet."""
+        return sorted(dict.get(self, '_chunked') or ())
+
+    def __missing__(self, key):
+        chunked = dict.get(self, '_chunked')
+        if not chunked or key not in chunked:
+            raise KeyError(key)
+        self.load_chunks()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in (dict.get(self, '_chunked') or ())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def load_chunks(self):
+        """Load all of the chunked fields that haven't been loaded yet."""
+        chunked = dict.get(self, '_chunked')
+        if chunked:
+            values = self._chunk_store.load(self['id'].decode('hex'), chunked)
+            dict.update(self, values)
+            del self['_chunked']
+
+    def stream_field(self, name):
+        """Yield the contents of a chunked field a piece at a time, without
+        holding all of it in memory: unicode strings for a text field, and
+        the JSON encoding of the value for anything else. A field that's
+        already loaded (or isn't chunked) is yielded whole.
+        """
+        chunked = dict.get(self, '_chunked') or {}
+        if name not in chunked:
+            yield self[name]
+            return
+        for piece in self._chunk_store.stream(self['id'].decode('hex'), name, chunked[name]):
+            yield piece
+
+class ChunkStore(object):
+
+    log = ClassLogger()
+
+    # the most chunk data sent in one INSERT; escaping can double it, and
+    # this keeps the statement under MySQL's default max_allowed_packet of
+    # 4MB (each statement has at least one chunk, so chunk_size has to fit
+    # too)
+    max_insert_bytes = 1 << 20
+
+    def __init__(self, connection, threshold, chunk_size=1 << 20, use_zlib=True, router=None):
+        self.connection = connection
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.use_zlib = use_zlib
+        self.router = router
+
+        # fields that are never moved out of line, see pin()
+        self.pinned = set()
+
+    @property
+    def reader(self):
+        return self.router if self.router is not None else self.connection
+
+    def create_table(self):
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS entity_chunks (
+                entity_id BINARY(16) NOT NULL,
+                field VARCHAR(255) NOT NULL,
+                seq INTEGER NOT NULL,
+                data MEDIUMBLOB NOT NULL,
+                PRIMARY KEY (entity_id, field, seq)
+            ) ENGINE=InnoDB""")
+
+    def pin(self, fields):
+        """Keep some fields in the entities row (the ones an index or view
+        reads).
+        """
+        self.pinned.update(fields)
+
+    def entity(self, d):
+        """Wrap a decoded stub body."""
+        entity = ChunkedEntity(d)
+        object.__setattr__(entity, '_chunk_store', self)
+        return entity
+
+    def split(self, entity):
+        """Split an entity into a stub and the fields to store out of line.
+        Returns (stub, fields, kept), where fields is a dict of field name ->
+        (kind, data) to write, and kept lists the fields that are already
+        stored out of line and weren't loaded (so their chunks stay as they
+        are). Entities that fit under the threshold are returned unchanged.
+        """
+        chunked = dict(entity.get('_chunked') or {})
+        body_size = len(simplejson.dumps(entity))
+        if body_size <= self.threshold and not chunked:
+            return entity, {}, []
+
+        stub = dict(entity)
+        stub.pop('_chunked', None)
+        for k in chunked.keys():
+            if k in stub:
+                # it was loaded or overwritten, so it'll be written again
+                del chunked[k]
+        kept = list(chunked)
+
+        sizes = sorted(((len(simplejson.dumps(v)), k) for k, v in stub.iteritems() if k != 'updated' and k not in self.pinned), reverse=True)
+        fields = {}
+        for size, k in sizes:
+            if body_size <= self.threshold:
+                break
+            v = stub.pop(k)
+            if isinstance(v, basestring):
+                kind = 'text'
+                data = v.encode('utf-8') if isinstance(v, unicode) else v
+            else:
+                kind = 'json'
+                data = simplejson.dumps(v)
+            fields[k] = (kind, data)
+            chunked[k] = kind
+            body_size -= size
+        if chunked:
+            stub['_chunked'] = chunked
+        return stub, fields, kept
+
+    def write(self, entity_id, fields, kept=(), is_new=False):
+        """Store the chunks for an entity, replacing any it had, except for
+        the fields in kept.
+        """
+        if not is_new:
+            q = 'DELETE FROM entity_chunks WHERE entity_id = %s'
+            if kept:
+                q += ' AND field NOT IN (%s)' % (', '.join('%s' for x in kept),)
+            self.connection.execute(q, entity_id, *kept)
+        rows = []
+        for field, (kind, data) in fields.iteritems():
+            for seq, offset in enumerate(xrange(0, max(len(data), 1), self.chunk_size)):
+                chunk = data[offset:offset + self.chunk_size]
+                if self.use_zlib:
+                    chunk = zlib.compress(chunk, 1)
+                rows.append((entity_id, field, seq, chunk))
+        batch = []
+        batch_bytes = 0
+        for row in rows:
+            if batch and batch_bytes + len(row[3]) > self.max_insert_bytes:
+                self._insert_chunks(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(row)
+            batch_bytes += len(row[3])
+        if batch:
+            self._insert_chunks(batch)
+
+    def _insert_chunks(self, rows):
+        vals = []
+        for row in rows:
+            vals.extend(row)
+        self.connection.execute('INSERT INTO entity_chunks (entity_id, field, seq, data) VALUES ' + ', '.join('(%s, %s, %s, %s)' for x in rows), *vals)
+
+    def delete(self, entity_ids):
+        if entity_ids:
+            self.connection.execute('DELETE FROM entity_chunks WHERE entity_id IN (%s)' % (', '.join('%s' for x in entity_ids),), *entity_ids)
+
+    def _decode(self, kind, data):
+        if kind == 'text':
+            return data.decode('utf-8')
+        return simplejson.loads(data)
+
+    def load(self, entity_id, chunked):
+        """Load the fields named in chunked (a dict of field -> kind) for an
+        entity, with one query.
+        """
+        fields = list(chunked)
+        rows = self.reader.query('SELECT field, data FROM entity_chunks WHERE entity_id = %%s AND field IN (%s) ORDER BY field, seq' % (', '.join('%s' for x in fields),), entity_id, *fields)
+        pieces = {}
+        for row in rows:
+            data = row['data']
+            if self.use_zlib:
+                data = zlib.decompress(data)
+            pieces.setdefault(row['field'], []).append(data)
+        values = {}
+        for field in fields:
+            if field not in pieces:
+                self.log.warning('missing chunks for field %s of %s' % (field, entity_id.encode('hex')))
+                continue
+            values[field] = self._decode(chunked[field], ''.join(pieces[field]))
+        return values
+
+    def stream(self, entity_id, field, kind):
+        decoder = codecs.getincrementaldecoder('utf-8')() if kind == 'text' else None
+        seq = 0
+        while True:
+            row = self.reader.get('SELECT data FROM entity_chunks WHERE entity_id = %s AND field = %s AND seq = %s', entity_id, field, seq)
+            if row is None:
+                break
+            data = row['data']
+            if self.use_zlib:
+                data = zlib.decompress(data)
+            yield decoder.decode(data) if decoder else data
+            seq += 1
+        if decoder:
+            tail = decoder.decode('', final=True)
+            if tail:
+                yield tail
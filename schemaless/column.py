@@ -1,6 +1,36 @@
+import operator
 import simplejson
 import zlib
 
+# returned by extractors (see make_extractor) when there's nothing to extract
+MISSING = object()
+
+def make_extractor(spec):
+    """Make a function that pulls a value out of an entity. spec is either
+    a dotted path into the entity (e.g. 'address.city') or a function that
+    takes the entity. The extractor returns MISSING if a key on the path is
+    missing, the function raises KeyError, TypeError or AttributeError, or the
+    value is None.
+    """
+    if callable(spec):
+        def extract(entity):
+            try:
+                val = spec(entity)
+            except (KeyError, TypeError, AttributeError):
+                return MISSING
+            return MISSING if val is None else val
+    else:
+        path = spec.split('.')
+        def extract(entity):
+            val = entity
+            for key in path:
+                try:
+                    val = val[key]
+                except (KeyError, TypeError, IndexError):
+                    return MISSING
+            return MISSING if val is None else val
+    return extract
+
 class Entity(dict):
 
     @classmethod
@@ -8,13 +38,17 @@ class Entity(dict):
         return Entity(id=make_guid())
 
     @classmethod
-    def from_row(cls, row, use_zlib=False):
+    def from_row(cls, row, use_zlib=False, chunks=None):
         body = row['body']
         if use_zlib:
             body = zlib.decompress(body)
         d = simplejson.loads(body)
         d['id'] = row['id'].encode('hex')
         d['updated'] = row['updated']
+        if 'version' in row:
+            d['version'] = row['version']
+        if chunks is not None and '_chunked' in d:
+            return chunks.entity(d)
         return cls(d)
 
     def __hasattr__(self, name):
@@ -78,54 +112,147 @@ class ColumnExpression(object):
         self.op = op
         self.rhs = rhs
 
+    # SQL fragments for the operators that take a single parameter
+    _sql_ops = {
+        OP_LT: ' < %s',
+        OP_LE: ' <= %s',
+        OP_EQ: ' = %s',
+        OP_NE: ' != %s',
+        OP_GT: ' > %s',
+        OP_GE: ' >= %s'}
+
+    @property
+    def shape(self):
+        """A hashable description of the SQL this expression builds, which
+        doesn't depend on the parameter values (except for whether they're
+        NULL, and how many values there are for IN).
+        """
+        if self.op == self.OP_IN:
+            return (self.name, self.op, len(self.rhs))
+        return (self.name, self.op, self.rhs is None)
+
+    def params(self):
+        """The parameters for the SQL built by build()."""
+        if self.op == self.OP_IN:
+            return list(self.rhs)
+        elif self.rhs is None and self.op in (self.OP_EQ, self.OP_NE):
+            return []
+        return [self.rhs]
+
+    def build_sql(self):
+        """The SQL for this expression, with %s placeholders."""
+        if self.op == self.OP_IN:
+            return self.name + ' IN (' + ', '.join('%s' for x in self.rhs) + ')'
+        elif self.rhs is None and self.op == self.OP_EQ:
+            return '%s IS NULL' % self.name
+        elif self.rhs is None and self.op == self.OP_NE:
+            return '%s IS NOT NULL' % self.name
+        try:
+            return self.name + self._sql_ops[self.op]
+        except KeyError:
+            raise ValueError('Unknown operator')
+
     def build(self):
-        if self.op == self.OP_LT:
-            return self.name + ' < %s', [self.rhs]
-        elif self.op == self.OP_LE:
-            return self.name + ' <= %s', [self.rhs]
-        elif self.op == self.OP_EQ:
-            if self.rhs is None:
-                return '%s IS NULL' % self.name, []
-            else:
-                return (self.name + ' = %s'), [self.rhs]
-        elif self.op == self.OP_NE:
-            if self.rhs is None:
-                return '%s IS NOT NULL' % self.name, []
-            else:
-                return (self.name + ' != %s'), [self.rhs]
-        elif self.op == self.OP_GT:
-            return (self.name + ' > %s'), [self.rhs]
-        elif self.op == self.OP_GE:
-            return (self.name + ' >= %s'), [self.rhs]
-        elif self.op == self.OP_IN:
-            sql = self.name + ' IN (' + ', '.join('%s' for x in self.rhs) + ')'
-            return sql, self.rhs
-        else:
+        return self.build_sql(), self.params()
+
+    # Python comparison functions for the operators that take a single value
+    _compare_ops = {
+        OP_LT: operator.lt,
+        OP_LE: operator.le,
+        OP_EQ: operator.eq,
+        OP_NE: operator.ne,
+        OP_GT: operator.gt,
+        OP_GE: operator.ge}
+
+    def compile(self, extractor=None, multi=False):
+        """Return a function that takes a row (a dict) and checks this
+        expression against it. The operator dispatch happens once, here, and
+        IN checks use a set when the values are hashable. If extractor is
+        given, it's used to get the value to check from the row (see
+        make_extractor), and rows it extracts nothing from don't match. If
+        multi is true the value is a list, and the row matches if any of its
+        elements do, like the rows of a multi-valued index.
+        """
+        if extractor is not None or multi:
+            name = self.name
+            check = self.predicate
+            get = extractor or operator.itemgetter(name)
+            def check_extracted(row):
+                val = get(row)
+                if val is MISSING:
+                    return False
+                if multi:
+                    return any(check({name: v}) for v in list_elements(val))
+                return check({name: val})
+            return check_extracted
+
+        name = self.name
+        rhs = self.rhs
+        if self.op == self.OP_IN:
+            try:
+                values = frozenset(rhs)
+            except TypeError:
+                return lambda row: row[name] in rhs
+
+            def check_in(row):
+                val = row[name]
+                try:
+                    return val in values
+                except TypeError:
+                    return val in rhs
+            return check_in
+
+        try:
+            compare = self._compare_ops[self.op]
+        except KeyError:
             raise ValueError('Unknown operator')
+        return lambda row: compare(row[name], rhs)
+
+    @property
+    def predicate(self):
+        """The compiled check for this expression (see compile())."""
+        try:
+            return self._predicate
+        except AttributeError:
+            self._predicate = self.compile()
+            return self._predicate
 
     def check(self, val):
-        val = val[self.name]
-        if self.op == self.OP_LT:
-            return val < self.rhs
-        elif self.op == self.OP_LE:
-            return val <= self.rhs
-        elif self.op == self.OP_EQ:
-            return val == self.rhs
-        elif self.op == self.OP_NE:
-            return val != self.rhs
-        elif self.op == self.OP_GT:
-            return val > self.rhs
-        elif self.op == self.OP_GE:
-            return val >= self.rhs
-        elif self.op == self.OP_IN:
-            return val in self.rhs
-        else:
-            raise ValueError('Unknown operator')
+        return self.predicate(val)
 
     def __str__(self):
         return '%s(name=%r, op=%d, rhs=%r)' % (self.__class__.__name__, self.name, self.op, self.rhs)
     __repr__ = __str__
 
+def list_elements(val):
+    """The elements of a multi-valued property; a value that isn't a list
+    counts as a list of one, and None as an empty one.
+    """
+    if val is None:
+        return []
+    if isinstance(val, (list, tuple, set, frozenset)):
+        return val
+    return [val]
+
+def filter_rows(exprs, rows, extractors={}, multi=frozenset()):
+    """Return the rows that satisfy all of the expressions. extractors maps
+    the names of computed index columns to their extractors, which are used
+    instead of looking the name up in the row, and multi is the names of
+    multi-valued columns, which match if any of their elements do.
+
+    Each expression is compiled once and applied to the whole batch of
+    remaining rows, so the cost per row is a single function call per
+    expression.
+    """
+    for e in exprs:
+        if not rows:
+            break
+        if e.name in extractors or e.name in multi:
+            rows = filter(e.compile(extractors.get(e.name), e.name in multi), rows)
+        else:
+            rows = filter(e.predicate, rows)
+    return rows
+
 class ColumnBuilder(object):
 
     def __init__(self):
@@ -0,0 +1,91 @@
+import random
+
+from schemaless.log import ClassLogger
+
+class Counter(object):
+    """Counters kept in their own table, outside of entity bodies, so that
+    incrementing one is a single atomic statement instead of reading and
+    rewriting an entity.
+
+    Each counter is stored as shards rows (keyed by (counter_key, shard));
+    an increment goes to a random one of them, which spreads out the row
+    lock contention for hot counters, and reads add them back up. Keys are
+    strings, e.g. the hex id of the entity being counted.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, table, shards=1, connection=None, router=None):
+        if shards < 1:
+            raise ValueError('A counter needs at least one shard')
+        self.table = table
+        self.shards = shards
+        self.connection = connection
+        self.router = router
+        self.incr_sql = 'INSERT INTO %s (counter_key, shard, n) VALUES (%%s, %%s, %%s) ON DUPLICATE KEY UPDATE n = n + VALUES(n)' % (table,)
+        self.get_sql = 'SELECT SUM(n) AS n FROM %s WHERE counter_key = %%s' % (table,)
+
+    def __str__(self):
+        return '%s(table=%s, shards=%d)' % (self.__class__.__name__, self.table, self.shards)
+    __repr__ = __str__
+
+    def create_table(self):
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS %s (
+                counter_key VARCHAR(255) NOT NULL,
+                shard SMALLINT UNSIGNED NOT NULL,
+                n BIGINT NOT NULL,
+                PRIMARY KEY (counter_key, shard)
+            ) ENGINE=InnoDB""" % (self.table,))
+
+    @property
+    def reader(self):
+        return self.router if self.router is not None else self.connection
+
+    def _shard(self):
+        return random.randrange(self.shards) if self.shards > 1 else 0
+
+    def _note_write(self):
+        if self.router is not None:
+            self.router.note_write()
+
+    def incr(self, key, n=1):
+        """Add n (which may be negative) to a counter."""
+        self.connection.execute(self.incr_sql, key, self._shard(), n)
+        self._note_write()
+
+    def decr(self, key, n=1):
+        self.incr(key, -n)
+
+    def incr_many(self, counts):
+        """Apply a dict of counter key -> increment, with one statement."""
+        if not counts:
+            return
+        q = 'INSERT INTO %s (counter_key, shard, n) VALUES %s ON DUPLICATE KEY UPDATE n = n + VALUES(n)' % (self.table, ', '.join('(%s, %s, %s)' for x in counts))
+        vals = []
+        for key, n in counts.iteritems():
+            vals.extend([key, self._shard(), n])
+        self.connection.execute(q, *vals)
+        self._note_write()
+
+    def get(self, key):
+        row = self.reader.get(self.get_sql, key)
+        return int(row['n']) if row and row['n'] is not None else 0
+
+    def get_many(self, keys):
+        """Return a dict of counter key -> value for a list of keys, with one
+        query. Counters that were never incremented are 0.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        q = 'SELECT counter_key, SUM(n) AS n FROM %s WHERE counter_key IN (%s) GROUP BY counter_key' % (self.table, ', '.join('%s' for x in keys))
+        counts = dict.fromkeys(keys, 0)
+        for row in self.reader.query(q, *keys):
+            counts[row['counter_key']] = int(row['n'])
+        return counts
+
+    def delete(self, key):
+        """Remove a counter (resetting it to 0)."""
+        self.connection.execute('DELETE FROM %s WHERE counter_key = %%s' % (self.table,), key)
+        self._note_write()
@@ -1,38 +1,318 @@
 import time
-import simplejson
 import zlib
+import datetime
+import hashlib
+import contextlib
+import simplejson
 
 import tornado.database
 
+from schemaless.advisor import QueryRecorder
+from schemaless.bloom import IdFilter
+from schemaless.catalog import SchemaCatalog
+from schemaless.chunk import ChunkStore
 from schemaless.column import Entity
-from schemaless.index import Index
+from schemaless.counter import Counter
+from schemaless.deadline import deadline_scope, suspend_deadline
+from schemaless.index import Index, entities_in_sql
 from schemaless.guid import raw_guid
+from schemaless.instrument import InstrumentedConnection, QueryStats
 from schemaless.log import ClassLogger
+from schemaless.replica import ReadRouter
+from schemaless.singleflight import SingleFlight, SharedReads
+from schemaless.text import TextIndex
+from schemaless.view import View
+
+# the kinds of changes recorded in the changelog
+CHANGE_INSERT = 1
+CHANGE_UPDATE = 2
+CHANGE_DELETE = 3
+
+def _stored_time(t):
+    """A time as MySQL gives it back from a TIMESTAMP column written with
+    FROM_UNIXTIME: a datetime, to the second, in the session's time zone
+    (which is assumed to be the process's).
+    """
+    return datetime.datetime.fromtimestamp(int(t))
+
+class ConflictError(Exception):
+    """Raised by DataStore.update when the entity was changed by someone
+    else.
+    """
 
 class DataStore(object):
 
     log = ClassLogger()
 
-    def __init__(self, mysql_shards=[], user=None, database=None, password=None, use_zlib=True, indexes=[], create_entities=True):
+    def __init__(self, mysql_shards=[], user=None, database=None, password=None, use_zlib=True, indexes=[], create_entities=True,
+                 mysql_replicas=[], read_your_writes=None, pin_time=1.0, max_replica_lag=None, schema_cache=None, changelog=False,
+                 chunk_threshold=None, chunk_size=1 << 20, expiry=False, ttls={}, single_flight=False):
         if not mysql_shards:
             raise ValueError('Must specify at least one MySQL shard')
         if len(mysql_shards) > 1:
             raise NotImplementedError
         self.use_zlib = use_zlib
-        self.indexes = [Index('entities', ['tag'])]
-        self.connection = tornado.database.Connection(host=mysql_shards[0], user=user, password=password, database=database)
+        self.mysql_shards = mysql_shards
+        self.connection_args = {'user': user, 'password': password, 'database': database}
+        self.connection = self._connect(mysql_shards[0])
+        self.replica_connections = [self._connect(host) for host in mysql_replicas]
+        self.router = ReadRouter(self.connection, self.replica_connections, read_your_writes=read_your_writes, pin_time=pin_time, max_replica_lag=max_replica_lag)
+        self.chunks = None
+        if chunk_threshold is not None:
+            self.chunks = ChunkStore(self.connection, chunk_threshold, chunk_size=chunk_size, use_zlib=use_zlib, router=self.router)
+        self.indexes = [Index('entities', ['tag'], connection=self.connection, use_zlib=self.use_zlib, router=self.router, chunks=self.chunks)]
+        self.views = []
+        self.ttls = ttls
+        self.expiry_index = None
+        self.transaction_depth = 0
+        # on the primary, since a replica may not have a new table yet
+        self.catalog = SchemaCatalog(self.connection, database=database, cache_file=schema_cache)
+        self.stats = None
+        self.recorder = None
+        self.id_filter = None
+        self.single_flight = None
+        self.shared_reads = None
+        if single_flight:
+            # a SingleFlight can be passed in to share reads with other
+            # datastores, such as the ones in other threads
+            self.single_flight = single_flight if isinstance(single_flight, SingleFlight) else SingleFlight()
+            self.shared_reads = SharedReads(self.single_flight, self.router, (mysql_shards[0], database), self._in_transaction)
+            for idx in self.indexes:
+                idx.shared_reads = self.shared_reads
         if create_entities and not self.check_table_exists('entities'):
             self.create_entities_table()
+        self.changelog = changelog
+        if changelog and not self.check_table_exists('changelog'):
+            self.create_changelog_tables()
+        if self.chunks is not None and not self.check_table_exists('entity_chunks'):
+            self.router.note_write()
+            self.chunks.create_table()
+            self.catalog.add_table('entity_chunks', ['entity_id', 'field', 'seq', 'data'])
+        if expiry or ttls:
+            if not self.check_table_exists('entity_expiry'):
+                self.create_expiry_table()
+            self.expiry_index = Index('entity_expiry', ['expires_at'], connection=self.connection, use_zlib=self.use_zlib, router=self.router, chunks=self.chunks)
+            for idx in self.indexes:
+                idx.skip_expired = True
+            self._add_index(self.expiry_index)
+
+    def _connect(self, host):
+        return InstrumentedConnection(tornado.database.Connection(host=host, **self.connection_args))
 
     @property
     def tag_index(self):
         return self.indexes[0]
 
-    def define_index(self, table, properties=[], match_on={}, shard_on=None):
-        idx = Index(table=table, properties=properties, match_on=match_on, shard_on=shard_on, connection=self.connection, use_zlib=self.use_zlib)
+    @property
+    def hashed(self):
+        """Whether the entities table has a body_hash column."""
+        return self.catalog.has_column('entities', 'body_hash')
+
+    @property
+    def versioned(self):
+        """Whether the entities table has a version column (tables created
+        before it was added don't).
+        """
+        return self.catalog.has_column('entities', 'version')
+
+    def add_query_hook(self, before=None, after=None):
+        """Register callbacks to run before and/or after every statement sent
+        to MySQL. Each callback is called with a QueryEvent (see
+        schemaless.instrument); for the after callbacks the event has the
+        number of rows and the elapsed time filled in.
+        """
+        for conn in [self.connection] + self.replica_connections:
+            conn.add_hook(before=before, after=after)
+
+    def remove_query_hook(self, before=None, after=None):
+        for conn in [self.connection] + self.replica_connections:
+            conn.remove_hook(before=before, after=after)
+
+    def use_primary(self):
+        """Context manager that sends all reads to the primary, e.g.
+
+            with datastore.use_primary():
+                entity = datastore.by_id(entity_id)
+        """
+        return self.router.use_primary()
+
+    def enable_stats(self, slow_query_time=None):
+        """Start collecting per-table/per-operation query counters and
+        latency histograms. Queries taking at least slow_query_time seconds
+        are logged. Returns the QueryStats object, which is also available as
+        self.stats.
+        """
+        if self.stats is None:
+            self.stats = QueryStats(slow_query_time=slow_query_time)
+            self.add_query_hook(after=self.stats)
+        else:
+            self.stats.slow_query_time = slow_query_time
+        return self.stats
+
+    def enable_recorder(self, max_shapes=1000):
+        """Start recording the shapes of the queries run through indexes
+        and the ORM, for schemaless.advisor. Returns the QueryRecorder, which
+        is also kept as self.recorder.
+        """
+        if self.recorder is None:
+            self.recorder = QueryRecorder(max_shapes=max_shapes)
+            for idx in self.indexes:
+                idx.recorder = self.recorder
+        return self.recorder
+
+    def enable_id_filter(self, path=None, capacity=None, error_rate=0.01, refresh_interval=1.0, gap_timeout=300, max_staleness=5.0):
+        """Keep a Bloom filter of the ids in the entities table, so that
+        by_id returns None for most ids that don't exist without a query.
+        The filter is loaded from path if it exists, and built (and saved
+        there) otherwise, and refreshed every refresh_interval seconds by a
+        background thread with its own connection. Ids that aren't in it
+        are taken not to exist if it was refreshed in the last max_staleness
+        seconds. See schemaless.bloom.
+        """
+        if self.id_filter is not None:
+            self.id_filter.stop()
+        connection = self._connect(self.mysql_shards[0]) if refresh_interval is not None else None
+        self.id_filter = IdFilter(self, path=path, capacity=capacity, error_rate=error_rate, refresh_interval=refresh_interval,
+                                  gap_timeout=gap_timeout, max_staleness=max_staleness, connection=connection)
+        return self.id_filter
+
+    def _add_index(self, idx):
+        idx.recorder = self.recorder
+        idx.shared_reads = self.shared_reads
+        # the purger queries entity_expiry for the expired entities
+        idx.skip_expired = self.expiry_index is not None and idx is not self.expiry_index
+        if self.chunks is not None:
+            self.chunks.pin(idx.source_fields)
         self.indexes.append(idx)
         return idx
 
+    def define_index(self, table, properties=[], match_on={}, shard_on=None, extract={}, multi=()):
+        """Define an index on some properties of the entities that match
+        match_on. extract maps the names of computed columns to a dotted path
+        into the entity or a function of the entity, e.g.
+
+            datastore.define_index('index_email', extract={'email': lambda e: e['email'].lower()})
+            datastore.define_index('index_city', extract={'city': 'address.city'})
+
+        Entities that a computed column can't be extracted from aren't
+        indexed.
+
+        The columns named in multi hold lists, and the index gets a row for
+        each element, so that e.g. an index on tags with multi=['tags'] finds
+        the entities with a given tag. Its table mustn't have a unique key on
+        entity_id.
+        """
+        idx = Index(table=table, properties=properties, match_on=match_on, shard_on=shard_on, connection=self.connection, use_zlib=self.use_zlib, router=self.router, chunks=self.chunks, extract=extract, multi=multi)
+        return self._add_index(idx)
+
+    def define_text_index(self, table, fields, match_on={}):
+        """Define a full text index on some string fields (its table is
+        created if it doesn't exist), e.g.
+
+            post_text = datastore.define_text_index('text_post', ['title', 'content'], match_on={'tag': POST_TAG})
+            post_text.search('some words')
+
+        See schemaless.text.TextIndex.
+        """
+        idx = TextIndex(table, fields, match_on=match_on, connection=self.connection, use_zlib=self.use_zlib, router=self.router, chunks=self.chunks)
+        if not self.check_table_exists(table):
+            self.router.note_write()
+            idx.create_table()
+            self.catalog.add_table(table, ['token', 'entity_id'])
+        return self._add_index(idx)
+
+    def define_view(self, table, group_by, aggregate='count', field=None, match_on={}, where=None):
+        """Define an aggregate over entities that's updated by every put,
+        put_many and delete, e.g. the number of comments on each post:
+
+            comment_count = datastore.define_view('view_comment_count', ['post_id'], match_on={'tag': COMMENT_TAG})
+            comment_count.get(post_id)
+
+        See schemaless.view.View for the aggregates and the table layout.
+        """
+        view = View(table, group_by, aggregate=aggregate, field=field, match_on=match_on, where=where, connection=self.connection, router=self.router,
+                use_zlib=self.use_zlib, chunks=self.chunks, transaction=self.transaction)
+        if self.chunks is not None:
+            self.chunks.pin(view.source_fields)
+        self.views.append(view)
+        return view
+
+    def define_counter(self, table, shards=1):
+        """Define a set of counters kept in their own table (which is
+        created if it doesn't exist), e.g.
+
+            likes = datastore.define_counter('counter_likes', shards=8)
+            likes.incr(post.id)
+            likes.get_many([post.id for post in posts])
+
+        See schemaless.counter.Counter.
+        """
+        counter = Counter(table, shards=shards, connection=self.connection, router=self.router)
+        if not self.check_table_exists(table):
+            self.router.note_write()
+            counter.create_table()
+            self.catalog.add_table(table, ['counter_key', 'shard', 'n'])
+        return counter
+
+    def _locked_rows(self, entity_ids):
+        """Read (and lock, in the current transaction) the stored rows of
+        some entities. Returns a dict keyed by raw id.
+        """
+        if not entity_ids:
+            return {}
+        rows = self.connection.query(entities_in_sql(len(entity_ids)) + ' FOR UPDATE', *entity_ids)
+        return dict((row['id'], row) for row in rows)
+
+    def _stored_entity(self, row):
+        entity = Entity.from_row(row, use_zlib=self.use_zlib, chunks=self.chunks)
+        entity.setdefault('tag', row['tag'])
+        return entity
+
+    def _locked_entities(self, entity_ids):
+        return dict((entity_id, self._stored_entity(row)) for entity_id, row in self._locked_rows(entity_ids).iteritems())
+
+    def _content_hash(self, entity):
+        """A hash of the contents of an entity (apart from the updated
+        time), stored in the body_hash column.
+        """
+        contents = dict((k, v) for k, v in entity.iteritems() if k != 'updated')
+        return hashlib.md5(simplejson.dumps(contents, sort_keys=True)).digest()
+
+    def _same_contents(self, old, new):
+        ignore = ('id', 'updated', 'version') if self.versioned else ('id', 'updated')
+        old = dict((k, v) for k, v in old.iteritems() if k not in ignore)
+        new = dict((k, v) for k, v in new.iteritems() if k != 'updated')
+        return old == new
+
+    def _changed_entity(self, row, entity):
+        """Compare the stored row of an entity with new contents for it.
+        Returns the stored entity, or None if the contents haven't changed
+        (apart from the updated time). When the row has a body_hash, an
+        unchanged entity is detected without decoding the stored body.
+        """
+        if row.get('body_hash') is not None:
+            if row['body_hash'] == self._content_hash(entity):
+                return None
+            return self._stored_entity(row)
+        old = Entity.from_row(row, use_zlib=self.use_zlib, chunks=self.chunks)
+        if self._same_contents(old, entity):
+            return None
+        old.setdefault('tag', row['tag'])
+        return old
+
+    def _apply_views(self, entity_id, old, new, tag=None):
+        if tag is None and old is not None:
+            tag = old.get('tag')
+        if tag is not None:
+            # the tag is stored in its own column, so views can match on it
+            # even when it isn't in the body
+            if old is not None and 'tag' not in old:
+                old = dict(old, tag=tag)
+            if new is not None and 'tag' not in new:
+                new = dict(new, tag=tag)
+        for view in self.views:
+            view.apply(entity_id, old, new)
+
     def _find_indexes(self, entity, include_entities=False):
         """Find all of the indexes that may index an entity, based on the keys
         in the entity.
@@ -45,8 +325,40 @@ class DataStore(object):
                 elif include_entities:
                     yield idx
     
-    def put(self, entity, tag=None):
+    def _set_expiry(self, entity, tag, ttl):
+        """Set the expires_at time of an entity that's about to be written,
+        from the ttl passed to put, or the TTL for its tag if it's new.
+        """
+        if 'id' not in entity and 'expires_at' in entity and entity['expires_at'] is None:
+            del entity['expires_at']
+        if ttl is None and 'id' not in entity and 'expires_at' not in entity:
+            ttl = self.ttls.get(tag)
+        if ttl is not None:
+            if self.expiry_index is None:
+                raise ValueError('TTLs need a DataStore created with expiry=True')
+            entity['expires_at'] = time.time() + ttl
+
+    def _carry_expiry(self, row, entity):
+        """Keep the expiry time of an entity that's written back without
+        one (the ORM only writes its own columns, for instance). Setting
+        expires_at to None removes it.
+        """
+        if self.expiry_index is None:
+            return
+        if 'expires_at' not in entity:
+            expires_at = self._stored_entity(row).get('expires_at')
+            if expires_at is not None:
+                entity['expires_at'] = expires_at
+        elif entity['expires_at'] is None:
+            del entity['expires_at']
+
+    def put(self, entity, tag=None, ttl=None):
+        """Insert or update an entity. If ttl is given (or the entity is new
+        and its tag has a TTL), the entity expires that many seconds from
+        now: reads stop returning it, and ExpiryPurger deletes it later.
+        """
         is_update = False
+        self._set_expiry(entity, tag, ttl)
         entity['updated'] = time.time()
         entity_id = None
 
@@ -60,58 +372,418 @@ class DataStore(object):
             is_update = True
             if len(entity_id) != 16:
                 entity_id = entity_id.decode('hex')
-        body = simplejson.dumps(entity_copy)
+        if self.versioned:
+            entity_copy.pop('version', None)
+
+        try:
+            with self._write_transaction():
+                if is_update:
+                    old = self._put_update(entity_id, entity_copy)
+                    if old is not None:
+                        self._apply_views(entity_id, old, entity_copy)
+                        self._log_changes(CHANGE_UPDATE, [(entity_id, old['tag'])])
+                    entity['updated'] = _stored_time(entity['updated'])
+                    return entity
+                else:
+                    entity = self._put_new(entity_id, entity_copy, tag)
+                    self._apply_views(entity_id, None, entity_copy, tag)
+                    self._log_changes(CHANGE_INSERT, [(entity_id, tag)])
+                    return entity
+        finally:
+            self.router.note_write()
+
+    def _encode_body(self, entity):
+        body = simplejson.dumps(entity)
         if self.use_zlib:
             body = zlib.compress(body, 1)
+        return body
+
+    def _encode_entity(self, entity):
+        """Encode the body of an entity, moving its big fields out of line
+        if chunking is enabled. Returns (body, chunks), where chunks is
+        passed to _write_chunks once the entities row has been written.
+        """
+        if self.chunks is None:
+            return self._encode_body(entity), None
+        stub, fields, kept = self.chunks.split(entity)
+        return self._encode_body(stub), (fields, kept)
+
+    def _write_chunks(self, entity_id, chunks, is_new=False, old=None):
+        """Write the chunks from _encode_entity. For an update, old is the
+        stored entity, if known: when neither it nor the new contents have
+        chunks, there's nothing to replace.
+        """
+        if chunks is None:
+            return
+        fields, kept = chunks
+        if not fields and (is_new or (old is not None and '_chunked' not in old)):
+            return
+        self.chunks.write(entity_id, fields, kept, is_new=is_new)
+
+    def _make_entity(self, d):
+        if self.chunks is not None and '_chunked' in d:
+            return self.chunks.entity(d)
+        return Entity(d)
 
-        if is_update:
-            self._put_update(entity_id, entity_copy, body)
-            return entity
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the statements in the with block in a single transaction,
+        which is rolled back if the block raises. Nested transactions are
+        folded into the outermost one.
+        """
+        if self.transaction_depth:
+            self.transaction_depth += 1
+            try:
+                yield
+            finally:
+                self.transaction_depth -= 1
         else:
-            return self._put_new(entity_id, entity_copy, tag, body)
+            self.connection.execute('BEGIN')
+            self.transaction_depth = 1
+            try:
+                yield
+            except:
+                self.transaction_depth = 0
+                with suspend_deadline(check=False):
+                    self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self.transaction_depth = 0
+                with suspend_deadline(check=False):
+                    self.connection.execute('COMMIT')
+
+    def _in_transaction(self):
+        return self.transaction_depth > 0
+
+    def _write_transaction(self):
+        """The transaction for a write that also has to update the
+        changelog, views or chunks. Without one, the deadline is checked
+        once here instead of before each statement, so that a write isn't
+        cut off between the entities row and its index rows.
+        """
+        if self.changelog or self.views or self.chunks is not None:
+            return self.transaction()
+        return suspend_deadline()
+
+    def _log_changes(self, op, changes):
+        """Record changes, a list of (raw entity_id, tag) pairs, in the
+        changelog.
+        """
+        if not self.changelog or not changes:
+            return
+        q = 'INSERT INTO changelog (entity_id, tag, op) VALUES ' + ', '.join('(%s, %s, %s)' for x in changes)
+        vals = []
+        for entity_id, tag in changes:
+            vals.extend([entity_id, tag, op])
+        self.connection.execute(q, *vals)
+
+    def put_many(self, entities, tag=None, batch_size=500, ttl=None):
+        """Like put, for many entities at once. New entities and updates are
+        written with multi-row statements (at most batch_size rows each), all
+        in one transaction. Returns the entities, which (like with put) have
+        their id and updated fields set.
+        """
+        now = time.time()
+        versioned = self.versioned
+        new_entities = []
+        updated_entities = []
+        for entity in entities:
+            self._set_expiry(entity, tag, ttl)
+            entity['updated'] = now
+            entity_copy = entity.copy()
+            if versioned:
+                entity_copy.pop('version', None)
+            entity_id = entity_copy.pop('id', None)
+            if entity_id is None:
+                entity_id = raw_guid()
+                entity['id'] = entity_id.encode('hex')
+                new_entities.append((entity_id, entity_copy))
+            else:
+                if len(entity_id) != 16:
+                    entity_id = entity_id.decode('hex')
+                updated_entities.append((entity_id, entity_copy))
+
+        try:
+            with self.transaction():
+                for i in xrange(0, len(new_entities), batch_size):
+                    batch = new_entities[i:i + batch_size]
+                    self._put_new_many(batch, tag)
+                    for entity_id, entity in batch:
+                        self._apply_views(entity_id, None, entity, tag)
+                    self._log_changes(CHANGE_INSERT, [(entity_id, tag) for entity_id, entity in batch])
+                for i in xrange(0, len(updated_entities), batch_size):
+                    batch = updated_entities[i:i + batch_size]
+                    stored = self._locked_rows([entity_id for entity_id, entity in batch])
+                    changed = []
+                    for entity_id, entity in batch:
+                        row = stored.get(entity_id)
+                        if row is None:
+                            self.log.warning('not updating %s, which does not exist' % (entity_id.encode('hex'),))
+                            continue
+                        self._carry_expiry(row, entity)
+                        old = self._changed_entity(row, entity)
+                        if old is not None:
+                            changed.append((entity_id, entity, old))
+                    if not changed:
+                        continue
+                    self._put_update_many(changed)
+                    for entity_id, entity, old in changed:
+                        self._apply_views(entity_id, old, entity)
+                    self._log_changes(CHANGE_UPDATE, [(entity_id, old['tag']) for entity_id, entity, old in changed])
+        finally:
+            self.router.note_write()
+        # the same type that put (and a read) gives back
+        updated = _stored_time(now)
+        for entity in entities:
+            entity['updated'] = updated
+        return [Entity(entity) for entity in entities]
+
+    def _insert_index_many(self, index, rows):
+        if not rows:
+            return
+        q = index.insert_many_sql(len(rows))
+        vals = []
+        for row in rows:
+            vals.extend(row)
+        self.connection.execute(q, *vals)
+
+    def _index_rows(self, entities):
+        """Group the index rows for a list of (entity_id, entity) pairs by
+        index.
+        """
+        index_rows = {}
+        for entity_id, entity in entities:
+            for idx in self._find_indexes(entity):
+                index_rows.setdefault(idx, []).extend(self._entity_index_rows(idx, entity_id, entity))
+        return index_rows
+
+    def _entity_index_rows(self, index, entity_id, entity):
+        """The rows to insert into an index for an entity."""
+        if index.multi:
+            return [[entity_id] + list(row) for row in sorted(index.rows_for(entity))]
+        return [[entity_id] + index.values(entity)]
+
+    def _put_new_many(self, entities, tag):
+        if self.hashed:
+            q = 'INSERT INTO entities (id, updated, tag, body, body_hash) VALUES ' + ', '.join('(%s, FROM_UNIXTIME(%s), %s, %s, %s)' for x in entities)
+        else:
+            q = 'INSERT INTO entities (id, updated, tag, body) VALUES ' + ', '.join('(%s, FROM_UNIXTIME(%s), %s, %s)' for x in entities)
+        vals = []
+        chunks = []
+        for entity_id, entity in entities:
+            body, entity_chunks = self._encode_entity(entity)
+            chunks.append((entity_id, entity_chunks))
+            vals.extend([entity_id, int(entity['updated']), tag, body])
+            if self.hashed:
+                vals.append(self._content_hash(entity))
+        self.connection.execute(q, *vals)
+        if self.id_filter is not None:
+            for entity_id, entity in entities:
+                self.id_filter.add(entity_id)
+        for entity_id, entity_chunks in chunks:
+            self._write_chunks(entity_id, entity_chunks, is_new=True)
+        for idx, rows in self._index_rows(entities).iteritems():
+            self._insert_index_many(idx, rows)
+
+    def _put_update_many(self, entities):
+        """Write updates for a list of (entity_id, entity, stored entity)
+        triples.
+        """
+        hashed = self.hashed
+        when = ' '.join('WHEN %s THEN %s' for x in entities)
+        q = 'UPDATE entities SET updated = CURRENT_TIMESTAMP, '
+        if self.versioned:
+            q += 'version = version + 1, '
+        q += 'body = CASE id ' + when + ' END'
+        if hashed:
+            q += ', body_hash = CASE id ' + when + ' END'
+        q += ' WHERE id IN (%s)' % (', '.join('%s' for x in entities),)
+        vals = []
+        chunks = []
+        for entity_id, entity, old in entities:
+            body, entity_chunks = self._encode_entity(entity)
+            chunks.append((entity_id, entity_chunks, old))
+            vals.extend([entity_id, body])
+        if hashed:
+            for entity_id, entity, old in entities:
+                vals.extend([entity_id, self._content_hash(entity)])
+        vals.extend(entity_id for entity_id, entity, old in entities)
+        self.connection.execute(q, *vals)
+        for entity_id, entity_chunks, old in chunks:
+            self._write_chunks(entity_id, entity_chunks, old=old)
+
+        # replace the index rows that changed
+        deleted = {}
+        inserted = {}
+        for entity_id, entity, old in entities:
+            removed, added, changed = self._changed_indexes(old, entity)
+            for idx in removed + changed:
+                deleted.setdefault(idx, []).append(entity_id)
+            for idx in added + changed:
+                inserted.setdefault(idx, []).extend(self._entity_index_rows(idx, entity_id, entity))
+        for idx, entity_ids in deleted.iteritems():
+            q = 'DELETE FROM %s WHERE entity_id IN (%s)' % (idx.table, ', '.join('%s' for x in entity_ids))
+            self.connection.execute(q, *entity_ids)
+        for idx, rows in inserted.iteritems():
+            self._insert_index_many(idx, rows)
 
     def _insert_index(self, index, entity_id, entity):
-        pnames = ['entity_id']
-        vals = [entity_id]
-        for p in index.properties:
-            pnames.append(p)
-            vals.append(entity[p])
-
-        q = 'INSERT INTO %s (%s) VALUES (' % (index.table, ', '.join(pnames))
-        q += ', '.join('%s' for x in pnames)
-        q += ')'
+        if index.multi:
+            self._insert_index_many(index, self._entity_index_rows(index, entity_id, entity))
+            return
+        vals = [entity_id] + index.values(entity)
         try:
-            self.connection.execute(q, *vals)
+            self.connection.execute(index.insert_sql, *vals)
         except tornado.database.OperationalError:
-            self.log.exception('query = %s, vals = %s' % (q, vals))
+            self.log.exception('query = %s, vals = %s' % (index.insert_sql, vals))
             raise
 
-    def _update_index(self, index, entity_id, entity):
-        row = self.connection.get('SELECT * FROM %s WHERE entity_id = %%s' % (index.table,), entity_id)
-        if row:
-            vals = []
-            q = 'UPDATE %s SET ' % index.table
-            qs = []
-            for p in index.properties:
-                qs.append('%s = %%s' % p)
-                vals.append(entity[p])
-            q += ', '.join(qs)
-            q += ' WHERE entity_id = %s'
-            vals.append(entity_id)
-            self.connection.execute(q, *vals)
+    def _put_new(self, entity_id, entity, tag):
+        body, chunks = self._encode_entity(entity)
+        if self.hashed:
+            self.connection.execute('INSERT INTO entities (id, updated, tag, body, body_hash) VALUES (%s, FROM_UNIXTIME(%s), %s, %s, %s)', entity_id, int(entity['updated']), tag, body, self._content_hash(entity))
         else:
-            self._insert_index(index, entity_id, entity)
-
-    def _put_new(self, entity_id, entity, tag, body):
-        pk = self.connection.execute('INSERT INTO entities (id, updated, tag, body) VALUES (%s, FROM_UNIXTIME(%s), %s, %s)', entity_id, int(entity['updated']), tag, body)
+            self.connection.execute('INSERT INTO entities (id, updated, tag, body) VALUES (%s, FROM_UNIXTIME(%s), %s, %s)', entity_id, int(entity['updated']), tag, body)
+        if self.id_filter is not None:
+            self.id_filter.add(entity_id)
+        self._write_chunks(entity_id, chunks, is_new=True)
         for idx in self._find_indexes(entity):
             self._insert_index(idx, entity_id, entity)
-        return self.by_id(entity_id)
+        return self._by_id(entity_id, self.connection)
 
-    def _put_update(self, entity_id, entity, body):
-        self.connection.execute('UPDATE entities SET updated = CURRENT_TIMESTAMP, body = %s WHERE id = %s', body, entity_id)
-        for idx in self._find_indexes(entity):
-            self._update_index(idx, entity_id, entity)
+    def _update_sql(self, conditions):
+        q = 'UPDATE entities SET updated = CURRENT_TIMESTAMP, body = %s'
+        if self.hashed:
+            q += ', body_hash = %s'
+        if self.versioned:
+            q += ', version = version + 1'
+        return q + ' WHERE ' + conditions
+
+    def _update_vals(self, entity):
+        """The values for the SET clause of _update_sql, and the chunks to
+        write if the update goes through.
+        """
+        body, chunks = self._encode_entity(entity)
+        vals = [body]
+        if self.hashed:
+            vals.append(self._content_hash(entity))
+        return vals, chunks
+
+    def _put_update(self, entity_id, entity):
+        """Write an update to an existing entity. Nothing is written if its
+        contents haven't changed, and only the indexes whose values changed
+        are touched. Returns the stored entity from before the update, or
+        None if nothing was written.
+        """
+        row = self.connection.get('SELECT * FROM entities WHERE id = %s FOR UPDATE', entity_id)
+        if row is None:
+            self.log.warning('not updating %s, which does not exist' % (entity_id.encode('hex'),))
+            return None
+        self._carry_expiry(row, entity)
+        old = self._changed_entity(row, entity)
+        if old is None:
+            return None
+        vals, chunks = self._update_vals(entity)
+        self.connection.execute(self._update_sql('id = %s'), *(vals + [entity_id]))
+        self._write_chunks(entity_id, chunks, old=old)
+        self._reindex(entity_id, old, entity)
+        return old
+
+    def _changed_indexes(self, old, new):
+        """Compare the index rows for two versions of an entity. Returns
+        lists of the indexes that only have a row for old, only have a row
+        for new, and have different rows for each.
+        """
+        old_indexes = set(self._find_indexes(old))
+        new_indexes = set(self._find_indexes(new))
+        changed = []
+        for idx in old_indexes & new_indexes:
+            if idx.multi:
+                if idx.rows_for(old) != idx.rows_for(new):
+                    changed.append(idx)
+            elif idx.values(old) != idx.values(new):
+                changed.append(idx)
+        return list(old_indexes - new_indexes), list(new_indexes - old_indexes), changed
+
+    def _reindex(self, entity_id, old, new):
+        """Bring the index rows of an entity from old to new, only touching
+        the indexes whose values actually changed.
+        """
+        removed, added, changed = self._changed_indexes(old, new)
+        for idx in removed:
+            self.connection.execute('DELETE FROM %s WHERE entity_id = %%s' % (idx.table,), entity_id)
+        for idx in added:
+            self._insert_index(idx, entity_id, new)
+        for idx in changed:
+            if idx.multi:
+                # only write the elements that were added or removed
+                old_rows = idx.rows_for(old)
+                new_rows = idx.rows_for(new)
+                for row in sorted(old_rows - new_rows):
+                    self.connection.execute(idx.delete_row_sql, entity_id, *row)
+                self._insert_index_many(idx, [[entity_id] + list(row) for row in sorted(new_rows - old_rows)])
+                continue
+            vals = idx.values(new)
+            vals.append(entity_id)
+            if not self.connection.execute_rowcount(idx.update_sql, *vals):
+                # the entity had no row in the index (say, from an earlier
+                # write that failed part way), so add it
+                self._insert_index(idx, entity_id, new)
+
+    def update(self, id, changes, remove=(), expected_version=None, retries=3):
+        """Change some of the properties of an entity: the ones in the
+        changes dict are set, and the ones in remove are deleted. Only the
+        index tables whose values change are written.
+
+        The write is a compare-and-set on the entity's version. If
+        expected_version is given and the stored version is different,
+        ConflictError is raised; otherwise a concurrent write makes the
+        update start over from the new version, up to retries times.
+
+        Returns the updated entity (with its new version), or None if
+        there's no such entity. This needs the entities table to have a
+        version column.
+        """
+        if not self.versioned:
+            raise NotImplementedError('The entities table has no version column')
+        entity_id = id.decode('hex') if len(id) == 32 else id
+        for attempt in xrange(retries + 1):
+            row = self.connection.get('SELECT * FROM entities WHERE id = %s', entity_id)
+            if row is None:
+                return None
+            old = Entity.from_row(row, use_zlib=self.use_zlib, chunks=self.chunks)
+            if expected_version is not None and old['version'] != expected_version:
+                raise ConflictError('Expected version %d of %s, found version %d' % (expected_version, old['id'], old['version']))
+
+            new = dict(old)
+            del new['id']
+            version = new.pop('version')
+            new.update(changes)
+            for k in remove:
+                new.pop(k, None)
+            new['updated'] = time.time()
+            if self._same_contents(old, new):
+                return old
+            try:
+                with self._write_transaction():
+                    vals, chunks = self._update_vals(new)
+                    updated = self.connection.execute_rowcount(self._update_sql('id = %s AND version = %s'), *(vals + [entity_id, version]))
+                    if updated:
+                        self._write_chunks(entity_id, chunks, old=old)
+                        self._reindex(entity_id, old, new)
+                        self._apply_views(entity_id, old, new, row['tag'])
+                        self._log_changes(CHANGE_UPDATE, [(entity_id, row['tag'])])
+            finally:
+                self.router.note_write()
+            if updated:
+                new['id'] = old['id']
+                new['version'] = version + 1
+                new['updated'] = _stored_time(new['updated'])
+                return self._make_entity(new)
+            if expected_version is not None:
+                raise ConflictError('Version %d of %s was replaced concurrently' % (version, old['id']))
+            self.log.debug('retrying update of %s after a concurrent write (attempt %d)' % (old['id'], attempt + 1))
+        raise ConflictError('Gave up updating %s after %d conflicts' % (old['id'], retries + 1))
 
     def delete(self, entity=None, id=None):
         if entity is None and id is None:
@@ -119,44 +791,185 @@ class DataStore(object):
         if entity and 'id' not in entity:
             raise ValueError('Cannot provide an entity without an id')
         if not entity:
-            entity = self.by_id(id)
+            entity = self._by_id(id, self.connection)
             if not entity:
                 return 0
         entity_id = entity['id'].decode('hex')
+        self.router.note_write()
 
         def _delete(table_name):
             col = 'id' if table_name == 'entities' else 'entity_id'
-            return int(bool(self.connection.execute('DELETE FROM %s WHERE %s = %%s' % (table_name, col), entity_id)))
+            return int(bool(self.connection.execute_rowcount('DELETE FROM %s WHERE %s = %%s' % (table_name, col), entity_id)))
+
+        with self._write_transaction():
+            if self.views:
+                # the caller's copy of the entity may be out of date
+                entity = self._locked_entities([entity_id]).get(entity_id, entity)
+            deleted = 0
+            for idx in self._find_indexes(entity):
+                deleted += _delete(idx.table)
+            entity_deleted = _delete('entities')
+            if self.chunks is not None:
+                self.chunks.delete([entity_id])
+            if entity_deleted:
+                self._log_changes(CHANGE_DELETE, [(entity_id, entity.get('tag'))])
+                self._apply_views(entity_id, entity, None)
+        return deleted + entity_deleted
 
+    def by_id(self, id, deadline=None):
+        if len(id) == 32:
+            id = id.decode('hex')
+        if self.id_filter is not None and not self.id_filter.might_exist(id):
+            return None
+        with deadline_scope(deadline):
+            if self.shared_reads is None:
+                entity = self._by_id(id, self.router)
+            else:
+                entity = self.shared_reads.do(('by_id', id), lambda reader: self._by_id(id, reader))
+        if entity is not None and entity.get('expires_at') is not None and entity['expires_at'] <= time.time():
+            return None
+        return entity
+
+    def delete_expired(self, entity_ids, now=None):
+        """Delete those of the given (raw) entity ids that have expired as of
+        now, in one transaction, along with any entity_expiry rows that
+        point at entities that no longer exist. Returns the number of
+        entities deleted. Used by ExpiryPurger.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            with self.transaction():
+                entities = self._locked_entities(entity_ids)
+                expired = dict((entity_id, entity) for entity_id, entity in entities.iteritems() if entity.get('expires_at') is not None and entity['expires_at'] <= now)
+                self._delete_entities(expired)
+                orphans = [entity_id for entity_id in entity_ids if entity_id not in entities]
+                if orphans:
+                    self.connection.execute('DELETE FROM entity_expiry WHERE entity_id IN (%s)' % (', '.join('%s' for x in orphans),), *orphans)
+        finally:
+            self.router.note_write()
+        return len(expired)
+
+    def delete_many(self, ids, tombstone=False, batch_size=500):
+        """Delete many entities, given by id. The entities are read with one
+        query per batch_size ids (to find their index rows), and deleted with
+        one multi-row DELETE per table, all in one transaction. Returns the
+        number of entities deleted.
+
+        With tombstone=True only the entities rows are deleted, which hides
+        the entities from by_id and index queries right away. The index rows
+        (and chunks) to delete are recorded in the tombstones table, and
+        TombstonePurger deletes them later, in throttled batches.
+        """
+        entity_ids = [id.decode('hex') if len(id) == 32 else id for id in ids]
+        if tombstone and not self.check_table_exists('tombstones'):
+            self.create_tombstones_table()
         deleted = 0
-        seen_entities = False
-        for idx in self._find_indexes(entity):
-            if idx.table == 'entities':
-                seen_entities = True
-            deleted += _delete(idx.table)
-        if not seen_entities:
-            deleted += _delete('entities')
+        try:
+            with self.transaction():
+                for i in xrange(0, len(entity_ids), batch_size):
+                    entities = self._locked_entities(entity_ids[i:i + batch_size])
+                    self._delete_entities(entities, tombstone=tombstone)
+                    deleted += len(entities)
+        finally:
+            self.router.note_write()
         return deleted
 
-    def by_id(self, id):
+    def _delete_entities(self, entities, tombstone=False):
+        """Delete entities (a dict of raw id -> stored entity, see
+        _locked_entities) along with their index rows and chunks, with one
+        multi-row DELETE per table (or, with tombstone, record the index rows
+        and chunks for TombstonePurger). This has to run in a transaction.
+        """
+        if not entities:
+            return
+        table_ids = {}
+        for entity_id, entity in entities.iteritems():
+            for idx in self._find_indexes(entity):
+                table_ids.setdefault(idx.table, []).append(entity_id)
+            if self.chunks is not None and dict.get(entity, '_chunked'):
+                table_ids.setdefault('entity_chunks', []).append(entity_id)
+        if tombstone:
+            tombstones = [(table, entity_id) for table, entity_ids in table_ids.iteritems() for entity_id in entity_ids]
+            if tombstones:
+                vals = []
+                for tombstone_row in tombstones:
+                    vals.extend(tombstone_row)
+                self.connection.execute('INSERT IGNORE INTO tombstones (index_table, entity_id) VALUES ' + ', '.join('(%s, %s)' for x in tombstones), *vals)
+        else:
+            for table, entity_ids in table_ids.iteritems():
+                self.connection.execute('DELETE FROM %s WHERE entity_id IN (%s)' % (table, ', '.join('%s' for x in entity_ids)), *entity_ids)
+        entity_ids = entities.keys()
+        self.connection.execute('DELETE FROM entities WHERE id IN (%s)' % (', '.join('%s' for x in entity_ids),), *entity_ids)
+        self._log_changes(CHANGE_DELETE, [(entity_id, entity.get('tag')) for entity_id, entity in entities.iteritems()])
+        for entity_id, entity in entities.iteritems():
+            self._apply_views(entity_id, entity, None)
+
+    def _by_id(self, id, connection):
         if len(id) == 32:
             id = id.decode('hex')
-        row = self.connection.get('SELECT * FROM entities WHERE id = %s', id)
-        return Entity.from_row(row, use_zlib=self.use_zlib) if row else None
+        row = connection.get('SELECT * FROM entities WHERE id = %s', id)
+        return Entity.from_row(row, use_zlib=self.use_zlib, chunks=self.chunks) if row else None
 
     def check_table_exists(self, table_name):
-        row = self.connection.get('SELECT COUNT(*) AS tbl_count FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s', table_name)
-        return bool(row['tbl_count'])
+        return self.catalog.has_table(table_name)
 
     def create_entities_table(self):
+        self.router.note_write()
         self.connection.execute("""
-            CREATE TABLE entities (
+            CREATE TABLE IF NOT EXISTS entities (
                 added_id INTEGER NOT NULL AUTO_INCREMENT,
                 id BINARY(16) NOT NULL,
                 updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
                 tag MEDIUMINT,
                 body MEDIUMBLOB NOT NULL,
+                version INT UNSIGNED NOT NULL DEFAULT 0,
+                body_hash BINARY(16),
                 PRIMARY KEY (added_id),
                 UNIQUE KEY (id),
                 KEY (updated)
             ) ENGINE=InnoDB""")
+        self.catalog.add_table('entities', ['added_id', 'id', 'updated', 'tag', 'body', 'version', 'body_hash'])
+
+    def create_expiry_table(self):
+        self.router.note_write()
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS entity_expiry (
+                entity_id BINARY(16) NOT NULL,
+                expires_at DOUBLE NOT NULL,
+                PRIMARY KEY (expires_at, entity_id),
+                UNIQUE KEY (entity_id)
+            ) ENGINE=InnoDB""")
+        self.catalog.add_table('entity_expiry', ['entity_id', 'expires_at'])
+
+    def create_tombstones_table(self):
+        self.router.note_write()
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS tombstones (
+                index_table VARCHAR(64) NOT NULL,
+                entity_id BINARY(16) NOT NULL,
+                PRIMARY KEY (index_table, entity_id)
+            ) ENGINE=InnoDB""")
+        self.catalog.add_table('tombstones', ['index_table', 'entity_id'])
+
+    def create_changelog_tables(self):
+        self.router.note_write()
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS changelog (
+                change_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+                entity_id BINARY(16) NOT NULL,
+                tag MEDIUMINT,
+                op TINYINT NOT NULL,
+                created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (change_id)
+            ) ENGINE=InnoDB""")
+        self.catalog.add_table('changelog', ['change_id', 'entity_id', 'tag', 'op', 'created'])
+        if not self.check_table_exists('changelog_offsets'):
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS changelog_offsets (
+                    consumer VARCHAR(255) NOT NULL,
+                    change_id BIGINT UNSIGNED NOT NULL,
+                    updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (consumer)
+                ) ENGINE=InnoDB""")
+            self.catalog.add_table('changelog_offsets', ['consumer', 'change_id', 'updated'])
@@ -0,0 +1,100 @@
+"""Deadlines for datastore calls.
+
+A deadline bounds the wall clock time of everything done inside it:
+
+    with schemaless.deadline_scope(0.5):
+        posts = Post.query(c.user_id == user_id)
+
+or, for a single call, Index.query(..., deadline=0.5) and the like. Every
+statement sent to MySQL first checks the time left, and SELECTs are sent
+with a MAX_EXECUTION_TIME hint for it (MySQL 5.7.8 and later; older
+servers ignore the hint), so a slow query is killed by the server instead
+of holding the caller. When the time runs out DeadlineExceeded is raised.
+
+Writes that aren't in a transaction check the deadline once, before their
+first statement, and then run to the end (see suspend_deadline), so that
+they're never left half done; ones in a transaction are rolled back.
+
+Deadlines nest, and an inner deadline never extends an outer one. They're
+kept per thread.
+"""
+import time
+import threading
+import contextlib
+
+# the MySQL error raised when MAX_EXECUTION_TIME kills a query
+ER_QUERY_TIMEOUT = 3024
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline(object):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.time() + timeout
+
+    def __str__(self):
+        return '%s(timeout=%r, remaining=%1.3f)' % (self.__class__.__name__, self.timeout, self.remaining())
+    __repr__ = __str__
+
+    def remaining(self):
+        """Seconds left, which is negative once the deadline has passed."""
+        return self.expires_at - time.time()
+
+    def check(self):
+        """Raise DeadlineExceeded if the deadline has passed."""
+        if time.time() >= self.expires_at:
+            raise DeadlineExceeded('deadline of %1.3f seconds exceeded' % (self.timeout,))
+
+_local = threading.local()
+
+def current_deadline():
+    """The innermost deadline in effect in this thread, or None."""
+    return getattr(_local, 'deadline', None)
+
+def check_deadline():
+    """Raise DeadlineExceeded if the current deadline has passed."""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is not None:
+        deadline.check()
+
+@contextlib.contextmanager
+def deadline_scope(timeout):
+    """Run the body with a deadline timeout seconds from now, or the
+    enclosing deadline if that's sooner. A timeout of None adds no deadline.
+    """
+    if timeout is None:
+        yield current_deadline()
+        return
+    outer = current_deadline()
+    deadline = Deadline(timeout)
+    if outer is not None and outer.expires_at < deadline.expires_at:
+        deadline = outer
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = outer
+
+@contextlib.contextmanager
+def suspend_deadline(check=True):
+    """Run the body without the current deadline, after checking it if check
+    is true. Used for the statements that have to run together, and for
+    COMMIT and ROLLBACK.
+    """
+    deadline = current_deadline()
+    if check and deadline is not None:
+        deadline.check()
+    _local.deadline = None
+    try:
+        yield deadline
+    finally:
+        _local.deadline = deadline
+
+def add_time_limit(statement, deadline):
+    """Add a MAX_EXECUTION_TIME hint for the time left to a SELECT."""
+    if not statement.startswith('SELECT '):
+        return statement
+    ms = max(int(deadline.remaining() * 1000), 1)
+    return 'SELECT /*+ MAX_EXECUTION_TIME(%d) */ %s' % (ms, statement[7:])
@@ -1,4 +1,26 @@
-from schemaless.column import ColumnExpression, Entity
+import time
+import operator
+import itertools
+
+from schemaless.column import ColumnExpression, Entity, MISSING, make_extractor, list_elements
+from schemaless.deadline import deadline_scope
+
+# number of ids -> SQL to fetch that many entities
+_entities_in_cache = {}
+
+def entities_in_sql(num_ids):
+    try:
+        return _entities_in_cache[num_ids]
+    except KeyError:
+        q = _entities_in_cache[num_ids] = 'SELECT * FROM entities WHERE id IN (%s)' % (', '.join('%s' for x in xrange(num_ids)),)
+        return q
+
+def not_expired(entities):
+    """Drop the entities whose expires_at time has passed (they're purged
+    from the database in the background, see schemaless.batch.ExpiryPurger).
+    """
+    now = time.time()
+    return [e for e in entities if e.get('expires_at') is None or e['expires_at'] > now]
 
 class Order(object):
 
@@ -32,17 +54,59 @@ def reduce_args(*exprs, **kwargs):
 
 class Index(object):
 
-    def __init__(self, table, properties=[], match_on={}, shard_on=None, connection=None, use_zlib=True):
+    # a schemaless.advisor.QueryRecorder, see DataStore.enable_recorder
+    recorder = None
+
+    # a schemaless.singleflight.SharedReads, see DataStore(single_flight=True)
+    shared_reads = None
+
+    # whether queries skip the entities that entity_expiry says have expired,
+    # see DataStore(expiry=True)
+    skip_expired = False
+
+    # the smallest page read when a limited query has to read on past
+    # entities it dropped; later pages double in size
+    refill_page_size = 100
+
+    def __init__(self, table, properties=[], match_on={}, shard_on=None, connection=None, use_zlib=True, router=None, chunks=None, extract={}, multi=()):
         if shard_on is not None:
             raise NotImplementedError
-        if any(',' in p for p in properties):
-            raise ValueError('Bad property name: %r' % (p,))
+        for p in list(properties) + list(extract):
+            if ',' in p or '.' in p:
+                raise ValueError('Bad property name: %r' % (p,))
 
         self.table = table
-        self.properties = frozenset(properties)
+        self.properties = frozenset(properties) | frozenset(extract)
         self.match_on = match_on
+
+        # column name -> function computing the column from an entity, for
+        # the columns that aren't just a top level property
+        self.extractors = dict((name, make_extractor(spec)) for name, spec in extract.iteritems())
+        self.required_keys = self.properties - frozenset(self.extractors)
+
+        # the top level properties the index reads, as far as can be told
+        # without looking into extract functions
+        self.source_fields = self.required_keys | frozenset(match_on) | frozenset(spec.split('.')[0] for spec in extract.itervalues() if isinstance(spec, basestring))
+
+        # list valued columns, which get one index row per element
+        self.multi = frozenset(multi)
+        if not (self.multi <= self.properties):
+            raise ValueError('Multi-valued columns %s are not in the index' % (sorted(self.multi - self.properties),))
         self.connection = connection
         self.use_zlib = use_zlib
+        self.router = router
+        self.chunks = chunks
+
+        # the statements used to maintain the index, which only depend on the
+        # columns
+        self.columns = sorted(self.properties)
+        self.getters = [self.extractors.get(p) or operator.itemgetter(p) for p in self.columns]
+        self.row_sql = '(%s)' % (', '.join('%s' for x in xrange(len(self.columns) + 1)),)
+        self.insert_sql = 'INSERT INTO %s (%s) VALUES %s' % (table, ', '.join(['entity_id'] + self.columns), self.row_sql)
+        self.update_sql = 'UPDATE %s SET %s WHERE entity_id = %%s' % (table, ', '.join('%s = %%s' % (p,) for p in self.columns))
+        self.select_sql = 'SELECT * FROM %s WHERE entity_id = %%s' % (table,)
+        self.delete_row_sql = 'DELETE FROM %s WHERE entity_id = %%s AND %s' % (table, ' AND '.join('%s = %%s' % (p,) for p in self.columns))
+        self._query_cache = {}
 
     def __str__(self):
         return '%s(table=%s, properties=%s, match_on=%s)' % (self.__class__.__name__, self.table, self.properties, self.match_on)
@@ -51,70 +115,188 @@ class Index(object):
     def __cmp__(self, other):
         return cmp(self.table, other.table)
 
+    def insert_many_sql(self, num_rows):
+        """The statement to insert num_rows rows into the index at once."""
+        return self.insert_sql + (', ' + self.row_sql) * (num_rows - 1)
+
+    def values(self, entity):
+        """The values of the index columns for an entity, in the same order
+        as self.columns.
+        """
+        return [get(entity) for get in self.getters]
+
+    def rows_for(self, entity):
+        """The set of index rows (tuples of the column values, in the same
+        order as self.columns) for an entity. That's just the one row unless
+        the index has multi-valued columns, which get a row for each distinct
+        element (and for each combination of elements, if there are several
+        of them).
+        """
+        vals = self.values(entity)
+        if not self.multi:
+            return set([tuple(vals)])
+        choices = []
+        for name, val in zip(self.columns, vals):
+            if name in self.multi:
+                choices.append(set(list_elements(val)))
+            else:
+                choices.append([val])
+        return set(itertools.product(*choices))
+
     def matches(self, entity, keys):
-        if not (self.properties <= keys):
+        if not (self.required_keys <= keys):
             return False
         for k, v in self.match_on.iteritems():
             if entity.get(k) != v:
                 return False
+        for extract in self.extractors.itervalues():
+            if extract(entity) is MISSING:
+                return False
         return True
 
+    @property
+    def reader(self):
+        """The connection (or ReadRouter) that queries are run against."""
+        return self.router if self.router is not None else self.connection
+
     def _query(self, *exprs, **kwargs):
-        exprs, order_by, limit = reduce_args(*exprs, **kwargs)
-        return self._do_query(exprs, order_by, limit)
+        with deadline_scope(kwargs.pop('deadline', None)):
+            exprs, order_by, limit = reduce_args(*exprs, **kwargs)
+            return self._do_query(exprs, order_by, limit)
+
+    def _compile_query(self, exprs, order_by, limit):
+        """Build the SQL for a query shape (the columns and operators used,
+        the ordering and whether there's a limit). Parameter values aren't
+        part of the shape, so the result is cached and reused.
+        """
+        key = (tuple(e.shape for e in exprs), order_by and (order_by.name, order_by.order), bool(limit))
+        try:
+            return self._query_cache[key]
+        except KeyError:
+            pass
 
-    def _do_query(self, exprs, order_by, limit):
-        values = []
         where_clause = []
         for e in exprs:
             if e.name not in self.properties:
                 raise ValueError('This index has no column named %r' % (e.name,))
-            expr_string, vals = e.build()
-            where_clause.append(expr_string)
-            values.extend(vals)
+            where_clause.append(e.build_sql())
+        if self.skip_expired:
+            # to the second, so that identical queries can still be shared
+            # (see schemaless.singleflight); not_expired does the rest
+            id_column = 'entities.id' if self.table == 'entities' else '%s.entity_id' % (self.table,)
+            where_clause.append('NOT EXISTS (SELECT 1 FROM entity_expiry WHERE entity_expiry.entity_id = %s AND entity_expiry.expires_at <= %%s)' % (id_column,))
 
         if self.table == 'entities':
             # XXX: this is a bit hacky
-            q = 'SELECT * FROM entities WHERE ' + ' AND '.join(where_clause)
-            if order_by:
-                q += ' ORDER BY %s %s' % (order_by.name, order_by.order)
-            if limit:
-                q += ' LIMIT %d' % (limit,)
-            entity_rows = self.connection.query(q, *values)
+            q = 'SELECT * FROM entities'
+        elif self.multi and not order_by:
+            # an entity can match more than one of its rows; dedupe before
+            # the LIMIT so that it counts entities
+            q = 'SELECT DISTINCT entity_id FROM %s' % self.table
         else:
             q = 'SELECT entity_id FROM %s' % self.table
-            if where_clause:
-                q += ' WHERE ' + ' AND '.join(where_clause)
-            if order_by:
-                q += ' ORDER BY %s %s' % (order_by.name, order_by.order)
-            if limit:
-                q += ' LIMIT %d' % (limit,)
+        if where_clause:
+            q += ' WHERE ' + ' AND '.join(where_clause)
+        if order_by and self.multi and self.table != 'entities':
+            # DISTINCT can't be ordered by a column it doesn't select, so
+            # group instead, ordering each entity by its first row
+            agg = 'MIN' if order_by.order == 'ASC' else 'MAX'
+            q += ' GROUP BY entity_id ORDER BY %s(%s) %s' % (agg, order_by.name, order_by.order)
+        elif order_by:
+            q += ' ORDER BY %s %s' % (order_by.name, order_by.order)
+        if limit:
+            q += ' LIMIT %s'
+
+        self._query_cache[key] = q
+        return q
+
+    def _query_params(self, exprs, limit):
+        """The parameters for the SQL built by _compile_query."""
+        values = []
+        for e in exprs:
+            values.extend(e.params())
+        if self.skip_expired:
+            values.append(int(time.time()))
+        if limit:
+            values.append(int(limit))
+        return values
 
-            rows = self.connection.query(q, *values)
+    def _do_query(self, exprs, order_by, limit, record=True):
+        q = self._compile_query(exprs, order_by, limit)
+        values = self._query_params(exprs, limit)
+
+        if not record or self.recorder is None:
+            return self._shared_fetch(q, values, order_by, limit)
+        start = time.time()
+        result = self._shared_fetch(q, values, order_by, limit)
+        self.recorder.record('index', self.table, self.table, exprs, [], order_by, limit, len(result), len(result), time.time() - start, q, values)
+        return result
+
+    def _shared_fetch(self, q, values, order_by, limit):
+        """_fetch, sharing the result with identical concurrent queries if
+        single flight is on.
+        """
+        if self.shared_reads is None:
+            return self._fetch(q, values, order_by, limit)
+        return self.shared_reads.do(('query', q, tuple(values)), lambda reader: self._fetch(q, values, order_by, limit, reader))
+
+    def _fetch(self, q, values, order_by, limit=None, reader=None):
+        """Run an index query and fetch its entities. Expired entities, and
+        index rows whose entity is gone (tombstoned by delete_many, or not
+        on a replica yet) are skipped, so when a page of a limited query
+        loses some, the following pages are read until the limit is filled
+        or the index rows run out. Those pages are at least refill_page_size
+        rows, and double each time.
+        """
+        if reader is None:
+            reader = self.reader
+        entities, num_rows = self._fetch_page(q, values, order_by, reader)
+        if not limit or num_rows < limit or len(entities) >= limit:
+            return entities
+        seen = set(e['id'] for e in entities)
+        offset = limit
+        page_size = max(limit, self.refill_page_size)
+        while len(entities) < limit:
+            # the LIMIT is the last parameter
+            page, num_rows = self._fetch_page(q + ' OFFSET %s', values[:-1] + [page_size, offset], order_by, reader)
+            for e in page:
+                if e['id'] not in seen:
+                    seen.add(e['id'])
+                    entities.append(e)
+            if num_rows < page_size:
+                break
+            offset += page_size
+            page_size *= 2
+        return entities[:limit]
+
+    def _fetch_page(self, q, values, order_by, reader):
+        """Run the query, and return the live entities it found along with
+        the number of rows it returned.
+        """
+        if self.table == 'entities':
+            entity_rows = reader.query(q, *values)
+            num_rows = len(entity_rows)
+            if order_by:
+                return not_expired([Entity.from_row(row, use_zlib=self.use_zlib, chunks=self.chunks) for row in entity_rows]), num_rows
+        else:
+            rows = reader.query(q, *values)
+            num_rows = len(rows)
             if rows:
                 entity_ids = [r['entity_id'] for r in rows]
-                q = 'SELECT * FROM entities WHERE id IN ('
-                q += ', '.join('%s' for x in rows)
-                q += ')'
-                entity_rows = self.connection.query(q, *entity_ids)
+                entity_rows = reader.query(entities_in_sql(len(entity_ids)), *entity_ids)
             else:
-                return []
+                return [], 0
 
         if not order_by:
             #sorted_entities = sorted(entity_rows, key=lambda x: x['updated'], reverse=True)
             sorted_entities = sorted(entity_rows, key=lambda x: x['updated'])
         else:
-            # XXX: this is O(n^2), bad
-            sorted_entities = []
-            for row_id in (row['entity_id'] for row in rows):
-                for e in entity_rows:
-                    if e['id'] == row_id:
-                        sorted_entities.append(e)
-                        break
-                else:
-                    assert False
-
-        return [Entity.from_row(row, use_zlib=self.use_zlib) for row in sorted_entities]
+            # entities that disappeared between the two queries (or haven't
+            # reached a replica yet) are skipped
+            rows_by_id = dict((e['id'], e) for e in entity_rows)
+            sorted_entities = [rows_by_id[i] for i in entity_ids if i in rows_by_id]
+
+        return not_expired([Entity.from_row(row, use_zlib=self.use_zlib, chunks=self.chunks) for row in sorted_entities]), num_rows
 
     def get(self, *exprs, **kwargs):
         kwargs['limit'] = 1
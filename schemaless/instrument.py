@@ -0,0 +1,248 @@
+"""Query instrumentation.
+
+Every statement that schemaless sends to MySQL goes through an
+InstrumentedConnection, which wraps a tornado.database.Connection and calls
+any registered hooks before and after the statement runs. Hooks are called
+with a QueryEvent. QueryStats is a hook that keeps per-table/per-operation
+counters and latency histograms, and logs slow queries.
+
+    ds = schemaless.DataStore(...)
+    stats = ds.enable_stats(slow_query_time=0.1)
+    ...
+    print stats.snapshot()
+"""
+import re
+import time
+import threading
+import collections
+import simplejson
+
+import tornado.database
+
+from schemaless.deadline import DeadlineExceeded, ER_QUERY_TIMEOUT, current_deadline, add_time_limit
+from schemaless.log import ClassLogger
+
+_statement_re = re.compile(r'^\s*(\w+)')
+_table_res = {
+    'SELECT': re.compile(r'\bFROM\s+`?(\w+)', re.I),
+    'INSERT': re.compile(r'^\s*INSERT\s+(?:IGNORE\s+)?INTO\s+`?(\w+)', re.I),
+    'REPLACE': re.compile(r'^\s*REPLACE\s+(?:INTO\s+)?`?(\w+)', re.I),
+    'UPDATE': re.compile(r'^\s*UPDATE\s+`?(\w+)', re.I),
+    'DELETE': re.compile(r'\bFROM\s+`?(\w+)', re.I),
+    'CREATE': re.compile(r'\bTABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)', re.I),
+}
+
+# statement -> (operation, table); statements are templates, so this stays
+# small
+_shape_cache = {}
+
+def statement_shape(statement):
+    """Return the (operation, table) for a SQL statement, e.g. ('SELECT',
+    'entities'). The table is None if it can't be determined.
+    """
+    try:
+        return _shape_cache[statement]
+    except KeyError:
+        pass
+    m = _statement_re.match(statement)
+    operation = m.group(1).upper() if m else None
+    table = None
+    table_re = _table_res.get(operation)
+    if table_re:
+        m = table_re.search(statement)
+        if m:
+            table = m.group(1)
+    _shape_cache[statement] = (operation, table)
+    return operation, table
+
+class QueryEvent(object):
+    """Describes a single statement. The rows, elapsed and error attributes
+    are only filled in for the hooks that run after the statement.
+
+    statement -- the SQL statement, with %s placeholders for the parameters
+    operation -- e.g. 'SELECT', 'INSERT'
+    table -- the (first) table the statement touches, if known
+    num_params -- the number of parameters passed with the statement
+    rows -- rows returned (for reads) or affected (for execute_rowcount)
+    elapsed -- wall clock time in seconds
+    error -- the exception raised by the statement, if any
+    """
+
+    __slots__ = ['statement', 'operation', 'table', 'num_params', 'rows', 'elapsed', 'error']
+
+    def __init__(self, statement, num_params):
+        self.statement = statement
+        self.operation, self.table = statement_shape(statement)
+        self.num_params = num_params
+        self.rows = None
+        self.elapsed = None
+        self.error = None
+
+    def __str__(self):
+        return '%s(operation=%s, table=%s, rows=%r, elapsed=%r)' % (self.__class__.__name__, self.operation, self.table, self.rows, self.elapsed)
+    __repr__ = __str__
+
+class InstrumentedConnection(object):
+    """Wraps a tornado.database.Connection, timing each statement and calling
+    the registered before/after hooks, and enforcing the current deadline
+    (see schemaless.deadline). Anything that isn't a statement is passed
+    through to the wrapped connection.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.before_hooks = []
+        self.after_hooks = []
+
+    def add_hook(self, before=None, after=None):
+        if before is not None:
+            self.before_hooks.append(before)
+        if after is not None:
+            self.after_hooks.append(after)
+
+    def remove_hook(self, before=None, after=None):
+        if before is not None:
+            self.before_hooks.remove(before)
+        if after is not None:
+            self.after_hooks.remove(after)
+
+    def _run_hooks(self, hooks, event):
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                self.log.exception('exception in query hook %r' % (hook,))
+
+    def _execute(self, method, query, parameters):
+        deadline = current_deadline()
+        if deadline is None:
+            return getattr(self.connection, method)(query, *parameters)
+        deadline.check()
+        try:
+            return getattr(self.connection, method)(add_time_limit(query, deadline), *parameters)
+        except tornado.database.OperationalError, e:
+            if e.args and e.args[0] == ER_QUERY_TIMEOUT:
+                raise DeadlineExceeded('query killed after the deadline of %1.3f seconds: %s' % (deadline.timeout, query))
+            raise
+
+    def _call(self, method, count_rows, query, parameters):
+        if not (self.before_hooks or self.after_hooks):
+            return self._execute(method, query, parameters)
+
+        event = QueryEvent(query, len(parameters))
+        self._run_hooks(self.before_hooks, event)
+        start = time.time()
+        try:
+            result = self._execute(method, query, parameters)
+        except Exception, e:
+            event.elapsed = time.time() - start
+            event.error = e
+            self._run_hooks(self.after_hooks, event)
+            raise
+        event.elapsed = time.time() - start
+        event.rows = count_rows(result)
+        self._run_hooks(self.after_hooks, event)
+        return result
+
+    def query(self, query, *parameters):
+        return self._call('query', len, query, parameters)
+
+    def get(self, query, *parameters):
+        return self._call('get', lambda row: int(row is not None), query, parameters)
+
+    def execute(self, query, *parameters):
+        return self._call('execute', lambda lastrowid: None, query, parameters)
+
+    def execute_rowcount(self, query, *parameters):
+        return self._call('execute_rowcount', lambda rowcount: rowcount, query, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class QueryStats(object):
+    """Per-table/per-operation counters and latency histograms, meant to be
+    registered as an after hook on an InstrumentedConnection. Statements that
+    take longer than slow_query_time seconds are logged, and the most recent
+    of them are kept around for the snapshot.
+    """
+
+    log = ClassLogger()
+
+    # upper bounds (in seconds) of the histogram buckets; anything slower than
+    # the last bound goes in an overflow bucket
+    buckets = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, slow_query_time=None, max_slow_queries=100):
+        self.slow_query_time = slow_query_time
+        self.max_slow_queries = max_slow_queries
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.slow_queries = collections.deque(maxlen=self.max_slow_queries)
+
+    def __call__(self, event):
+        elapsed = event.elapsed
+        with self.lock:
+            key = (event.table, event.operation)
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = {
+                    'count': 0,
+                    'errors': 0,
+                    'rows': 0,
+                    'total_time': 0.0,
+                    'max_time': 0.0,
+                    'histogram': [0] * (len(self.buckets) + 1)}
+            counter['count'] += 1
+            if event.error is not None:
+                counter['errors'] += 1
+            if event.rows:
+                counter['rows'] += event.rows
+            counter['total_time'] += elapsed
+            counter['max_time'] = max(counter['max_time'], elapsed)
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    counter['histogram'][i] += 1
+                    break
+            else:
+                counter['histogram'][-1] += 1
+
+            if self.slow_query_time is not None and elapsed >= self.slow_query_time:
+                self.slow_queries.append({
+                    'time': time.time(),
+                    'statement': event.statement,
+                    'table': event.table,
+                    'rows': event.rows,
+                    'elapsed': elapsed})
+                self.log.warning('slow query (%1.3f seconds, %s rows): %s' % (elapsed, event.rows, event.statement))
+
+    def snapshot(self):
+        """Return a copy of the current counters as plain data, like:
+
+            {'tables': {'entities': {'SELECT': {'count': 10, ...}}},
+             'buckets': [0.0005, 0.001, ...],
+             'slow_queries': [...]}
+
+        Statements whose table couldn't be determined are under the table
+        name None.
+        """
+        with self.lock:
+            tables = {}
+            for (table, operation), counter in self.counters.iteritems():
+                counter = dict(counter, histogram=list(counter['histogram']))
+                counter['mean_time'] = counter['total_time'] / counter['count']
+                tables.setdefault(table, {})[operation] = counter
+            return {'tables': tables,
+                    'buckets': list(self.buckets),
+                    'slow_queries': list(self.slow_queries)}
+
+    def export(self):
+        """Return the snapshot as a JSON string."""
+        snapshot = self.snapshot()
+        snapshot['tables'] = dict((str(k), v) for k, v in snapshot['tables'].iteritems())
+        return simplejson.dumps(snapshot)
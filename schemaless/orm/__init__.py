@@ -1,5 +1,5 @@
 from session import Session
-from index import Index
+from index import Index, TextIndex
 from column import *
 from document import make_base
 import converters
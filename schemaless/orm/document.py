@@ -1,15 +1,120 @@
+import time
 import yaml
 from collections import defaultdict
 from index import IndexCollection
 from schemaless.index import reduce_args
+from schemaless.column import filter_rows
+from schemaless.deadline import deadline_scope, check_deadline
 from schemaless.log import ClassLogger
 from schemaless.orm.util import is_type_list
-from schemaless.orm.index import Index
+from schemaless.orm.index import Index, TextIndex
 from schemaless.orm.column import Column, DEFAULT_NONCE
 from schemaless import c
 
+# attributes that every document instance has a slot for
+_internal_slots = ('_schemaless_id', '_schemaless_dirty', '_schemaless_collected_fields', '_schemaless_prefetched', 'updated')
+
+_missing = object()
+
+def _instance_items(x):
+    for k in x._schemaless_slot_names:
+        v = getattr(x, k, _missing)
+        if v is not _missing:
+            yield k, v
+    for item in getattr(x, '__dict__', {}).iteritems():
+        yield item
+
 def _collect_fields(x):
-    return set((k, v) for k, v in x.__dict__.iteritems() if k != 'tag' and not k.startswith('_') and not callable(v))
+    return set((k, v) for k, v in _instance_items(x) if k != 'tag' and not k.startswith('_') and not callable(v))
+
+def _make_slots(name, bases, cls_dict):
+    """The __slots__ for a document class: one for each column and internal
+    attribute that the bases don't already provide. The first document class
+    also gets a __dict__ (so that arbitrary attributes can still be set) and a
+    __weakref__ (for the session's identity map).
+    """
+    names = set(_internal_slots) | set(c.name for c in cls_dict['_columns'])
+    names.discard('tag')
+    slots = sorted(n for n in names if n not in cls_dict and not any(hasattr(b, n) for b in bases))
+    if not any(b.__dictoffset__ for b in bases):
+        slots.append('__dict__')
+    if not any(b.__weakrefoffset__ for b in bases):
+        slots.append('__weakref__')
+    return tuple(slots)
+
+def _make_hydrator(cls, raw_setattr, base_init):
+    """Build the function that turns an entity from the datastore into an
+    instance of cls, without going through __init__. Everything that only
+    depends on the class (which columns have converters or defaults, which are
+    required) is worked out here, once.
+    """
+    tag = cls.tag
+    required = cls._required_columns
+    columns = []
+    for c in sorted(cls._columns, key=lambda c: c.name):
+        if c.name == 'tag':
+            continue
+        convert = c.convert.from_db if c.convert else None
+        columns.append((c.name, convert, c.default, callable(c.default)))
+    column_names = frozenset(name for name, convert, default, default_is_callable in columns)
+    new = cls.__new__
+
+    def hydrate(d):
+        if d['tag'] != tag:
+            raise ValueError('Expected item with tag %d, instead got item with tag %d' % (tag, d['tag']))
+        chunked = dict.get(d, '_chunked')
+        if chunked and not column_names.isdisjoint(chunked):
+            # some columns are stored out of line (see schemaless.chunk)
+            d.load_chunks()
+        missing = required.difference(d)
+        if missing:
+            raise ValueError('Missing from %s the following keys: %s' % (d, ', '.join(k for k in sorted(missing))))
+
+        obj = new(cls)
+        if base_init is not None:
+            base_init(obj)
+        for name, convert, default, default_is_callable in columns:
+            v = d.get(name, _missing)
+            if v is not _missing:
+                if convert is not None:
+                    v = convert(v)
+            elif default is not DEFAULT_NONCE:
+                v = default() if default_is_callable else default
+            else:
+                continue
+            raw_setattr(obj, name, v)
+        raw_setattr(obj, '_schemaless_id', d['id'])
+        raw_setattr(obj, '_schemaless_dirty', False)
+        # None means "every column the entity had", which includes all of
+        # the required columns
+        raw_setattr(obj, '_schemaless_collected_fields', None)
+        raw_setattr(obj, 'updated', d['updated'])
+        return obj
+
+    return hydrate
+
+class QueryResult(list):
+    """The list of documents returned by a query."""
+
+    def prefetch(self, child_cls, on):
+        """Load the child_cls documents whose `on` field is the id of one of
+        these documents, with a single IN query, and attach them to their
+        parents. Afterwards parent.prefetched(child_cls, on) returns the
+        children of each parent. For instance,
+
+            posts = Post.query(c.author == 'evan').prefetch(Comment, 'post_id')
+
+        costs two index queries and two entity fetches, however many posts
+        there are. Returns self, for chaining.
+        """
+        children = defaultdict(list)
+        ids = list(set(d.id for d in self if d.id is not None))
+        if ids:
+            for child in child_cls.query(getattr(c, on).in_(ids)):
+                children[getattr(child, on)].append(child)
+        for d in self:
+            d._set_prefetched(child_cls, on, children.get(d.id, []))
+        return self
 
 def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=None):
     """Create a base class for ORM documents.
@@ -18,6 +123,11 @@ def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=
     base_cls -- the base class for the document class
     tags_file -- the path of a YAML file containing tags declarations
     tags_db -- an explicit maping (as a dict) or tags declarations
+
+    The document classes are bound to session, whose identity map caches
+    the documents it loads for as long as they're in use, so a long running
+    process has to call session.clear() at the end of each unit of work
+    (e.g. in a RequestHandler's on_finish) to see other processes' writes.
     """
 
     # tags that have been registered
@@ -70,11 +180,28 @@ def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=
                         raise ValueError("Sorry, I don't know how to make an index for %s from %r" % (name, idx))
                 cls_dict['_indexes'] = indexes
                 cls_dict['_schemaless_index_collection'] = IndexCollection(indexes)
+                extractors = {}
+                multi = set()
                 for idx in indexes:
                     idx.declare(session.datastore, tag=cls_dict['tag'])
+                    extractors.update(idx.underlying.extractors)
+                    multi |= idx.underlying.multi
+                cls_dict['_schemaless_extractors'] = extractors
+                cls_dict['_schemaless_multi'] = frozenset(multi)
 
             cls_dict['_session'] = session
-            return meta_base.__new__(mcs, name, bases, cls_dict)
+            if '__slots__' not in cls_dict:
+                cls_dict['__slots__'] = _make_slots(name, bases, cls_dict)
+            cls = meta_base.__new__(mcs, name, bases, cls_dict)
+
+            cls._schemaless_slot_names = tuple(sorted(set(
+                n for k in cls.__mro__ for n in k.__dict__.get('__slots__', ()) if n not in ('__dict__', '__weakref__'))))
+            if not '_abstract' in cls_dict:
+                cls._schemaless_hydrate = staticmethod(_make_hydrator(cls, raw_setattr, base_init))
+            return cls
+
+    raw_setattr = base_cls.__setattr__
+    base_init = base_cls.__init__ if base_cls is not object else None
 
     class Document(base_cls):
 
@@ -100,65 +227,84 @@ def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=
                     raise TypeError('Inconsistent tag')
             
             # FIXME: ought to grab other attributes off the class dict as well
-            self.__dict__['_schemaless_collected_fields'] = set(['tag'])
-            self.__dict__['_schemaless_id'] = from_dict.get('id', None)
+            collected_fields = set(['tag'])
+            raw_setattr(self, '_schemaless_collected_fields', collected_fields)
+            raw_setattr(self, '_schemaless_id', from_dict.get('id', None))
 
+            has_tag = hasattr(self, 'tag')
             for k, v in from_dict.iteritems():
                 if k in self._column_names:
-                    self.__dict__[k] = v
-                    self._schemaless_collected_fields.add(k)
+                    if k != 'tag' or not has_tag:
+                        raw_setattr(self, k, v)
+                    collected_fields.add(k)
 
             # Add default values
-            dict_keys = from_dict.keys()
             for c in self._columns:
-                if c.default != DEFAULT_NONCE and c.name not in dict_keys:
+                if c.default != DEFAULT_NONCE and c.name not in from_dict:
                     if callable(c.default):
                         v = c.default()
                     else:
                         v = c.default
-                    self.__dict__[c.name] = v
-                    self._schemaless_collected_fields.add(c.name)
+                    raw_setattr(self, c.name, v)
+                    collected_fields.add(c.name)
 
             self._schemaless_dirty = is_dirty
             if self._schemaless_dirty and self._saveable():
                 self._session.dirty_documents.add(self)
 
         def _saveable(self):
-            return self._schemaless_collected_fields >= self._required_columns
+            fields = self._schemaless_collected_fields
+            return fields is None or fields >= self._required_columns
 
         def __setattr__(self, k, v):
             if k in self._column_names:
-                self._schemaless_collected_fields.add(k)
+                if self._schemaless_collected_fields is not None:
+                    self._schemaless_collected_fields.add(k)
                 self._schemaless_dirty = True
                 if self not in self._session.dirty_documents and self._saveable():
                     self._session.dirty_documents.add(self)
             super(Document, self).__setattr__(k, v)
 
         def __delattr__(self, k):
-            try:
-                self._schemaless_collected_fields.remove(k)
-            except KeyError:
-                pass
+            if self._schemaless_collected_fields is None:
+                raw_setattr(self, '_schemaless_collected_fields', set(['tag']) | set(n for n in self._column_names if hasattr(self, n)))
+            self._schemaless_collected_fields.discard(k)
             super(Document, self).__delattr__(k)
 
+        def __getstate__(self):
+            return dict(_instance_items(self))
+
+        def __setstate__(self, state):
+            # copy and pickle restore documents without __init__, so
+            # __setattr__ (which needs the internal slots) is bypassed
+            for k, v in state.iteritems():
+                if k == '_schemaless_collected_fields' and v is not None:
+                    v = set(v)
+                raw_setattr(self, k, v)
+
         @property
         def is_dirty(self):
             return self._schemaless_dirty
 
+        def _set_prefetched(self, child_cls, on, children):
+            if getattr(self, '_schemaless_prefetched', None) is None:
+                raw_setattr(self, '_schemaless_prefetched', {})
+            self._schemaless_prefetched[(child_cls, on)] = children
+
+        def prefetched(self, child_cls, on):
+            """Return the child_cls documents attached to this document by
+            QueryResult.prefetch(child_cls, on), or None if they weren't
+            prefetched.
+            """
+            return (getattr(self, '_schemaless_prefetched', None) or {}).get((child_cls, on))
+
         @classmethod
         def from_datastore(cls, d):
-            if d['tag'] != cls.tag:
-                raise ValueError('Expected item with tag %d, instead got item with tag %d' % (cls.tag, d['tag']))
-            missing = cls._required_columns - set(d.keys())
-            if missing:
-                raise ValueError('Missing from %s the following keys: %s' % (d, ', '.join(k for k in sorted(missing))))
-            for k, v in d.iteritems():
-                c = cls._column_map.get(k)
-                if c and c.convert:
-                    d[k] = c.convert.from_db(v)
-
-            obj = cls(d, is_dirty=False)
-            obj.updated = d['updated']
+            obj = cls._session.identity_map.get(d['id'])
+            if obj is not None and obj.__class__ is cls:
+                return obj
+            obj = cls._schemaless_hydrate(d)
+            cls._session.identity_map[obj.id] = obj
             return obj
 
         def to_dict(self):
@@ -179,15 +325,22 @@ def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=
         def id(self):
             return getattr(self, '_schemaless_id', None)
 
-        def save(self, clear_session=True):
+        def _check_saveable(self):
             if not self._saveable():
                 missing = self._required_columns - self._schemaless_collected_fields
                 raise ValueError('This object is not yet saveable, missing: %s' % (', '.join(str(k) for k in missing),))
+
+        def _mark_saved(self, obj):
+            self.updated = obj['updated']
+            self._schemaless_id = obj['id']
+            self._schemaless_dirty = False
+            self._session.identity_map[self._schemaless_id] = self
+
+        def save(self, clear_session=True):
+            self._check_saveable()
             if self._schemaless_dirty:
                 obj = self._session.datastore.put(self.to_dict(), self.tag)
-                self.updated = obj['updated']
-                self._schemaless_id = obj['id']
-                self._schemaless_dirty = False
+                self._mark_saved(obj)
                 if clear_session and self in self._session.dirty_documents:
                     self._session.dirty_documents.remove(self)
             return self
@@ -198,12 +351,18 @@ def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=
             if not hasattr(self, '_schemaless_id'):
                 raise ValueError('This object has no entity id (or has not been persisted)')
             self._session.datastore.delete(id=self._schemaless_id)
+            self._session.identity_map.pop(self._schemaless_id, None)
             if clear_session and self in self._session.dirty_documents:
                 self._session.dirty_documents.remove(self)
 
         @classmethod
         def _query(cls, *exprs, **kwargs):
-            exprs, order_by, limit = reduce_args(*exprs, **kwargs)
+            with deadline_scope(kwargs.pop('deadline', None)):
+                exprs, order_by, limit = reduce_args(*exprs, **kwargs)
+                return cls._run_query(exprs, order_by, limit)
+
+        @classmethod
+        def _run_query(cls, exprs, order_by, limit):
             columns = set(e.name for e in exprs)
             if order_by:
                 columns.add(order_by.name)
@@ -215,12 +374,22 @@ def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=
                 raise ValueError('cannot do this query, no indexes can be used')
 
             query_exprs = [e for e in exprs if e.name in using]
-            result = idx.underlying._do_query(query_exprs, order_by, limit)
-            retained_result = []
-            for x in result:
-                if all(e.check(x) for e in exprs):
-                    retained_result.append(cls.from_datastore(x))
-            return retained_result
+            recorder = cls._session.datastore.recorder
+            if recorder is None:
+                result = idx.underlying._do_query(query_exprs, order_by, limit)
+                rows = filter_rows(exprs, result, cls._schemaless_extractors, cls._schemaless_multi)
+                check_deadline()
+                return QueryResult(cls.from_datastore(x) for x in rows)
+
+            start = time.time()
+            result = idx.underlying._do_query(query_exprs, order_by, limit, record=False)
+            rows = filter_rows(exprs, result, cls._schemaless_extractors, cls._schemaless_multi)
+            residual = [e for e in exprs if e.name not in using]
+            sql = idx.underlying._compile_query(query_exprs, order_by, limit)
+            recorder.record('document', cls.__name__, idx.table_name, exprs, residual, order_by, limit, len(result), len(rows), time.time() - start,
+                            sql, idx.underlying._query_params(query_exprs, limit))
+            check_deadline()
+            return QueryResult(cls.from_datastore(x) for x in rows)
 
         @classmethod
         def get(cls, *exprs, **kwargs):
@@ -241,8 +410,24 @@ def make_base(session, meta_base=type, base_cls=object, tags_file=None, tags_db=
         def all(cls):
             return cls._query(c.tag == cls.tag)
 
+        @classmethod
+        def search(cls, text, prefix=False, limit=None, deadline=None):
+            """Find the documents containing all of the words in text, using
+            the first TextIndex in _indexes. See TextIndex.search.
+            """
+            for idx in cls._indexes:
+                if isinstance(idx, TextIndex):
+                    result = idx.underlying.search(text, prefix=prefix, limit=limit, deadline=deadline)
+                    return QueryResult(cls.from_datastore(x) for x in result)
+            raise ValueError('%s has no text index' % (cls.__name__,))
+
         @classmethod
         def by_id(cls, id):
+            if len(id) == 16:
+                id = id.encode('hex')
+            obj = cls._session.identity_map.get(id)
+            if obj is not None and obj.__class__ is cls:
+                return obj
             entity = cls._session.datastore.by_id(id)
             if not entity:
                 return entity
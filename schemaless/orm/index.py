@@ -6,20 +6,24 @@ class Index(object):
 
     log = ClassLogger()
 
-    def __init__(self, table_name, fields):
+    def __init__(self, table_name, fields, extract={}, multi=()):
         self.table_name = table_name
         self.fields = fields
         self.field_set = frozenset(fields)
+        self.extract = extract
+        self.multi = multi
         self.underlying = None
 
     @classmethod
-    def automatic(cls, tag, fields, datastore, declare=True):
+    def automatic(cls, tag, fields, datastore, declare=True, extract={}, multi=()):
         """This is an "internal" method for declaratively creating
         indexes. Arguments are like this:
 
         tag -- the tag of the document that this is being created for
         fields -- a list of typed Column objects like [Binary('foo', 16), VarChar('email', 255)]
         datastore -- a handle to the datastore
+        extract -- computed columns, see DataStore.define_index
+        multi -- the names of list valued fields, see DataStore.define_index
 
         A unique table name will be created using the tag and an md5 of the
         field names. The table will be created, if necessary.
@@ -31,11 +35,15 @@ class Index(object):
 
         if not datastore.check_table_exists(table_name):
             cls.log.info('Creating %s' % (table_name,))
-            sql = ['CREATE TABLE %s (' % (table_name,)]
+            sql = ['CREATE TABLE IF NOT EXISTS %s (' % (table_name,)]
             for f in fields:
                 sql.append('    %s,' % (f,))
             sql.append('    `entity_id` BINARY(16) NOT NULL,')
-            sql.append('    UNIQUE KEY (`entity_id`),')
+            if multi:
+                # there's a row per element, so entity_id isn't unique
+                sql.append('    KEY (`entity_id`),')
+            else:
+                sql.append('    UNIQUE KEY (`entity_id`),')
             sql.append('    PRIMARY KEY (%s, `entity_id`)' % (field_string,))
             sql.append(') ENGINE=InnoDB')
             sql = '\n'.join(sql)
@@ -53,8 +61,9 @@ class Index(object):
 
             # create the table
             datastore.connection.execute(sql)
+            datastore.catalog.add_table(table_name, [f.name for f in fields] + ['entity_id'])
 
-        obj = cls(table_name, [f.name for f in fields])
+        obj = cls(table_name, [f.name for f in fields], extract=extract, multi=multi)
         if declare:
             obj.declare(datastore, tag=tag)
         return obj
@@ -63,7 +72,8 @@ class Index(object):
         match_on = {}
         if tag is not None:
             match_on = {'tag': tag}
-        self.underlying = datastore.define_index(self.table_name, self.fields, match_on=match_on)
+        properties = [f for f in self.fields if f not in self.extract]
+        self.underlying = datastore.define_index(self.table_name, properties, match_on=match_on, extract=self.extract, multi=self.multi)
         return self.underlying
 
     def __str__(self):
@@ -73,6 +83,22 @@ class Index(object):
             return '%s(%s)' % (self.__class__.__name__, self.underlying)
     __repr__ = __str__
 
+class TextIndex(Index):
+    """A full text index on some string fields of a document, used by
+    Document.search. It isn't used by queries.
+    """
+
+    def __init__(self, table_name, fields):
+        super(TextIndex, self).__init__(table_name, fields)
+        self.field_set = frozenset()
+
+    def declare(self, datastore, tag=None):
+        match_on = {}
+        if tag is not None:
+            match_on = {'tag': tag}
+        self.underlying = datastore.define_text_index(self.table_name, self.fields, match_on=match_on)
+        return self.underlying
+
 class IndexCollection(object):
 
     log = ClassLogger()
@@ -1,10 +1,54 @@
+import weakref
+
 class Session(object):
 
     def __init__(self, datastore):
         self.datastore = datastore
         self.dirty_documents = set()
 
+        # entity id -> the document loaded (or saved) for it in this session;
+        # documents drop out once nothing else refers to them
+        self.identity_map = weakref.WeakValueDictionary()
+
+    def expunge(self, document):
+        """Forget a document, so that it will be fetched again the next time
+        it's loaded.
+        """
+        if document.id is not None and self.identity_map.get(document.id) is document:
+            del self.identity_map[document.id]
+        self.dirty_documents.discard(document)
+
+    def clear(self):
+        """Forget all of the documents loaded in this session (for instance,
+        at the end of a request). Unsaved changes are discarded.
+        """
+        self.identity_map.clear()
+        self.dirty_documents.clear()
+
     def save(self):
+        """Flush all of the dirty documents.
+
+        The documents are grouped by tag and by whether they're new or
+        updates, and each group is written with DataStore.put_many, all in one
+        transaction. A document that was changed several times since the last
+        flush is written once.
+        """
+        if not self.dirty_documents:
+            return
+
+        groups = {}
         for d in self.dirty_documents:
-            d.save(clear_session=False)
+            d._check_saveable()
+            if d.is_dirty:
+                groups.setdefault((d.tag, d.id is None), []).append(d)
+
+        # the documents are only marked saved once the transaction has
+        # committed, so that if it's rolled back they can be saved again
+        saved = []
+        with self.datastore.transaction():
+            for (tag, is_new), documents in sorted(groups.iteritems()):
+                entities = self.datastore.put_many([d.to_dict() for d in documents], tag)
+                saved.extend(zip(documents, entities))
+        for d, entity in saved:
+            d._mark_saved(entity)
         self.dirty_documents.clear()
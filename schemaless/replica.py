@@ -0,0 +1,221 @@
+import time
+import threading
+import itertools
+import contextlib
+
+import tornado.database
+
+from schemaless.log import ClassLogger
+
+class Replica(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.down_until = 0
+        self.checked_at = 0
+        # the highest primary binlog position it's known to have applied
+        self.confirmed_position = None
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, getattr(self.connection, 'host', '?'))
+    __repr__ = __str__
+
+class RoutedReader(object):
+    """Reads from a replica chosen up front by ReadRouter.route (or from the
+    primary if it's None), falling back to the primary like the router.
+    """
+
+    def __init__(self, router, replica):
+        self.router = router
+        self.replica = replica
+
+    def query(self, query, *parameters):
+        return self.router._read_on(self.replica, 'query', query, parameters)
+
+    def get(self, query, *parameters):
+        return self.router._read_on(self.replica, 'get', query, parameters)
+
+class _RouterState(threading.local):
+    """The read-your-writes state of a ReadRouter, which is kept per thread."""
+
+    def __init__(self):
+        self.last_write = 0
+        self.write_position = None
+        self.primary_only = 0
+
+class ReadRouter(object):
+    """Routes reads to read replicas, and everything else to the primary.
+
+    Replicas are used round-robin. A replica that raises an OperationalError
+    is marked down for retry_interval seconds, and the read is retried on the
+    primary. If max_replica_lag is set, each replica's replication lag is
+    checked (at most every check_interval seconds) and replicas lagging by more
+    than max_replica_lag seconds are skipped.
+
+    The read_your_writes option controls what happens to reads issued within
+    pin_time seconds of a write made through this router:
+
+      None -- nothing special, reads may not see the write yet
+      'pin' -- reads go to the primary
+      'position' -- reads go to a replica only after it has applied the
+                    primary's binlog position as of the last write (using
+                    MASTER_POS_WAIT), otherwise to the primary; the
+                    position each replica is known to have applied is
+                    remembered, so it's only waited for once
+
+    This state (and use_primary) is kept per thread, so each thread reads
+    its own writes without pinning the other threads to the primary.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, primary, replicas=[], read_your_writes=None, pin_time=1.0, max_replica_lag=None, check_interval=5.0, retry_interval=30.0, position_timeout=0.5):
+        if read_your_writes not in (None, 'pin', 'position'):
+            raise ValueError('Unknown read_your_writes mode %r' % (read_your_writes,))
+        self.primary = primary
+        self.replicas = [Replica(conn) for conn in replicas]
+        self.read_your_writes = read_your_writes
+        self.pin_time = pin_time
+        self.max_replica_lag = max_replica_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.position_timeout = position_timeout
+
+        self.state = _RouterState()
+        self.next_replica = itertools.count()
+
+    @property
+    def last_write(self):
+        """When the current thread last wrote through this router."""
+        return self.state.last_write
+
+    def note_write(self):
+        """Called after every write, for read-your-writes tracking."""
+        self.state.last_write = time.time()
+        self.state.write_position = None
+
+    @contextlib.contextmanager
+    def use_primary(self):
+        """Send all of the current thread's reads to the primary within the
+        with block.
+        """
+        self.state.primary_only += 1
+        try:
+            yield
+        finally:
+            self.state.primary_only -= 1
+
+    def _mark_down(self, replica, reason):
+        self.log.warning('marking %s down for %1.1f seconds: %s' % (replica, self.retry_interval, reason))
+        replica.down_until = time.time() + self.retry_interval
+
+    def _is_healthy(self, replica, now):
+        if replica.down_until > now:
+            return False
+        if self.max_replica_lag is not None and now - replica.checked_at >= self.check_interval:
+            replica.checked_at = now
+            try:
+                status = replica.connection.get('SHOW SLAVE STATUS')
+            except tornado.database.OperationalError, e:
+                self._mark_down(replica, e)
+                return False
+            lag = status and status.get('Seconds_Behind_Master')
+            if lag is None or lag > self.max_replica_lag:
+                self._mark_down(replica, 'replication lag is %s' % (lag,))
+                return False
+        return True
+
+    def _has_caught_up(self, replica):
+        state = self.state
+        if state.write_position is None:
+            status = self.primary.get('SHOW MASTER STATUS')
+            if not status:
+                # binary logging is off, so there's no position to wait for
+                return False
+            state.write_position = (status['File'], status['Position'])
+        # binlog file names have zero padded sequence numbers, so positions
+        # compare as tuples
+        if replica.confirmed_position is not None and replica.confirmed_position >= state.write_position:
+            return True
+        log_file, log_pos = state.write_position
+        try:
+            row = replica.connection.get('SELECT MASTER_POS_WAIT(%s, %s, %s) AS pos_wait', log_file, log_pos, self.position_timeout)
+        except tornado.database.OperationalError, e:
+            self._mark_down(replica, e)
+            return False
+        if row['pos_wait'] is None or row['pos_wait'] < 0:
+            return False
+        replica.confirmed_position = max(replica.confirmed_position, state.write_position)
+        return True
+
+    def choose(self):
+        """Return the replica to read from, or None to read from the
+        primary.
+        """
+        state = self.state
+        if not self.replicas or state.primary_only:
+            return None
+        now = time.time()
+        recent_write = self.read_your_writes and now - state.last_write < self.pin_time
+        if recent_write and self.read_your_writes == 'pin':
+            return None
+
+        for x in xrange(len(self.replicas)):
+            replica = self.replicas[self.next_replica.next() % len(self.replicas)]
+            if not self._is_healthy(replica, now):
+                continue
+            if recent_write and not self._has_caught_up(replica):
+                continue
+            return replica
+        return None
+
+    def replica_lag(self):
+        """Return the replication lag in seconds of the most lagged replica
+        that isn't marked down, or None if there are no replicas. A replica
+        that isn't replicating counts as infinitely far behind.
+        """
+        now = time.time()
+        lags = []
+        for replica in self.replicas:
+            if replica.down_until > now:
+                continue
+            try:
+                status = replica.connection.get('SHOW SLAVE STATUS')
+            except tornado.database.OperationalError, e:
+                self._mark_down(replica, e)
+                continue
+            lag = status and status.get('Seconds_Behind_Master')
+            lags.append(float('inf') if lag is None else lag)
+        return max(lags) if lags else None
+
+    def route(self):
+        """Choose where the current thread's next read goes, for a read that
+        may be shared with other threads (see schemaless.singleflight).
+        Returns (reader, route): reader has query and get methods, and route
+        is 'primary' or 'replica', or None if the read went to a replica
+        that had to catch up with this thread's last write, which another
+        thread's read can't stand in for.
+        """
+        replica = self.choose()
+        if replica is None:
+            return RoutedReader(self, None), 'primary'
+        if self.read_your_writes and time.time() - self.state.last_write < self.pin_time:
+            return RoutedReader(self, replica), None
+        return RoutedReader(self, replica), 'replica'
+
+    def _read(self, method, query, parameters):
+        return self._read_on(self.choose(), method, query, parameters)
+
+    def _read_on(self, replica, method, query, parameters):
+        if replica is not None:
+            try:
+                return getattr(replica.connection, method)(query, *parameters)
+            except tornado.database.OperationalError, e:
+                self._mark_down(replica, e)
+        return getattr(self.primary, method)(query, *parameters)
+
+    def query(self, query, *parameters):
+        return self._read('query', query, parameters)
+
+    def get(self, query, *parameters):
+        return self._read('get', query, parameters)
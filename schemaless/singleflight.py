@@ -0,0 +1,169 @@
+"""Coalescing of identical concurrent reads.
+
+With DataStore(single_flight=True), a by_id or index query that's issued
+while an identical one (the same id, or the same SQL and parameters) is
+already running in another thread waits for that one instead of going to
+MySQL itself. The first caller gets the result; the others get copies, so
+callers can still modify what they get back.
+
+MySQLdb connections can't be shared between threads, so threads usually
+have a DataStore each; they share reads by passing the same SingleFlight:
+
+    flight = schemaless.SingleFlight()
+    ds = schemaless.DataStore(..., single_flight=flight) # in each thread
+
+A read doesn't join a call that started before the current thread's most
+recent write, so that it can't miss that write, nor a call that was routed
+differently: reads sent to the primary only join reads sent to the
+primary, and a read sent to a replica that had to catch up with the
+thread's own write isn't shared at all. Reads inside a transaction are
+never coalesced. The deadline of the call that went to MySQL is its own: if
+it runs out, the reads that were waiting on it run again themselves, under
+their own deadlines.
+"""
+import copy
+import time
+import threading
+
+from schemaless.column import Entity
+from schemaless.deadline import DeadlineExceeded, current_deadline
+from schemaless.log import ClassLogger
+
+def copy_result(result):
+    """A copy of an entity, or a list of them, that shares nothing mutable
+    with the original.
+    """
+    if isinstance(result, list):
+        return [copy_result(x) for x in result]
+    if isinstance(result, Entity):
+        entity = result.__class__(copy.deepcopy(dict(result)))
+        entity.__dict__.update(result.__dict__)
+        return entity
+    return copy.deepcopy(result)
+
+class _Call(object):
+
+    __slots__ = ['started', 'event', 'result', 'error', 'followers']
+
+    def __init__(self):
+        self.started = time.time()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time; see the module docstring.
+    bypass, if given, is called with no arguments before each call, and
+    the call isn't coalesced if it returns true.
+    """
+
+    log = ClassLogger()
+
+    def __init__(self, bypass=None):
+        self.bypass = bypass
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # kind -> counts, where kind is the first element of the key
+            self.counters = {}
+
+    def _count(self, kind, name):
+        counter = self.counters.get(kind)
+        if counter is None:
+            counter = self.counters[kind] = {'calls': 0, 'executed': 0, 'coalesced': 0}
+        counter[name] += 1
+
+    def do(self, key, fn, not_before=0):
+        """Return fn(), or a copy of the result of an identical call (with
+        the same key) that's in flight and started at or after not_before.
+        key is a tuple whose first element names the kind of call, for the
+        counters.
+        """
+        if self.bypass is not None and self.bypass():
+            return fn()
+        try:
+            hash(key)
+        except TypeError:
+            return fn()
+
+        with self.lock:
+            self._count(key[0], 'calls')
+            call = self.calls.get(key)
+            if call is not None and call.started >= not_before:
+                call.followers += 1
+                self._count(key[0], 'coalesced')
+                leader = False
+            else:
+                call = _Call()
+                if key not in self.calls:
+                    self.calls[key] = call
+                self._count(key[0], 'executed')
+                leader = True
+
+        if not leader:
+            return self._follow(call, fn)
+
+        try:
+            call.result = fn()
+        except Exception, e:
+            call.error = e
+        with self.lock:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+            followers = call.followers
+        call.event.set()
+        if call.error is not None:
+            raise call.error
+        # the followers copy call.result, so the caller mustn't get it
+        return copy_result(call.result) if followers else call.result
+
+    def _follow(self, call, fn):
+        deadline = current_deadline()
+        if deadline is None:
+            call.event.wait()
+        elif not call.event.wait(max(deadline.remaining(), 0)):
+            raise DeadlineExceeded('deadline of %1.3f seconds exceeded waiting for a coalesced read' % (deadline.timeout,))
+        if isinstance(call.error, DeadlineExceeded):
+            # the leader ran out of time, which says nothing about ours
+            return fn()
+        if call.error is not None:
+            raise call.error
+        return copy_result(call.result)
+
+    def snapshot(self):
+        """Return the counters as plain data, like:
+
+            {'by_id': {'calls': 100, 'executed': 10, 'coalesced': 90},
+             'query': {...}}
+        """
+        with self.lock:
+            return dict((kind, dict(counter)) for kind, counter in self.counters.iteritems())
+
+class SharedReads(object):
+    """A DataStore's reads through a SingleFlight, which may be shared with
+    the other DataStores for the same database. The read is routed (see
+    ReadRouter.route) before it's coalesced, and the route is part of the
+    key.
+    """
+
+    def __init__(self, flight, router, scope, bypass):
+        self.flight = flight
+        self.router = router
+        # tells the datastores sharing the flight apart
+        self.scope = scope
+        self.bypass = bypass
+
+    def do(self, key, fn):
+        """Return fn(reader), or a copy of the result of an identical read.
+        key is as for SingleFlight.do.
+        """
+        if self.bypass():
+            return fn(self.router)
+        reader, route = self.router.route()
+        if route is None:
+            return fn(reader)
+        return self.flight.do((key[0], self.scope, route) + tuple(key[1:]), lambda: fn(reader), self.router.last_write)
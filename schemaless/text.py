@@ -0,0 +1,133 @@
+"""Full text search over string properties.
+
+A TextIndex splits the fields it indexes into lowercased word tokens when
+entities are written, and keeps one (token, entity_id) row per distinct
+token. Searches for several words intersect their rows in SQL, with a self
+join per word, and the matching entities are then fetched with one query.
+"""
+import re
+import time
+
+from schemaless.column import Entity
+from schemaless.deadline import deadline_scope
+from schemaless.index import Index, entities_in_sql, not_expired
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text, max_length=64):
+    """Split some text into a list of distinct lowercased words, in the
+    order they first appear. Words longer than max_length are truncated.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    seen = set()
+    tokens = []
+    for token in _token_re.findall(text.lower()):
+        token = token[:max_length]
+        if token not in seen:
+            seen.add(token)
+            tokens.append(token)
+    return tokens
+
+def _like_prefix(token):
+    return token.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+class TextIndex(Index):
+    """An index of the words in some string fields, e.g.
+
+        post_text = datastore.define_text_index('text_post', ['title', 'content'], match_on={'tag': POST_TAG})
+        post_text.search('mysql replication')
+        post_text.search('mysql repl', prefix=True)
+
+    Entities that have none of the fields aren't indexed. Fields holding a
+    list of strings are indexed too.
+    """
+
+    def __init__(self, table, fields, match_on={}, connection=None, use_zlib=True, router=None, chunks=None, max_token_length=64):
+        self.fields = list(fields)
+        self.max_token_length = max_token_length
+        super(TextIndex, self).__init__(table, match_on=match_on, connection=connection, use_zlib=use_zlib, router=router, chunks=chunks, extract={'token': self.tokens}, multi=['token'])
+        self.source_fields |= frozenset(self.fields)
+        self._search_cache = {}
+
+    def __str__(self):
+        return '%s(table=%s, fields=%s, match_on=%s)' % (self.__class__.__name__, self.table, self.fields, self.match_on)
+    __repr__ = __str__
+
+    def create_table(self):
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS %s (
+                token VARCHAR(%d) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
+                entity_id BINARY(16) NOT NULL,
+                PRIMARY KEY (token, entity_id),
+                KEY (entity_id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8""" % (self.table, self.max_token_length))
+
+    def tokens(self, entity):
+        """The tokens for an entity, or None if it has none of the fields."""
+        texts = []
+        for field in self.fields:
+            val = entity.get(field)
+            if isinstance(val, basestring):
+                texts.append(val)
+            elif isinstance(val, (list, tuple)):
+                texts.extend(v for v in val if isinstance(v, basestring))
+        if not texts:
+            return None
+        return tokenize(' '.join(texts), self.max_token_length)
+
+    def _search_sql(self, num_terms, prefix, limit):
+        key = (num_terms, prefix, bool(limit))
+        try:
+            return self._search_cache[key]
+        except KeyError:
+            pass
+
+        joins = ['%s t0' % (self.table,)]
+        where = []
+        for i in xrange(num_terms):
+            if i:
+                joins.append('JOIN %s t%d ON t%d.entity_id = t0.entity_id' % (self.table, i, i))
+            if prefix and i == num_terms - 1:
+                where.append('t%d.token LIKE %%s' % (i,))
+            else:
+                where.append('t%d.token = %%s' % (i,))
+        if self.skip_expired:
+            where.append('NOT EXISTS (SELECT 1 FROM entity_expiry WHERE entity_expiry.entity_id = t0.entity_id AND entity_expiry.expires_at <= %s)')
+        # entities is joined so that the limit applies to the newest matches
+        joins.append('JOIN entities e ON e.id = t0.entity_id')
+        # a prefix can match several tokens of the same entity
+        q = 'SELECT %st0.entity_id, e.updated FROM %s WHERE %s ORDER BY e.updated DESC' % ('DISTINCT ' if prefix else '', ' '.join(joins), ' AND '.join(where))
+        if limit:
+            q += ' LIMIT %s'
+        self._search_cache[key] = q
+        return q
+
+    def search(self, text, prefix=False, limit=None, deadline=None):
+        """Find the entities that contain all of the words in text, newest
+        first. If prefix is true the last word only has to be the start of
+        a word, for search as you type.
+        """
+        with deadline_scope(deadline):
+            return self._search(text, prefix, limit)
+
+    def _search(self, text, prefix, limit):
+        terms = tokenize(text, self.max_token_length)
+        if not terms:
+            return []
+        vals = terms[:-1] + [_like_prefix(terms[-1]) if prefix else terms[-1]]
+        if self.skip_expired:
+            vals.append(int(time.time()))
+        if limit:
+            vals.append(int(limit))
+        # _fetch reads on past the entities that turn out to have expired
+        return self._fetch(self._search_sql(len(terms), prefix, limit), vals, None, limit)
+
+    def _fetch_page(self, q, values, order_by, reader):
+        rows = reader.query(q, *values)
+        if not rows:
+            return [], 0
+        entity_ids = [r['entity_id'] for r in rows]
+        entity_rows = reader.query(entities_in_sql(len(entity_ids)), *entity_ids)
+        rows_by_id = dict((row['id'], row) for row in entity_rows)
+        return not_expired([Entity.from_row(rows_by_id[i], use_zlib=self.use_zlib, chunks=self.chunks) for i in entity_ids if i in rows_by_id]), len(rows)
@@ -0,0 +1,202 @@
+from schemaless.column import Entity
+from schemaless.log import ClassLogger
+
+class View(object):
+    """A denormalized aggregate over entities, kept up to date as entities are
+    put and deleted, so that reading it is a single-row lookup.
+
+    Entities that match (all of the group_by properties are present, the
+    match_on properties have the given values, and the where function, if
+    any, returns true) contribute to the row for their group_by values. The
+    aggregate is one of:
+
+      'count' -- the number of matching entities
+      'sum' -- the sum of the field property
+      'max' -- the largest value of the field property
+      'latest' -- the largest value of the field property, and the id of the
+                  entity that has it
+
+    'count' and 'sum' are maintained exactly. 'max' and 'latest' only ever
+    grow, since a delete (or an update that lowers the value) can't be undone
+    without looking at the other entities in the group; use rebuild() to
+    recompute them.
+
+    The table has to exist already; for a view of comments per post it could
+    look like:
+
+        CREATE TABLE view_comment_count (
+            post_id CHAR(32) NOT NULL,
+            value BIGINT NOT NULL,
+            PRIMARY KEY (post_id)
+        ) ENGINE=InnoDB
+
+    and a 'latest' view needs an extra `entity_id BINARY(16)` column.
+    """
+
+    log = ClassLogger()
+
+    aggregates = ('count', 'sum', 'max', 'latest')
+
+    def __init__(self, table, group_by, aggregate='count', field=None, match_on={}, where=None, connection=None, router=None, use_zlib=True, chunks=None, transaction=None):
+        if aggregate not in self.aggregates:
+            raise ValueError('Unknown aggregate %r' % (aggregate,))
+        if aggregate != 'count' and field is None:
+            raise ValueError('The %r aggregate needs a field' % (aggregate,))
+        self.table = table
+        self.group_by = list(group_by)
+        self.aggregate = aggregate
+        self.field = field
+        self.match_on = match_on
+        self.where = where
+        self.connection = connection
+        self.router = router
+        self.use_zlib = use_zlib
+        self.chunks = chunks
+        self.transaction = transaction
+
+        # the properties the view reads (apart from in where)
+        self.source_fields = frozenset(self.group_by + ([field] if field is not None else []) + list(match_on))
+
+        columns = self.group_by + ['value']
+        if aggregate == 'latest':
+            columns.append('entity_id')
+        q = 'INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE ' % (table, ', '.join(columns), ', '.join('%s' for x in columns))
+        if aggregate in ('count', 'sum'):
+            q += 'value = value + VALUES(value)'
+        elif aggregate == 'max':
+            q += 'value = GREATEST(value, VALUES(value))'
+        else:
+            # assignments are made left to right, so entity_id has to be
+            # compared against the old value
+            q += 'entity_id = IF(VALUES(value) >= value, VALUES(entity_id), entity_id), value = GREATEST(value, VALUES(value))'
+        self.upsert_sql = q
+        self.select_sql = 'SELECT * FROM %s WHERE %s' % (table, ' AND '.join('%s = %%s' % (g,) for g in self.group_by))
+
+    def __str__(self):
+        return '%s(table=%s, group_by=%s, aggregate=%s, field=%s)' % (self.__class__.__name__, self.table, self.group_by, self.aggregate, self.field)
+    __repr__ = __str__
+
+    def matches(self, entity):
+        for g in self.group_by:
+            if entity.get(g) is None:
+                return False
+        if self.field is not None and entity.get(self.field) is None:
+            return False
+        for k, v in self.match_on.iteritems():
+            if entity.get(k) != v:
+                return False
+        return self.where is None or self.where(entity)
+
+    def _contribution(self, entity):
+        if entity is None or not self.matches(entity):
+            return None
+        key = tuple(entity[g] for g in self.group_by)
+        value = 1 if self.aggregate == 'count' else entity[self.field]
+        return key, value
+
+    def _upsert(self, key, value, entity_id):
+        vals = list(key) + [value]
+        if self.aggregate == 'latest':
+            vals.append(entity_id)
+        self.connection.execute(self.upsert_sql, *vals)
+
+    def apply(self, entity_id, old, new):
+        """Update the view for a change to an entity. old is the entity
+        before the change (None for an insert) and new is the entity after
+        it (None for a delete). entity_id is the raw id.
+        """
+        old_c = self._contribution(old)
+        new_c = self._contribution(new)
+        if old_c == new_c:
+            return
+        if self.aggregate in ('count', 'sum'):
+            if old_c and new_c and old_c[0] == new_c[0]:
+                self._upsert(new_c[0], new_c[1] - old_c[1], entity_id)
+                return
+            if old_c:
+                self._upsert(old_c[0], -old_c[1], entity_id)
+        if new_c:
+            self._upsert(new_c[0], new_c[1], entity_id)
+
+    def row(self, *key):
+        """Return the row for the group with the given group_by values (in
+        the order of group_by), or None.
+        """
+        if len(key) != len(self.group_by):
+            raise ValueError('Expected values for %s' % (', '.join(self.group_by),))
+        reader = self.router if self.router is not None else self.connection
+        return reader.get(self.select_sql, *key)
+
+    def get(self, *key):
+        """Return the aggregate value for a group: a number for 'count',
+        'sum' and 'max' (0 or None for an empty group), and the (hex) id of
+        the latest entity for 'latest'.
+        """
+        row = self.row(*key)
+        if self.aggregate == 'latest':
+            return row['entity_id'].encode('hex') if row else None
+        if row is None:
+            return 0 if self.aggregate in ('count', 'sum') else None
+        return row['value']
+
+    def get_many(self, keys):
+        """Like get, for a list of group_by value tuples, with one query.
+        Returns a dict keyed by the tuples.
+        """
+        keys = [tuple(k) for k in keys]
+        if not keys:
+            return {}
+        q = 'SELECT * FROM %s WHERE (%s) IN (%s)' % (self.table, ', '.join(self.group_by), ', '.join('(%s)' % (', '.join('%s' for g in self.group_by),) for k in keys))
+        vals = []
+        for k in keys:
+            vals.extend(k)
+        reader = self.router if self.router is not None else self.connection
+        found = dict((tuple(row[g] for g in self.group_by), row) for row in reader.query(q, *vals))
+        result = {}
+        for k in keys:
+            row = found.get(k)
+            if self.aggregate == 'latest':
+                result[k] = row['entity_id'].encode('hex') if row else None
+            elif row is None:
+                result[k] = 0 if self.aggregate in ('count', 'sum') else None
+            else:
+                result[k] = row['value']
+        return result
+
+    def rebuild(self, batch_size=1000):
+        """Recompute the whole view from the entities table, a batch of rows
+        at a time, in one transaction. The DELETE of the old rows locks the
+        view table, so puts that would change it wait for the rebuild, and
+        the rows are read from the snapshot taken after it (with InnoDB's
+        default REPEATABLE READ isolation); so concurrent writes are
+        neither lost nor counted twice, but they're held up until the
+        rebuild is done.
+        """
+        with self.transaction():
+            self._rebuild(batch_size)
+
+    def _rebuild(self, batch_size):
+        self.connection.execute('DELETE FROM %s' % (self.table,))
+        next_row = 0
+        while True:
+            rows = self.connection.query('SELECT * FROM entities WHERE added_id >= %s ORDER BY added_id ASC LIMIT %s', next_row, batch_size)
+            if not rows:
+                break
+            groups = {}
+            for row in rows:
+                entity = Entity.from_row(row, use_zlib=self.use_zlib, chunks=self.chunks)
+                # the tag is stored in its own column, see DataStore._apply_views
+                entity.setdefault('tag', row['tag'])
+                c = self._contribution(entity)
+                if c is None:
+                    continue
+                key, value = c
+                if key not in groups:
+                    groups[key] = (value, row['id'])
+                elif self.aggregate in ('count', 'sum'):
+                    groups[key] = (groups[key][0] + value, None)
+                elif value >= groups[key][0]:
+                    groups[key] = (value, row['id'])
+            for key, (value, entity_id) in groups.iteritems():
+                self._upsert(key, value, entity_id)
+            next_row = rows[-1]['added_id'] + 1
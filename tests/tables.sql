@@ -26,9 +26,30 @@ CREATE TABLE IF NOT EXISTS `index_user_name` (
   UNIQUE KEY `entity_id` (`entity_id`)
 ) ENGINE=InnoDB;
 
+CREATE TABLE IF NOT EXISTS `index_city` (
+  `entity_id` binary(16) NOT NULL,
+  `city` varchar(255) NOT NULL,
+  `email` varchar(255) NOT NULL,
+  PRIMARY KEY (`city`,`email`,`entity_id`),
+  UNIQUE KEY `entity_id` (`entity_id`)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS `index_tags` (
+  `entity_id` binary(16) NOT NULL,
+  `tags` varchar(255) NOT NULL,
+  PRIMARY KEY (`tags`,`entity_id`),
+  KEY `entity_id` (`entity_id`)
+) ENGINE=InnoDB;
+
 CREATE TABLE IF NOT EXISTS `index_todo_user_id` (
   `entity_id` binary(16) NOT NULL,
   `user_id` char(32) NOT NULL,
   PRIMARY KEY (`user_id`,`entity_id`),
   UNIQUE KEY `entity_id` (`entity_id`)
 ) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS `view_user_count` (
+  `user_id` char(32) NOT NULL,
+  `value` bigint(20) NOT NULL,
+  PRIMARY KEY (`user_id`)
+) ENGINE=InnoDB;
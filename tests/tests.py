@@ -1,10 +1,12 @@
 import datetime
 import logging
+import time
 import unittest
 
 import schemaless
 from schemaless import orm
 from schemaless import c
+from schemaless.column import filter_rows, make_extractor, MISSING
 
 class TestBase(unittest.TestCase):
 
@@ -29,6 +31,29 @@ class TestBase(unittest.TestCase):
         if index.table_name != name:
             self.assert_(False, 'Expected to use index %s but actually used %s' % (name, index.table_name))
 
+class ColumnTestCase(TestBase):
+
+    def test_filter_rows(self):
+        rows = [{'a': x, 'b': str(x % 3)} for x in range(10)]
+        self.assert_equal([5, 6], [r['a'] for r in filter_rows([c.a > 4, c.a <= 6], rows)])
+        self.assert_equal([0, 3, 6, 9], [r['a'] for r in filter_rows([c.b.in_(['0'])], rows)])
+        self.assert_equal([], filter_rows([c.a > 4, c.a < 3], rows))
+        assert (c.a.in_([[1], [2]])).check({'a': [2]})
+        assert (c.a != None).check({'a': 0})
+
+    def test_filter_rows_extracted(self):
+        rows = [{'a': {'b': x}} for x in range(5)] + [{'a': None}, {}]
+        extractors = {'ab': make_extractor('a.b')}
+        self.assert_equal([3, 4], [r['a']['b'] for r in filter_rows([c.ab > 2], rows, extractors)])
+        lower = make_extractor(lambda e: e['email'].lower())
+        self.assert_equal('foo@example.com', lower({'email': 'Foo@Example.com'}))
+        assert lower({}) is MISSING
+
+    def test_filter_rows_multi(self):
+        rows = [{'tags': ['a', 'b']}, {'tags': ['c']}, {'tags': []}, {'tags': 'a'}]
+        self.assert_equal([rows[0], rows[3]], filter_rows([c.tags == 'a'], rows, multi=['tags']))
+        self.assert_equal([rows[0], rows[1]], filter_rows([c.tags.in_(['b', 'c'])], rows, multi=['tags']))
+
 class SchemalessTestCase(TestBase):
 
     def setUp(self):
@@ -57,6 +82,177 @@ class SchemalessTestCase(TestBase):
         self.ds.delete(id=self.entity.id)
         self.assert_len(0, self.user.query(c.user_id == self.entity.user_id))
 
+    def test_delete_many(self):
+        entities = [self.ds.put({'user_id': schemaless.guid(), 'first_name': 'a', 'last_name': 'b'}) for x in xrange(3)]
+        self.assert_equal(2, self.ds.delete_many([e.id for e in entities[:2]]))
+        self.assert_equal(1, self.ds.delete_many([entities[2].id], tombstone=True))
+        for e in entities:
+            self.assert_equal(None, self.ds.by_id(e.id))
+            self.assert_len(0, self.user.query(c.user_id == e.user_id))
+        self.assert_len(1, self.ds.connection.query('SELECT * FROM index_user_id WHERE user_id = %s', entities[2].user_id))
+
+        self.assert_equal(2, schemaless.TombstonePurger(self.ds, pause=0).run())
+        self.assert_len(0, self.ds.connection.query('SELECT * FROM index_user_id WHERE user_id = %s', entities[2].user_id))
+        self.assert_len(1, self.user_name.query(c.first_name == 'evan'))
+
+    def test_extracted_index(self):
+        city = self.ds.define_index('index_city', extract={'city': 'address.city', 'email': lambda e: e['email'].lower()})
+        entity = self.ds.put({'email': 'Evan@Example.com', 'address': {'city': 'sf'}})
+        self.ds.put({'email': 'evan@example.com'}) # no city, not indexed
+        self.assert_equal([entity.id], [e.id for e in city.query(c.city == 'sf', c.email == 'evan@example.com')])
+
+        entity['address'] = {'city': 'oakland'}
+        self.ds.put(entity)
+        self.assert_len(0, city.query(c.city == 'sf'))
+        self.assert_len(1, city.query(c.city == 'oakland'))
+        if self.ds.versioned:
+            self.ds.update(entity.id, {'address': {'city': 'berkeley'}})
+            self.assert_len(0, city.query(c.city == 'oakland'))
+            self.assert_len(1, city.query(c.city == 'berkeley'))
+        self.ds.delete(id=entity.id)
+        self.assert_len(0, city.query(c.city.in_(['oakland', 'berkeley'])))
+
+    def test_multi_index(self):
+        tags = self.ds.define_index('index_tags', ['tags'], multi=['tags'])
+        entity = self.ds.put({'tags': ['a', 'b', 'a']})
+        other = self.ds.put({'tags': ['b']})
+        self.assert_len(2, self.ds.connection.query('SELECT * FROM index_tags WHERE entity_id = %s', entity.id.decode('hex')))
+        self.assert_equal([entity.id], [e.id for e in tags.query(c.tags == 'a')])
+        self.assert_len(2, tags.query(c.tags.in_(['a', 'b'])))
+        # the limit counts entities, not index rows
+        self.assert_len(2, tags.query(c.tags.in_(['a', 'b']), limit=2))
+        self.assert_len(2, tags.query(c.tags.in_(['a', 'b']), order_by='tags', limit=2))
+
+        entity['tags'] = ['b', 'c']
+        self.ds.put(entity)
+        self.assert_len(0, tags.query(c.tags == 'a'))
+        self.assert_equal([entity.id], [e.id for e in tags.query(c.tags == 'c')])
+        self.ds.delete(id=other.id)
+        self.assert_len(1, tags.query(c.tags == 'b'))
+
+    def test_recorder(self):
+        from schemaless.advisor import suggest_fields
+        self.assert_equal(['b', 'a', 'c'], suggest_fields([('a', '>'), ('b', '='), ('c', '<')], ('c', 'ASC')))
+
+        recorder = self.ds.enable_recorder()
+        self.user.query(c.user_id == self.entity.user_id)
+        self.user.query(c.user_id == schemaless.guid())
+        shapes = recorder.snapshot()
+        self.assert_len(1, shapes)
+        self.assert_equal(2, shapes[0]['count'])
+        self.assert_equal(1, shapes[0]['fetched'])
+        self.assert_equal([('user_id', '=')], shapes[0]['columns'])
+
+    def test_deadline(self):
+        self.assert_len(1, self.user.query(c.user_id == self.entity.user_id, deadline=5))
+        with schemaless.deadline_scope(0.001):
+            time.sleep(0.01)
+            self.assertRaises(schemaless.DeadlineExceeded, self.user.query, c.user_id == self.entity.user_id)
+        with schemaless.deadline_scope(5):
+            with schemaless.deadline_scope(10) as deadline:
+                assert deadline.remaining() <= 5
+
+    def test_single_flight(self):
+        import threading
+        from schemaless.singleflight import SingleFlight
+        flight = SingleFlight()
+        started = threading.Event()
+        def slow_read():
+            started.set()
+            time.sleep(0.05)
+            return [schemaless.Entity(id='a', tags=['x'])]
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do(('query', 'a'), slow_read)))
+        leader.start()
+        started.wait()
+        results.append(flight.do(('query', 'a'), slow_read))
+        leader.join()
+        self.assert_equal(results[0], results[1])
+        assert results[0][0] is not results[1][0]
+        self.assert_equal({'query': {'calls': 2, 'executed': 1, 'coalesced': 1}}, flight.snapshot())
+
+        # a follower isn't failed by the leader's deadline
+        def timed_out_read():
+            started.set()
+            time.sleep(0.05)
+            raise schemaless.DeadlineExceeded('leader timed out')
+        started.clear()
+        errors = []
+        def lead():
+            try:
+                flight.do(('query', 'b'), timed_out_read)
+            except schemaless.DeadlineExceeded, e:
+                errors.append(e)
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait()
+        self.assert_equal(['ok'], flight.do(('query', 'b'), lambda: ['ok']))
+        leader.join()
+        self.assert_len(1, errors)
+
+        ds = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test', single_flight=True)
+        self.assert_equal(self.entity.user_id, ds.by_id(self.entity.id).user_id)
+        self.assert_equal(1, ds.single_flight.snapshot()['by_id']['executed'])
+        # datastores in other threads share reads through the same flight
+        other = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test', single_flight=ds.single_flight)
+        self.assert_equal(self.entity.user_id, other.by_id(self.entity.id).user_id)
+        self.assert_equal(2, ds.single_flight.snapshot()['by_id']['executed'])
+
+    def test_id_filter(self):
+        import os
+        import tempfile
+        from schemaless.bloom import BloomFilter
+        bloom = BloomFilter(1000, 0.01)
+        for x in xrange(1000):
+            bloom.add(str(x))
+        assert all(str(x) in bloom for x in xrange(1000))
+        assert sum(1 for x in xrange(1000, 11000) if str(x) in bloom) < 300
+
+        path = os.path.join(tempfile.mkdtemp(), 'ids.bloom')
+        id_filter = self.ds.enable_id_filter(path, capacity=1000, refresh_interval=None)
+        assert self.entity.id.decode('hex') in id_filter.bloom
+        self.assert_equal(self.entity.user_id, self.ds.by_id(self.entity.id).user_id)
+        entity = self.ds.put({'user_id': schemaless.guid()})
+        self.assert_equal(entity.user_id, self.ds.by_id(entity.id).user_id)
+
+        # a missing id is answered by the filter, without any statements
+        events = []
+        self.ds.add_query_hook(before=events.append)
+        self.assert_equal(None, self.ds.by_id(schemaless.guid()))
+        self.assert_len(0, events)
+        # unless it's too stale to rule the id out, or reads are pinned
+        id_filter.refreshed_at -= id_filter.max_staleness + 1
+        self.assert_equal(None, self.ds.by_id(schemaless.guid()))
+        self.assert_len(1, events)
+        id_filter.refresh()
+        with self.ds.use_primary():
+            assert id_filter.might_exist(schemaless.guid().decode('hex'))
+        self.ds.remove_query_hook(before=events.append)
+
+        id_filter.save()
+        loaded, added_id = BloomFilter.load(path)
+        self.assert_equal(id_filter.bloom.bits, loaded.bits)
+        self.assert_equal(id_filter.added_id, added_id)
+
+    def test_text_index(self):
+        self.assert_equal([u'hello', u'world'], schemaless.text.tokenize('Hello, world! hello'))
+        text = self.ds.define_text_index('text_post', ['title', 'content'])
+        post = self.ds.put({'title': 'MySQL replication', 'content': 'Setting up a replica'})
+        self.ds.put({'title': 'MySQL backups', 'content': 'Use mysqldump'})
+        self.assert_len(2, text.search('mysql'))
+        self.assert_equal([post.id], [e.id for e in text.search('replica mysql')])
+        self.assert_equal([post.id], [e.id for e in text.search('mysql repl', prefix=True)])
+        self.assert_len(0, text.search('mysql postgres'))
+
+        post['title'] = 'Postgres replication'
+        self.ds.put(post)
+        self.assert_len(1, text.search('mysql'))
+        self.assert_len(1, text.search('postgres'))
+
+        # distinct tokens that a case and accent insensitive collation would treat as equal
+        self.ds.put({'title': u'resume r\xe9sum\xe9'})
+        self.assert_len(1, text.search(u'r\xe9sum\xe9'))
+
     def test_match_on(self):
         entity_one = self.ds.put({'foo_id': schemaless.guid(), 'bar': 1, 'm': 'left'})
         entity_two = self.ds.put({'foo_id': schemaless.guid(), 'bar': 1, 'm': 'right'}) # only this should match
@@ -73,6 +269,374 @@ class SchemalessTestCase(TestBase):
         self.assert_len(2, rows)
         self.assert_equal(set(user_ids), set(row['user_id'] for row in rows))
 
+    def test_query_stats(self):
+        stats = self.ds.enable_stats()
+        events = []
+        self.ds.add_query_hook(after=events.append)
+        self.user.query(c.user_id == self.entity.user_id)
+        self.ds.remove_query_hook(after=events.append)
+
+        self.assert_equal(['index_user_id', 'entities'], [e.table for e in events])
+        snapshot = stats.snapshot()
+        self.assert_equal(1, snapshot['tables']['index_user_id']['SELECT']['count'])
+        self.assert_equal(1, snapshot['tables']['index_user_id']['SELECT']['rows'])
+        self.assert_equal(1, snapshot['tables']['entities']['SELECT']['rows'])
+
+    def test_schema_catalog(self):
+        events = []
+        self.ds.add_query_hook(after=events.append)
+        assert self.ds.check_table_exists('index_user_id')
+        assert self.ds.check_table_exists('index_user_name')
+        self.assert_len(0, events)
+        assert not self.ds.check_table_exists('index_does_not_exist') # looked up in case it was created since
+        self.ds.remove_query_hook(after=events.append)
+        self.assert_len(1, events)
+        assert self.ds.catalog.has_column('entities', 'body')
+
+    def test_schema_cache(self):
+        import os
+        import tempfile
+        from schemaless.catalog import SchemaCatalog
+        path = os.path.join(tempfile.mkdtemp(), 'schema.json')
+        conn = self.ds.connection
+        conn.execute('CREATE TABLE IF NOT EXISTS catalog_test (a INT)')
+        try:
+            SchemaCatalog(conn, database='test', cache_file=path).load()
+
+            # the cache is checked against the server's fingerprint, and used
+            events = []
+            self.ds.add_query_hook(after=events.append)
+            catalog = SchemaCatalog(conn, database='test', cache_file=path)
+            assert catalog.has_table('catalog_test')
+            assert not catalog.has_column('catalog_test', 'b')
+            self.assert_len(1, events)
+
+            # a changed fingerprint makes it load the metadata again
+            conn.execute('ALTER TABLE catalog_test ADD COLUMN b INT')
+            del events[:]
+            catalog = SchemaCatalog(conn, database='test', cache_file=path)
+            assert catalog.has_column('catalog_test', 'b')
+            self.assert_len(2, events)
+            self.ds.remove_query_hook(after=events.append)
+            self.assert_equal(catalog.fingerprint, catalog.server_fingerprint())
+        finally:
+            conn.execute('DROP TABLE catalog_test')
+
+    def test_update(self):
+        if not self.ds.versioned:
+            self.skipTest('entities table has no version column')
+        version = self.entity.version
+        entity = self.ds.update(self.entity.id, {'first_name': 'george'})
+        self.assert_equal(version + 1, entity.version)
+        self.assert_equal(self.entity.user_id, entity.user_id)
+        self.assert_len(1, self.user_name.query(c.first_name == 'george', c.last_name == 'klitzke'))
+        self.assert_len(0, self.user_name.query(c.first_name == 'evan'))
+
+        self.assertRaises(schemaless.ConflictError, self.ds.update, self.entity.id, {'first_name': 'evan'}, expected_version=version)
+        entity = self.ds.update(self.entity.id, {}, remove=['last_name'], expected_version=version + 1)
+        self.assert_len(0, self.user_name.query(c.first_name == 'george'))
+        assert 'last_name' not in self.ds.by_id(self.entity.id)
+
+    def test_unchanged_put(self):
+        events = []
+        self.ds.add_query_hook(after=events.append)
+        self.ds.put(self.entity)
+        self.assert_equal(['SELECT'], [e.operation for e in events])
+
+        del events[:]
+        self.entity.last_name = 'smith'
+        self.ds.put(self.entity)
+        self.ds.remove_query_hook(after=events.append)
+        self.assert_equal(['entities', 'index_user_name'], [e.table for e in events if e.operation == 'UPDATE'])
+        self.assert_len(1, self.user_name.query(c.first_name == 'evan', c.last_name == 'smith'))
+
+        # a missing index row is added back by the next put that changes it
+        self.ds.connection.execute('DELETE FROM index_user_name WHERE entity_id = %s', self.entity.id.decode('hex'))
+        self.entity.last_name = 'jones'
+        self.ds.put(self.entity)
+        self.assert_len(1, self.user_name.query(c.first_name == 'evan', c.last_name == 'jones'))
+
+    def test_counter(self):
+        likes = self.ds.define_counter('counter_test_likes', shards=4)
+        likes.delete('a')
+        likes.delete('b')
+        for x in xrange(10):
+            likes.incr('a')
+        likes.incr_many({'a': 5, 'b': 2})
+        likes.decr('b')
+        self.assert_equal(15, likes.get('a'))
+        self.assert_equal({'a': 15, 'b': 1, 'c': 0}, likes.get_many(['a', 'b', 'c']))
+
+class FakeConnection(object):
+    """Stands in for a tornado.database.Connection. Reads are answered by
+    respond(query, parameters), and every statement is recorded.
+    """
+
+    def __init__(self, respond=None):
+        self.respond = respond or (lambda query, parameters: None)
+        self.statements = []
+
+    def query(self, query, *parameters):
+        self.statements.append(query)
+        return self.respond(query, parameters)
+    get = query
+    execute = query
+
+class ReadRouterTestCase(TestBase):
+
+    def respond(self, name):
+        return lambda query, parameters: {'name': name}
+
+    def test_routing(self):
+        from schemaless.replica import ReadRouter
+        primary = FakeConnection(self.respond('primary'))
+        replicas = [FakeConnection(self.respond('r0')), FakeConnection(self.respond('r1'))]
+        router = ReadRouter(primary, replicas)
+        self.assert_equal(['r0', 'r1', 'r0'], [router.get('SELECT')['name'] for x in xrange(3)])
+        with router.use_primary():
+            self.assert_equal('primary', router.get('SELECT')['name'])
+        self.assert_equal('primary', ReadRouter(primary).get('SELECT')['name'])
+
+    def test_fallback(self):
+        import tornado.database
+        from schemaless.replica import ReadRouter
+        def broken(query, parameters):
+            raise tornado.database.OperationalError('gone away')
+        replica = FakeConnection(broken)
+        router = ReadRouter(FakeConnection(self.respond('primary')), [replica])
+        self.assert_equal('primary', router.get('SELECT')['name'])
+        # the replica is marked down, and not tried again for a while
+        self.assert_equal('primary', router.get('SELECT')['name'])
+        self.assert_len(1, replica.statements)
+
+    def test_pin(self):
+        import threading
+        from schemaless.replica import ReadRouter
+        router = ReadRouter(FakeConnection(self.respond('primary')), [FakeConnection(self.respond('replica'))], read_your_writes='pin', pin_time=0.05)
+        router.note_write()
+        self.assert_equal('primary', router.get('SELECT')['name'])
+        # the pin is per thread
+        names = []
+        other = threading.Thread(target=lambda: names.append(router.get('SELECT')['name']))
+        other.start()
+        other.join()
+        self.assert_equal(['replica'], names)
+        time.sleep(0.06)
+        self.assert_equal('replica', router.get('SELECT')['name'])
+
+    def test_position(self):
+        from schemaless.replica import ReadRouter
+        position = [120]
+        def primary_respond(query, parameters):
+            if query == 'SHOW MASTER STATUS':
+                return {'File': 'mysql-bin.000001', 'Position': position[0]}
+            return {'name': 'primary'}
+        def replica_respond(query, parameters):
+            if query.startswith('SELECT MASTER_POS_WAIT'):
+                return {'pos_wait': 0}
+            return {'name': 'replica'}
+        primary = FakeConnection(primary_respond)
+        replica = FakeConnection(replica_respond)
+        router = ReadRouter(primary, [replica], read_your_writes='position')
+        router.note_write()
+        self.assert_equal(['replica'] * 3, [router.get('SELECT')['name'] for x in xrange(3)])
+        # the position is only waited for once
+        self.assert_len(1, [q for q in replica.statements if 'MASTER_POS_WAIT' in q])
+
+        # nor is an older position
+        router.state.write_position = ('mysql-bin.000001', 100)
+        self.assert_equal('replica', router.get('SELECT')['name'])
+        self.assert_len(1, [q for q in replica.statements if 'MASTER_POS_WAIT' in q])
+
+        position[0] = 200
+        router.note_write()
+        self.assert_equal('replica', router.get('SELECT')['name'])
+        self.assert_len(2, [q for q in replica.statements if 'MASTER_POS_WAIT' in q])
+
+    def test_single_flight_routing(self):
+        import threading
+        from schemaless.replica import ReadRouter
+        from schemaless.singleflight import SingleFlight, SharedReads
+        started = threading.Event()
+        release = threading.Event()
+        def lagging(query, parameters):
+            started.set()
+            release.wait(5)
+            return 'stale'
+        router = ReadRouter(FakeConnection(lambda query, parameters: 'fresh'), [FakeConnection(lagging)], read_your_writes='pin')
+        reads = SharedReads(SingleFlight(), router, 'test', lambda: False)
+        read = lambda: reads.do(('by_id', 'a'), lambda reader: reader.get('SELECT'))
+
+        # this thread has just written, so its reads go to the primary, and
+        # mustn't join a read another thread sent to a replica after the
+        # write
+        router.note_write()
+        results = []
+        other = threading.Thread(target=lambda: results.append(read()))
+        other.start()
+        started.wait()
+        self.assert_equal('fresh', read())
+        release.set()
+        other.join()
+        self.assert_equal(['stale'], results)
+        self.assert_equal(0, reads.flight.snapshot()['by_id']['coalesced'])
+
+class ChangeFeedTestCase(TestBase):
+
+    def setUp(self):
+        super(ChangeFeedTestCase, self).setUp()
+        self.ds = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test', changelog=True)
+        self.user = self.ds.define_index('index_user_id', ['user_id'])
+        self.clear_tables(self.ds)
+
+    def test_changes(self):
+        feed = schemaless.ChangeFeed(self.ds, 'test')
+        self.assert_equal([], feed.poll())
+
+        entity = self.ds.put({'user_id': schemaless.guid()})
+        entity.user_id = schemaless.guid()
+        self.ds.put(entity)
+        other = self.ds.put({'user_id': schemaless.guid()})
+        self.ds.delete(other)
+
+        changes = feed.poll()
+        self.assert_equal([schemaless.CHANGE_INSERT, schemaless.CHANGE_UPDATE, schemaless.CHANGE_INSERT, schemaless.CHANGE_DELETE], [ch.op for ch in changes])
+        self.assert_equal([entity.id, entity.id, other.id, other.id], [ch.entity_id for ch in changes])
+        self.assert_equal(entity.user_id, changes[0].entity.user_id)
+        self.assert_equal(None, changes[3].entity)
+
+        # a new feed for the same consumer starts from the committed offset
+        feed.commit()
+        self.assert_equal([], schemaless.ChangeFeed(self.ds, 'test').poll())
+        self.assert_len(4, schemaless.ChangeFeed(self.ds, 'other').poll())
+
+class ChunkTestCase(TestBase):
+
+    def setUp(self):
+        super(ChunkTestCase, self).setUp()
+        self.ds = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test', chunk_threshold=1000, chunk_size=256)
+        self.user = self.ds.define_index('index_user_id', ['user_id'])
+        self.clear_tables(self.ds)
+
+    def test_chunks(self):
+        text = u'x' * 5000
+        entity = self.ds.put({'user_id': schemaless.guid(), 'text': text})
+        self.assert_equal(['text'], entity.chunked_fields)
+        self.assert_equal(text, u''.join(entity.stream_field('text')))
+
+        entity = self.user.query(c.user_id == entity.user_id)[0]
+        entity.title = 'small change'
+        self.ds.put(entity)
+        entity = self.ds.by_id(entity.id)
+        self.assert_equal('small change', entity.title)
+        self.assert_equal(text, entity.text)
+
+        self.ds.delete(entity)
+        row = self.ds.connection.get('SELECT COUNT(*) AS count FROM entity_chunks')
+        self.assert_equal(0, row['count'])
+
+    def test_small_update(self):
+        entity = self.ds.put({'user_id': schemaless.guid(), 'title': 'small'})
+        entity.title = 'still small'
+        events = []
+        self.ds.add_query_hook(after=events.append)
+        self.ds.put(entity)
+        self.ds.remove_query_hook(after=events.append)
+        # an entity that never had chunks has none to delete
+        self.assert_equal([], [e.statement for e in events if e.table == 'entity_chunks'])
+
+    def test_indexed_fields_stay_inline(self):
+        names = self.ds.define_index('index_user_name', ['first_name', 'last_name'])
+        entity = self.ds.put({'first_name': 'a' * 250, 'last_name': 'b' * 250, 'note': 'c' * 200, 'other': 'd' * 200, 'more': 'e' * 200})
+        self.assert_equal(['other'], entity.chunked_fields)
+
+        # written back without loading its chunks, it stays in the index
+        entity = names.get(c.first_name == 'a' * 250, c.last_name == 'b' * 250)
+        entity.note = 'changed'
+        self.ds.put(entity)
+        self.assert_len(1, names.query(c.first_name == 'a' * 250))
+
+class ExpiryTestCase(TestBase):
+
+    def setUp(self):
+        super(ExpiryTestCase, self).setUp()
+        self.ds = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test', expiry=True)
+        self.user = self.ds.define_index('index_user_id', ['user_id'])
+        self.clear_tables(self.ds)
+
+    def test_expiry(self):
+        user_id = schemaless.guid()
+        live = self.ds.put({'user_id': user_id}, ttl=3600)
+        expired = self.ds.put({'user_id': user_id}, ttl=-1)
+        self.assert_equal(None, self.ds.by_id(expired.id))
+        self.assert_equal([live.id], [e.id for e in self.user.query(c.user_id == user_id)])
+
+        # writing an entity back without expires_at keeps its expiry time
+        del live['expires_at']
+        live.foo = 'bar'
+        self.ds.put(live)
+        assert self.ds.by_id(live.id).expires_at > time.time()
+
+        self.assert_equal(1, schemaless.ExpiryPurger(self.ds, pause=0).run())
+        self.assert_len(1, self.ds.connection.query('SELECT * FROM index_user_id WHERE user_id = %s', user_id))
+        self.assert_len(1, self.ds.connection.query('SELECT * FROM entity_expiry'))
+
+    def test_limit_skips_expired(self):
+        user_id = schemaless.guid()
+        for x in xrange(3):
+            self.ds.put({'user_id': user_id}, ttl=-1)
+        live = self.ds.put({'user_id': user_id}, ttl=3600)
+        events = []
+        self.ds.add_query_hook(after=events.append)
+        self.assert_equal(live.id, self.user.get(c.user_id == user_id).id)
+        self.ds.remove_query_hook(after=events.append)
+        # the expired entities are skipped by the index query itself
+        self.assert_equal(['index_user_id', 'entities'], [e.table for e in events])
+        self.assert_equal([live.id], [e.id for e in self.user.query(c.user_id == user_id, limit=2)])
+
+    def test_search_skips_expired(self):
+        text = self.ds.define_text_index('text_post', ['title'])
+        live = self.ds.put({'title': 'mysql replication'}, ttl=3600)
+        for x in xrange(3):
+            self.ds.put({'title': 'mysql backups'}, ttl=-1)
+        self.assert_equal([live.id], [e.id for e in text.search('mysql', limit=1)])
+        self.assert_equal([live.id], [e.id for e in text.search('mysq', prefix=True, limit=2)])
+
+class ViewTestCase(TestBase):
+
+    def setUp(self):
+        super(ViewTestCase, self).setUp()
+        self.ds = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test')
+        self.user_count = self.ds.define_view('view_user_count', ['user_id'])
+        self.clear_tables(self.ds)
+
+    def test_count(self):
+        user_id, other_id = schemaless.guid(), schemaless.guid()
+        entity = self.ds.put({'user_id': user_id})
+        self.ds.put({'user_id': user_id})
+        self.assert_equal(2, self.user_count.get(user_id))
+        self.assert_equal(0, self.user_count.get(other_id))
+
+        entity.user_id = other_id
+        self.ds.put(entity)
+        self.assert_equal({(user_id,): 1, (other_id,): 1}, self.user_count.get_many([(user_id,), (other_id,)]))
+
+        self.ds.delete(entity)
+        self.assert_equal(0, self.user_count.get(other_id))
+
+        self.user_count.rebuild()
+        self.assert_equal(1, self.user_count.get(user_id))
+
+    def test_rebuild_tagged(self):
+        user_id = schemaless.guid()
+        ds = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test')
+        tagged = ds.define_view('view_user_count', ['user_id'], match_on={'tag': 1})
+        ds.put({'user_id': user_id}, tag=1)
+        ds.put({'user_id': user_id})
+        self.assert_equal(1, tagged.get(user_id))
+        tagged.rebuild()
+        self.assert_equal(1, tagged.get(user_id))
+
 class ORMTestCase(TestBase):
     def setUp(self):
         datastore = schemaless.DataStore(mysql_shards=['localhost:3306'], user='test', password='test', database='test')
@@ -158,6 +722,54 @@ class SchemalessORMTestCase(ORMTestCase):
         self.assert_used_index(self.User, 'index_user_id')
         self.assert_equal(set(user_ids[:3]), set(u.user_id for u in users[:3]))
 
+    def test_session_save_batches(self):
+        users = [self.User(user_id=schemaless.guid(), first_name='foo', last_name='bar') for x in range(5)]
+        events = []
+        self.session.datastore.add_query_hook(after=events.append)
+        self.session.save()
+        self.session.datastore.remove_query_hook(after=events.append)
+
+        # BEGIN, one insert into entities and into each matching index, COMMIT
+        self.assert_len(5, events)
+        for u in users:
+            assert u.id
+            assert not u.is_dirty
+        self.assert_len(5, self.User.query(c.first_name == 'foo', c.last_name == 'bar'))
+
+        users[0].first_name = 'baz'
+        users[0].first_name = 'quux'
+        self.session.save()
+        self.assert_equal(users[0].id, self.User.get(c.first_name == 'quux', c.last_name == 'bar').id)
+        self.assert_len(4, self.User.query(c.first_name == 'foo', c.last_name == 'bar'))
+
+    def test_saved_updated_type(self):
+        saved = self.User(user_id=schemaless.guid(), first_name='foo', last_name='bar').save()
+        flushed = self.User(user_id=schemaless.guid(), first_name='foo', last_name='bar')
+        self.session.save()
+        assert isinstance(saved.updated, datetime.datetime)
+        self.assert_equal(type(saved.updated), type(flushed.updated))
+        # and the same as reading the document back
+        self.session.clear()
+        self.assert_equal(flushed.updated, self.User.by_id(flushed.id).updated)
+
+        saved.first_name = 'baz'
+        saved.save()
+        assert isinstance(saved.updated, datetime.datetime)
+
+    def test_identity_map(self):
+        u = self.User(user_id=schemaless.guid(), first_name='foo', last_name='bar')
+        u.save()
+        assert self.User.by_id(u.id) is u
+        assert self.User.get(c.user_id == u.user_id) is u
+
+        self.session.clear()
+        v = self.User.by_id(u.id)
+        assert v is not u
+        assert self.User.get(c.user_id == u.user_id) is v
+
+        v.delete()
+        self.assert_equal(None, self.User.by_id(u.id))
+
     def test_name_query(self):
         u = self.User(user_id=schemaless.guid(), first_name='foo', last_name='bar')
         u.save()
@@ -206,6 +818,47 @@ class SchemalessORMTestCase(ORMTestCase):
         v = self.User.get(c.user_id == u.user_id)
         self.assert_(isinstance(v.time_created, datetime.datetime))
 
+    def test_copy_and_pickle(self):
+        import copy
+        import pickle
+        u = self.User(user_id=schemaless.guid(), first_name='evan', last_name='klitzke')
+        u.save()
+        self.session.clear()
+        loaded = self.User.by_id(u.id) # hydrated, without going through __init__
+        # pickle finds classes by name
+        globals()['User'] = self.User
+        try:
+            for duplicate in (copy.copy, copy.deepcopy, lambda x: pickle.loads(pickle.dumps(x, 0)), lambda x: pickle.loads(pickle.dumps(x, 2))):
+                for doc in (u, loaded):
+                    other = duplicate(doc)
+                    self.assert_equal(doc, other)
+                    self.assert_equal(doc.id, other.id)
+                    other.first_name = 'george'
+                    self.assert_equal('evan', doc.first_name)
+                    assert other.is_dirty
+        finally:
+            del globals()['User']
+
+    def test_hydrate(self):
+        u = self.User(user_id=schemaless.guid(), first_name='foo', last_name='bar')
+        u.save()
+        self.session.clear()
+
+        v = self.User.by_id(u.id)
+        assert v is not u
+        self.assert_equal(u, v)
+        assert not v.is_dirty
+        assert v._saveable()
+        assert not hasattr(v, 'birthdate')
+        assert isinstance(v.time_created, datetime.datetime)
+
+        # non-column attributes can still be set
+        v.scratch = 1
+        v.last_name = 'baz'
+        assert v.is_dirty
+        v.save()
+        self.assert_equal('baz', self.User.get(c.user_id == u.user_id).last_name)
+
     def test_index_update(self):
         u = self.User(user_id=schemaless.guid(), first_name='evan', last_name='klitzke')
         u.save()
@@ -245,6 +898,26 @@ class ManyToOneORMTestCase(ORMTestCase):
         item1.save()
 
         self.assert_equal(self.get_index_count('index_todo_user_id'), 2)
+
+    def test_prefetch(self):
+        class User(self.base_class):
+            _columns = [orm.Column('name')]
+
+        users = [User(name='evan').save(), User(name='george').save()]
+        for x in range(3):
+            self.ToDo(user_id=users[0].id, action='buy groceries').save()
+
+        events = []
+        self.session.datastore.add_query_hook(after=events.append)
+        fetched = User.all().prefetch(self.ToDo, 'user_id')
+        self.session.datastore.remove_query_hook(after=events.append)
+
+        # one query for the users, one index query and one entity fetch for
+        # all of the items
+        self.assert_len(3, events)
+        items = dict((u.name, u.prefetched(self.ToDo, 'user_id')) for u in fetched)
+        self.assert_len(3, items['evan'])
+        self.assert_len(0, items['george'])
        
 class AutomaticORMTestCase(ORMTestCase):
     """Test ORM documents with automatic indexes."""